@@ -209,22 +209,28 @@ SQL文件格式示例：
 
 注意事项：
     1. 输入Excel文件中的time_minute列会被向下取整到10分钟（如：202512260047 -> 202512260040）
-    2. 累计计算使用time_minute_10进行过滤，而不是原始的time_minute
+    2. 累计计算使用10分钟桶（time_minute_10，内部以当天桶下标 0..143 表示）进行过滤，而不是原始的time_minute
     3. 输出中的date_minute和date_p会被转换为字符串格式，避免Excel显示为科学计数法
     4. 如果启用CUBE聚合，会生成所有维度组合（包括"整体"），数据量会显著增加
 """
 
 import argparse
+import csv
+import hashlib
+import io
+import itertools
 import re
 import os
 import sys
 import time
 import shutil
+import tempfile
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List
+from typing import Iterator, List
 import xml.etree.ElementTree as ET
 
+import numpy as np
 import pandas as pd
 
 
@@ -287,6 +293,74 @@ def _maybe_categorize_dims(df: pd.DataFrame, dim_cols: List[str]) -> pd.DataFram
     return out
 
 
+def _factorize_dims(df: pd.DataFrame, dim_cols: List[str]):
+    """
+    把多个维度列一次性编码为单个 int64 组合组号（__gid），用于替代字符串维度上的 groupby/sort/merge。
+
+    返回 (gid, dims_tab)：
+    - gid：与 df 行对齐的组号（0..G-1，按首次出现顺序编号）
+    - dims_tab：第 i 行即组号 i 对应的维度取值，仅在组装输出时用于解码回字符串
+    说明：NaN 也会被当成一个独立取值（与 groupby(dropna=False) 语义一致）。
+    """
+    n = len(df)
+    if not dim_cols:
+        return np.zeros(n, dtype=np.int64), pd.DataFrame(index=range(1 if n else 0))
+    gid = np.zeros(n, dtype=np.int64)
+    card = 1
+    for c in dim_cols:
+        codes, uniques = pd.factorize(df[c], sort=False, use_na_sentinel=False)
+        k = max(len(uniques), 1)
+        if card * k >= 2**62:
+            # 混合进制即将溢出 int64：先把已有组合压缩成稠密组号再继续
+            gid, uniq = pd.factorize(gid, sort=False)
+            card = max(len(uniq), 1)
+        gid = gid.astype(np.int64) * k + codes
+        card *= k
+    gid, _ = pd.factorize(gid, sort=False)
+    gid = gid.astype(np.int64)
+    _, first_idx = np.unique(gid, return_index=True)
+    dims_tab = df[dim_cols].iloc[first_idx].reset_index(drop=True)
+    return gid, dims_tab
+
+
+def _decode_dims(out: pd.DataFrame, dims_tab: pd.DataFrame, gid_col: str = "__gid") -> pd.DataFrame:
+    """把 __gid 列解码回维度列（维度列放在最前，其余列保持原顺序）。"""
+    dims = dims_tab.iloc[out[gid_col].to_numpy(dtype=np.int64)].reset_index(drop=True)
+    rest = out.drop(columns=[gid_col]).reset_index(drop=True)
+    return pd.concat([dims, rest], axis=1)
+
+
+_CANONICAL_UINT_RE = r"^(?:0|[1-9][0-9]{0,17})$"
+
+
+def _encode_distinct_key(s: pd.Series, *, collision_check: bool = False) -> pd.Series:
+    """
+    在读入阶段把 distinct 键列（uid/order_id 等）一次性清洗并压缩为 nullable Int64：
+    - 无效值（见 _distinct_key_mask）编码为 NA，有效性掩码随列保存，后续阶段不再做字符串判断
+    - 规范的非负整数文本（无前导零、不超过 18 位）直接取其整数值
+    - 其他取值取 64 位哈希（pd.util.hash_array）并置最高位，落在负数区间，与整数值互不重叠
+
+    哈希对同一取值在不同批次/进程间稳定，不依赖 factorize 的编号顺序。
+    collision_check=True 时校验“不同原始值 -> 不同哈希”，冲突则报错（可改用 --key-encoding raw）。
+    """
+    valid = _distinct_key_mask(s).to_numpy()
+    out = np.zeros(len(s), dtype=np.int64)
+    if valid.any():
+        text = s[valid].astype(str)
+        is_int = text.str.match(_CANONICAL_UINT_RE).to_numpy()
+        vals = np.empty(len(text), dtype=np.int64)
+        if is_int.any():
+            vals[is_int] = text[is_int].astype(np.int64).to_numpy()
+        if (~is_int).any():
+            raw = text[~is_int].to_numpy(dtype=object)
+            h = pd.util.hash_array(raw) | np.uint64(1 << 63)
+            vals[~is_int] = h.view(np.int64)
+            if collision_check and len(pd.unique(h)) != len(pd.unique(raw)):
+                raise RuntimeError(f"distinct 键 {s.name} 的 64 位哈希出现冲突，请改用 --key-encoding raw")
+        out[valid] = vals
+    return pd.Series(pd.arrays.IntegerArray(out, ~valid), index=s.index, name=s.name)
+
+
 def _normalize_dim_values(df: pd.DataFrame, dim_cols: List[str]) -> pd.DataFrame:
     """
     维度值标准化：
@@ -326,9 +400,13 @@ def _distinct_key_mask(s: pd.Series) -> pd.Series:
 
     注意：如果源数据本身确实存在“空字符串”作为合法值，这个过滤会与 SQL 语义不一致；
     但对 uid/order_id 这类字段通常不会出现空字符串，优先保证与 Hive NULL 输出对齐。
+
+    已按 --key-encoding int64 编码过的列（整数类型，无效值为 NA，见 _encode_distinct_key）直接取 notna。
     """
     if s is None:
         return pd.Series(dtype=bool)
+    if pd.api.types.is_integer_dtype(s.dtype):
+        return s.notna()
     mask = s.notna()
     if mask.any():
         ss = s[mask].astype(str).str.strip()
@@ -385,6 +463,11 @@ def parse_args():
     p.add_argument("--sql-text", help="SQL文本字符串（包含SELECT字段列表）")
     p.add_argument("--sql", dest="sql_text", help="SQL文本字符串别名（同 --sql-text）")
     p.add_argument("--no-cube", action="store_true", help="禁用CUBE聚合（默认开启CUBE，生成'整体'维度组合）")
+    p.add_argument(
+        "--grouping-sets",
+        default=None,
+        help="只计算指定的维度组合（GROUPING SETS），替代完整 CUBE；例如 \"(os_type, func_name), (os_type), ()\" 或 \"rollup(os_type, func_name)\"；也可在SQL中写注释行 -- grouping_sets: ...（命令行优先）",
+    )
     p.add_argument(
         "--output_table",
         "--dw-table",
@@ -576,17 +659,136 @@ def parse_args():
         default="\\0001",
         help="datawork-client query_to_local 的 -fd 分隔符（默认 \\0001，与 online_test.py 对齐）",
     )
+    p.add_argument(
+        "--dw-pushdown-first-seen",
+        action="store_true",
+        help="把首次出现下推到源端：替代预聚合，拉取 1 条按 (维度,桶) 的 sum 查询 + 每个 distinct 字段 1 条 "
+        "min(桶) group by 维度,key 的查询（并发执行），本地只做新增计数、累计与 CUBE；多个 distinct 键时落地量大幅减少，结果不变",
+    )
+    p.add_argument(
+        "--dw-pull-slice-minutes",
+        type=int,
+        default=0,
+        help="把明细拉取按 time_minute 切成若干时间分片（分钟，10 的倍数，如 60），各分片单独 query_to_local 并发执行，"
+        "完成一片即解析一片；默认 0（整天一次拉取）",
+    )
+    p.add_argument(
+        "--dw-pull-workers",
+        type=int,
+        default=4,
+        help="--dw-pull-slice-minutes 下同时执行的 query_to_local 数（默认 4）",
+    )
+    p.add_argument(
+        "--dw-pull-retries",
+        type=int,
+        default=0,
+        help="每次 query_to_local（含各分片）在主引擎与回退引擎都失败后的重试次数（默认 0，不重试）",
+    )
     p.add_argument(
         "--dw-query-to-local-max-bytes",
         type=int,
         default=0,
         help="query_to_local 落地文件大小上限（字节）。默认不限制（0）；仅在你确认要强制保护本机时才建议设置",
     )
+    p.add_argument(
+        "--stream-chunk-rows",
+        type=int,
+        default=0,
+        help="按块流式处理 query_to_local 文件（每块行数）：每块预处理后立即归约为 (维度,桶) sum 增量与 (维度,key) 首次出现桶，"
+        "不再持有完整明细，峰值内存由聚合状态决定。默认 0（整表读入）；建议 1000000 左右，仅 source=datawork",
+    )
     p.add_argument(
         "--dw-compute-mode",
-        choices=["pandas", "sparksql"],
+        choices=["pandas", "sparksql", "duckdb", "localspark"],
         default="pandas",
-        help="计算模式：pandas（默认，本机计算；适合百万级以内）或 sparksql（集群侧 SparkSql 直接算累计+CUBE并写表；适合千万/亿级明细）",
+        help="计算模式：pandas（默认，本机计算；适合百万级以内）、sparksql（集群侧 SparkSql 直接算累计+CUBE并写表；适合千万/亿级明细）、"
+        "duckdb（本机内嵌 DuckDB 执行与 sparksql 同一套累计+CUBE 计划，多线程向量化、可落盘；需要 pip install duckdb）"
+        "或 localspark（query_to_local 落地文件读进本机 SparkSession，用 sparksql 同一套 SQL 计算并直接写 ORC，不经 pandas；需要 pyspark，仅 source=datawork）",
+    )
+    p.add_argument(
+        "--cum-engine",
+        choices=["groupby", "codes", "dense"],
+        default="groupby",
+        help="pandas 累计计算实现：groupby（默认，直接按字符串维度分组）、codes（维度先编码为单个 int64 组号再计算，维度多/行数大时更快）或 dense（组号+稠密 NumPy 累计内核，不再构造 维度x时间 网格 merge/ffill）",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="pandas 精确去重的并行进程数（默认 1=单进程）；>1 时按 distinct key 的哈希分片到进程池分别计算首次出现/每桶新增数再相加，结果与单进程一致",
+    )
+    p.add_argument(
+        "--cube-executor",
+        choices=["serial", "levels"],
+        default="serial",
+        help="distinct CUBE 的执行方式：serial（默认，逐个 mask 串行）或 levels（按维度折叠个数分层，同层 mask 提交到 --workers 大小的进程池并行；父层表以 mmap .npy 共享）",
+    )
+    p.add_argument(
+        "--cube-spill",
+        action="store_true",
+        help="CUBE 遍历时把每个 mask 的成品表先落盘到 --dw-tmp-dir（pickle），结束后再读回拼接；用于压低本地 CUBE 的峰值内存",
+    )
+    p.add_argument(
+        "--cube-over-increments",
+        action="store_true",
+        help="sum 指标的 CUBE 先在稀疏的每桶增量上做，再对每个组合一次性 cumsum + 稠密展开；跳过叶子层稠密累计表（维度稀疏时进入 CUBE 的行数少一个数量级）",
+    )
+    p.add_argument(
+        "--cube-fd-detect",
+        action="store_true",
+        help="本地 CUBE 前在数据上检测维度间的精确函数依赖（如 country_name -> country_type），可推出的组合直接复制改名为“整体”，跳过对应的 groupby；也可在SQL中写注释行 -- fd: a -> b 声明",
+    )
+    p.add_argument(
+        "--first-seen-method",
+        choices=["groupby", "sort", "bitmap"],
+        default="groupby",
+        help="distinct CUBE 中各组合“key 首次出现时间”的求法：groupby（默认，每个组合 groupby min）、sort（按时间排序一次，之后每个组合只做 drop_duplicates，排序在整个 CUBE 上复用）或 bitmap（每个(维度,桶)一个 roaring 位图，折叠维度时按桶 OR，需要 pyroaring；整数键/--key-encoding int64 时直接用键值作位图下标；--cube-executor levels 下按 groupby 处理）",
+    )
+    p.add_argument(
+        "--key-encoding",
+        choices=["raw", "int64"],
+        default="raw",
+        help="distinct 键（uid/order_id 等）在读入后的表示：raw（默认，保持原始字符串）或 int64（一次性清洗为 nullable Int64：规范整数取原值，其余取 64 位哈希；无效值为 NA），显著降低内存并省去各阶段的空值判断",
+    )
+    p.add_argument(
+        "--key-collision-check",
+        action="store_true",
+        help="--key-encoding int64 时校验哈希无冲突（不同原始值得到不同哈希），冲突则报错",
+    )
+    p.add_argument(
+        "--distinct-mode",
+        choices=["exact", "hll"],
+        default="exact",
+        help="distinct 指标口径：exact（默认，精确 count(distinct)）或 hll（HyperLogLog 近似：按 (维度,桶) 维护可合并草图，CUBE 与时间累计都只做寄存器 max；sparksql 模式对应 hll_sketch_agg + 窗口 hll_union_agg，需 Spark 3.5+）",
+    )
+    p.add_argument(
+        "--hll-precision",
+        type=int,
+        default=12,
+        help="--distinct-mode hll 的精度 p，取值 4..18（寄存器数 2^p，标准误差约 1.04/sqrt(2^p)；默认 12≈1.6%%）",
+    )
+    p.add_argument(
+        "--state-dir",
+        default=None,
+        help="日内滚动增量模式：按 date_p + SQL 签名把叶子层累计状态（每(维度,桶)的 sum 增量、每个 distinct 字段已出现的 key 及首次出现桶）存到该目录；下次运行只拉取 time_minute 晚于上次 end_ts 的明细并合并。--dw-mode append 时只输出新的时间点，并额外保存各维度组合的累计值与已出现 key，只计算新的桶；--dw-mode overwrite（以及 duckdb / hll）时每次仍重算全天的累计与 CUBE，只有拉取是增量的",
+    )
+    p.add_argument(
+        "--late-arrival-check",
+        action="store_true",
+        help="配合 --state-dir：每次运行先拉取每个10分钟桶的行数+校验和，与上次记录比较；有迟到数据时只从最早变化的桶起重算，"
+        "并且只重写受影响的时间段（sqlalchemy 按 date_minute 删除重写；spark 写入配合 --dw-write-slice-minutes 只替换受影响分片的 ORC 文件）。需 --dw-mode overwrite",
+    )
+    p.add_argument(
+        "--granularities",
+        default=None,
+        help="一次运行输出多个时间粒度（分钟，逗号分隔，须为10的倍数），例如 10,30,60；粗粒度由10分钟累计结果直接推出，"
+        "写到带 _<分钟>m 后缀的输出文件/表（如 out_30m.xlsx、<table>_60m），10 分钟仍写原名；不含 10 时不输出 10 分钟结果",
+    )
+    p.add_argument(
+        "--output-mode",
+        choices=["dense", "changes"],
+        default="dense",
+        help="输出形态：dense（默认，每个维度组合在每个10分钟点一行）或 changes（只输出有指标变化的行，组合第一次出现时也输出一行；本地计算跳过 维度x时间 网格，还原用 densify_change_only）",
     )
     p.add_argument(
         "--dw-compute-engine",
@@ -604,7 +806,11 @@ def parse_args():
     )
     p.add_argument("--dw-dry-run", action="store_true", help="仅生成SQL与数据文件，不实际调用datawork-client执行")
     p.add_argument("--profile", action="store_true", help="输出分阶段耗时与行数统计（用于性能诊断）")
-    return p.parse_args()
+    args = p.parse_args()
+    # p 过小误差失控、过大寄存器数组按 (维度, 桶) 成倍放大内存；SparkSQL 草图的 lgConfigK 也取同一值
+    if not 4 <= args.hll_precision <= 18:
+        p.error(f"--hll-precision 取值范围为 4..18: {args.hll_precision}")
+    return args
 
 
 def read_sql(args):
@@ -808,6 +1014,72 @@ def _build_preagg_hql(raw_hql: str, *, fields: List[str], metric_rules: dict) ->
     )
 
 
+def _build_first_seen_pushdown_hqls(
+    raw_hql: str, *, fields: List[str], metric_rules: dict, end_ts: int
+) -> List[str]:
+    """
+    --dw-pushdown-first-seen：把首次出现下推到源端，替代 _build_preagg_hql 的“维度 + 全部 distinct 键 + 桶”分组。
+    返回若干条拉取SQL（列序都与 fields 一致，本地按同一套读入/预处理处理，拼起来等价于一份紧凑明细）：
+    - 第 1 条：按 维度 + 桶 + date_p 的 sum 增量（distinct 键输出 NULL）
+    - 其后每个 distinct 字段一条：按 维度 + key + date_p 取 min(桶)，即该 key 的首次出现桶（sum 输出 0）
+
+    多个 distinct 键时不再保留 (order_id, uid) 组合，落地行数约为 维度x桶 + Σ 维度xkey。
+    首次出现只统计 end_ts 所在桶及之前的明细（之后的行本地本来也会丢弃）。
+    """
+    time_cols = {"time_hour", "time_minute", "date_p", "date_minute", "time_minute_10"}
+    metric_cols = [f for f in fields if f in metric_rules]
+    distinct_fields = [f for f in metric_cols if metric_rules.get(f) == "distinct"]
+    sum_fields = [f for f in metric_cols if metric_rules.get(f) == "sum"]
+    dim_cols = [c for c in fields if c not in metric_cols and c not in time_cols]
+    if "time_minute" not in fields:
+        raise ValueError("--dw-pushdown-first-seen 需要输入SQL包含 time_minute 字段")
+
+    tm_expr = "concat(substr(cast(time_minute as string),1,11),'0')"
+    inner = raw_hql.strip().rstrip(";").strip()
+    part_cols = ["date_p"] if "date_p" in fields else []
+
+    def build(select_cols: List[str], group_cols: List[str], where: str = None) -> str:
+        return (
+            "select "
+            + ", ".join(select_cols)
+            + "\nfrom (\n"
+            + inner
+            + "\n) raw\n"
+            + (f"where {where}\n" if where else "")
+            + "group by "
+            + ", ".join(group_cols)
+        )
+
+    def select_for(key: str = None) -> List[str]:
+        cols = []
+        for f in fields:
+            if f == "time_minute":
+                cols.append(f"min(cast({tm_expr} as bigint)) as time_minute" if key else f"{tm_expr} as time_minute")
+            elif f == "time_hour":
+                cols.append("max(time_hour) as time_hour")
+            elif f == "date_p" or f in dim_cols or f == key:
+                cols.append(f)
+            elif f in sum_fields:
+                cols.append("0 as " + f if key else f"sum({f}) as {f}")
+            elif f in distinct_fields:
+                cols.append(f"cast(null as string) as {f}")
+            else:
+                cols.append(f)
+        return cols
+
+    hqls = [build(select_for(), dim_cols + [tm_expr] + part_cols)]
+    end_10 = int(floor_10m(int(end_ts)))
+    for k in distinct_fields:
+        hqls.append(
+            build(
+                select_for(k),
+                dim_cols + [k] + part_cols,
+                where=f"{k} is not null and cast({tm_expr} as bigint) <= {end_10}",
+            )
+        )
+    return hqls
+
+
 def _build_sparksql_cum_cube_insert(
     *,
     raw_hql: str,
@@ -821,9 +1093,17 @@ def _build_sparksql_cum_cube_insert(
     schema_info: dict,
     no_cube: bool,
     preagg: bool,
+    grouping_sets: List[List[str]] = None,
+    distinct_mode: str = "exact",
+    hll_precision: int = 12,
+    select_only: bool = False,
 ) -> str:
     """
     在集群侧用 SparkSQL 直接计算“10分钟累计 + CUBE（可选）”，并 insert overwrite 到目标分区表。
+    select_only=True 时只返回 `with ... select 目标表列 from final`（不含 set/insert），
+    供 --dw-compute-mode localspark 在本机 SparkSession 里执行。
+    grouping_sets 非空时以 GROUPING SETS 只计算指定的维度组合（见 parse_grouping_sets）。
+    distinct_mode=hll 时 distinct 指标改用按 (维度, 桶) 的 HLL 草图再窗口合并（见 _approx_distinct_sql）。
 
     适用场景：明细数据量很大（千万/亿级），不适合 query_to_local 拉到本机再用 pandas 计算。
     """
@@ -905,7 +1185,7 @@ spine as (
     if dim_cols and (not no_cube):
         # WITH CUBE 会产生 NULL 维度，输出时统一转为 '整体'，避免后续 join 维度对不上
         dim_out_select = ", ".join([f"coalesce({c},'整体') as {c}" for c in dim_cols])
-        sum_group_by = f"group by date_minute, {dims_group} with cube"
+        sum_group_by = _sql_cube_group_by(["date_minute"], dim_cols, grouping_sets)
     elif dim_cols:
         dim_out_select = ", ".join(dim_cols)
         sum_group_by = f"group by date_minute, {dims_group}"
@@ -918,7 +1198,7 @@ sum_bucket as (
   select
     date_minute
     {',' if dim_out_select else ''}{dim_out_select}
-    {',' if sum_bucket_cols else ''}{sum_bucket_select}
+    ,{sum_bucket_select}
   from base
   {sum_group_by}
 )
@@ -927,22 +1207,55 @@ sum_bucket as (
     # distinct：先求 first_minute，再算每桶新增，再做 cumsum
     distinct_ctes = []
     new_cols = []
+    approx_names = []
     for k in distinct_keys:
         out_name = output_names.get(k, k)
-        first = f"""
+        if distinct_mode == "hll":
+            approx = _approx_distinct_sql(
+                k,
+                out_name,
+                base_sql="base",
+                dim_cols=dim_cols,
+                no_cube=no_cube,
+                grouping_sets=grouping_sets,
+                hll_precision=hll_precision,
+            )
+            distinct_ctes.append(f"{out_name}_approx as (\n{approx}\n)")
+            approx_names.append(out_name)
+            continue
+        if dim_cols and (not no_cube):
+            # CUBE 必须作用在 (dims, key) 的 first-seen 上：同一个 key 出现在多个维度值下时，
+            # 在 整体 行里只按其最早一次计入；再过滤掉 key 被折叠掉的行。
+            # 若先按 (dims, key) 求 first 再对 first_minute CUBE，整体 会把同一个 key 重复计数。
+            cube_dim_select = ", ".join([f"coalesce({c},'整体') as {c}" for c in dim_cols])
+            first = f"""
+{out_name}_first as (
+  select *
+  from (
+    select
+      min(date_minute) as first_minute
+      , {cube_dim_select}
+      , {k} as {k}
+    from base
+    where {k} is not null
+    {_sql_cube_group_by([k], dim_cols, grouping_sets)}
+  ) t
+  where {k} is not null
+)
+""".strip()
+        else:
+            first = f"""
 {out_name}_first as (
   select
     min(date_minute) as first_minute
     {',' if dim_cols else ''}{', '.join(dim_cols) if dim_cols else ''}
     , {k} as {k}
   from base
+  where {k} is not null
   group by {k}{',' if dim_cols else ''}{', '.join(dim_cols) if dim_cols else ''}
 )
 """.strip()
-        if dim_cols and (not no_cube):
-            new_dim_select = ", ".join([f"coalesce({c},'整体') as {c}" for c in dim_cols])
-            new_group_by = f"group by first_minute, {dims_group} with cube"
-        elif dim_cols:
+        if dim_cols:
             new_dim_select = ", ".join(dim_cols)
             new_group_by = f"group by first_minute, {dims_group}"
         else:
@@ -968,7 +1281,8 @@ sum_bucket as (
         dims_set_parts.append(f"select distinct {dims_select} from sum_bucket")
         for k in distinct_keys:
             out_name = output_names.get(k, k)
-            dims_set_parts.append(f"select distinct {dims_select} from {out_name}_new")
+            src = f"{out_name}_approx" if out_name in approx_names else f"{out_name}_new"
+            dims_set_parts.append(f"select distinct {dims_select} from {src}")
         dims_set = "dims as (\n  " + "\n  union\n  ".join(dims_set_parts) + "\n)"
     else:
         dims_set = "dims as (select 1 as __dummy_dim)"
@@ -991,6 +1305,9 @@ grid as (
         select_bucket_fields.append(f"coalesce(b.{out_name}_bucket,0) as {out_name}_bucket")
     for k in distinct_keys:
         out_name = output_names.get(k, k)
+        if out_name in approx_names:
+            select_bucket_fields.append(f"{out_name}_approx.{out_name}_sketch")
+            continue
         select_bucket_fields.append(f"coalesce({out_name}_new.{out_name}_new,0) as {out_name}_new")
 
     joined = f"""
@@ -1005,9 +1322,10 @@ joined as (
 """.rstrip()
     for k in distinct_keys:
         out_name = output_names.get(k, k)
+        alias = f"{out_name}_approx" if out_name in approx_names else f"{out_name}_new"
         joined += f"""
-  left join {out_name}_new {out_name}_new
-    on g.date_minute={out_name}_new.date_minute and {join_cond_new(out_name + "_new")}
+  left join {alias} {alias}
+    on g.date_minute={alias}.date_minute and {join_cond_new(alias)}
 """.rstrip()
     joined += "\n)"
 
@@ -1029,6 +1347,9 @@ joined as (
         )
     for k in distinct_keys:
         out_name = output_names.get(k, k)
+        if out_name in approx_names:
+            cum_select_cols.append(_approx_distinct_cum_sql(out_name, part_by))
+            continue
         cum_select_cols.append(
             f"sum({out_name}_new) over(partition by {part_by} order by {order_by} rows between unbounded preceding and current row) as {out_name}"
         )
@@ -1112,6 +1433,9 @@ joined as (
     cte_parts.extend([dims_set, grid, joined, final])
     with_sql = ",\n".join([p.strip() for p in cte_parts if p and p.strip()])
 
+    if select_only:
+        return f"with\n{with_sql}\nselect {', '.join(want_cols)}\nfrom final\n"
+
     insert_sql = (
         "set hive.exec.dynamic.partition.mode=nonstrict;\n"
         "with\n"
@@ -1138,9 +1462,14 @@ def _build_sparksql_cum_cube_insert_subquery(
     schema_info: dict,
     no_cube: bool,
     preagg: bool,
+    grouping_sets: List[List[str]] = None,
+    distinct_mode: str = "exact",
+    hll_precision: int = 12,
 ) -> str:
     """
     在集群侧用 SparkSQL 直接计算“10分钟累计 + CUBE（可选）”，并 insert overwrite 到目标分区表（date_p）。
+    grouping_sets 非空时以 GROUPING SETS 只计算指定的维度组合（见 parse_grouping_sets）。
+    distinct_mode=hll 时 distinct 指标改用按 (维度, 桶) 的 HLL 草图再窗口合并（精度与本地 hll_precision 对齐，见 _approx_distinct_sql）。
 
     注意：线上 OneSQL 校验对 JOIN 有额外限制（Join 两端必须是子查询），且 `select * from <CTE>` 会被当成真实表解析。
     因此这里不使用 WITH/CTE 来组织中间结果，而是生成“全子查询”的 INSERT SQL。
@@ -1298,9 +1627,7 @@ def _build_sparksql_cum_cube_insert_subquery(
                 + "\nfrom (\n"
                 + base_sql
                 + "\n) base\n"
-                + "group by "
-                + ", ".join(dim_cols)
-                + " with cube"
+                + _sql_cube_group_by([], dim_cols, grouping_sets)
             )
         else:
             dims_sql = (
@@ -1324,7 +1651,7 @@ def _build_sparksql_cum_cube_insert_subquery(
 
     if dim_cols and (not no_cube):
         sum_dim_select = ", ".join([f"coalesce({c},'整体') as {c}" for c in dim_cols])
-        sum_group_by = "group by date_minute, " + ", ".join(dim_cols) + " with cube"
+        sum_group_by = _sql_cube_group_by(["date_minute"], dim_cols, grouping_sets)
     elif dim_cols:
         sum_dim_select = ", ".join(dim_cols)
         sum_group_by = "group by date_minute, " + ", ".join(dim_cols)
@@ -1344,8 +1671,20 @@ def _build_sparksql_cum_cube_insert_subquery(
 
     # distinct：先求 first_minute，再算每桶新增
     distinct_new_sqls = {}
+    distinct_approx_sqls = {}
     for k in distinct_keys:
         out_name = output_names.get(k, k)
+        if distinct_mode == "hll":
+            distinct_approx_sqls[out_name] = _approx_distinct_sql(
+                k,
+                out_name,
+                base_sql="(\n" + base_sql + "\n) b",
+                dim_cols=dim_cols,
+                no_cube=no_cube,
+                grouping_sets=grouping_sets,
+                hll_precision=hll_precision,
+            )
+            continue
         # 关键点：distinct + cube 的语义必须在“distinct key 粒度”上做 cube。
         #
         # 错误做法（会导致 rollup/cube 层级重复计数）：
@@ -1358,7 +1697,7 @@ def _build_sparksql_cum_cube_insert_subquery(
         #   再按 first_minute 聚合为“新增数”，最后对新增数做窗口累计。
         if dim_cols and (not no_cube):
             first_dim_select = ", ".join([f"coalesce({c},'整体') as {c}" for c in dim_cols])
-            first_group_by = "group by " + k + ", " + ", ".join(dim_cols) + " with cube"
+            first_group_by = _sql_cube_group_by([k], dim_cols, grouping_sets)
             new_dim_select = ", ".join(dim_cols)
             new_group_by = "group by first_minute, " + ", ".join(dim_cols)
         elif dim_cols:
@@ -1428,8 +1767,10 @@ def _build_sparksql_cum_cube_insert_subquery(
     for f in sum_fields:
         out_name = output_names.get(f, f)
         joined_select_fields.append(f"coalesce(b.{out_name}_bucket,0) as {out_name}_bucket")
-    for out_name in [output_names.get(k, k) for k in distinct_keys]:
+    for out_name in distinct_new_sqls:
         joined_select_fields.append(f"coalesce(n_{out_name}.{out_name}_new,0) as {out_name}_new")
+    for out_name in distinct_approx_sqls:
+        joined_select_fields.append(f"h_{out_name}.{out_name}_sketch")
 
     joined_sql = (
         "select "
@@ -1451,6 +1792,14 @@ def _build_sparksql_cum_cube_insert_subquery(
             + "on "
             + _join_cond("g", f"n_{out_name}")
         )
+    for out_name, approx_sql in distinct_approx_sqls.items():
+        joined_sql += (
+            "\nleft join (\n"
+            + approx_sql
+            + f"\n) h_{out_name}\n"
+            + "on "
+            + _join_cond("g", f"h_{out_name}")
+        )
 
     # window cumulative
     if dim_cols:
@@ -1466,6 +1815,9 @@ def _build_sparksql_cum_cube_insert_subquery(
             f"sum({out_name}_bucket) over(partition by {part_by} order by date_minute rows between unbounded preceding and current row) as {out_name}"
         )
     for out_name in [output_names.get(k, k) for k in distinct_keys]:
+        if out_name in distinct_approx_sqls:
+            final_select_cols.append(_approx_distinct_cum_sql(out_name, part_by))
+            continue
         final_select_cols.append(
             f"sum({out_name}_new) over(partition by {part_by} order by date_minute rows between unbounded preceding and current row) as {out_name}"
         )
@@ -1512,44 +1864,114 @@ def strip_sql_line_comments(sql_text: str) -> str:
     return "\n".join(lines)
 
 
-def _read_datawork_query_to_local_file(path: Path, fields: List[str]) -> pd.DataFrame:
+def _detect_field_sep(first_line: bytes):
+    """按首行探测 query_to_local 文件的分隔符（\x01 / NUL / tab / 逗号），探测不到返回 None。"""
+    for c in (b"\x01", b"\x00", b"\t", b","):
+        if c in first_line:
+            return c
+    return None
+
+
+class _QueryToLocalStream(io.RawIOBase):
     """
-    datawork-client query_to_local 输出分隔符在不同环境下可能是 \\0001 被解析成 NUL(\\x00)。
-    为避免 pandas CSV 解析对 NUL 不兼容，这里用二进制方式读取并自动探测分隔符。
+    query_to_local 落地文件的只读流：先输出一行合成表头（c0..cN，保证 C 解析器按 N 列对齐），
+    再原样输出文件内容；分隔符为 NUL 时就地转换为 \\x01（C 解析器不接受 NUL 作分隔符）。
     """
-    b = Path(path).read_bytes()
-    if not b:
-        return pd.DataFrame(columns=fields)
-    lines = b.splitlines()
-    if not lines:
-        return pd.DataFrame(columns=fields)
 
-    first = lines[0]
-    candidates = [b"\x01", b"\x00", b"\t", b","]
-    sep = None
-    for c in candidates:
-        if c in first:
-            sep = c
-            break
-    if sep is None:
-        # 单列或未知分隔符：当作整行
-        rows = [[ln.decode("utf-8", errors="replace")] for ln in lines]
-        cols = fields[:1] if fields else ["col0"]
-        return pd.DataFrame(rows, columns=cols)
-
-    rows = []
-    for ln in lines:
-        parts = ln.split(sep)
-        # 兼容末尾额外分隔符导致的空列
-        if parts and parts[-1] == b"":
-            parts = parts[:-1]
-        row = [p.decode("utf-8", errors="replace") for p in parts]
-        if len(row) < len(fields):
-            row = row + [""] * (len(fields) - len(row))
-        elif len(row) > len(fields):
-            row = row[: len(fields)]
-        rows.append(row)
-    return pd.DataFrame(rows, columns=fields)
+    def __init__(self, fh, header: bytes, nul_to_sep: bool):
+        self._fh = fh
+        self._head = header
+        self._nul_to_sep = nul_to_sep
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self._head:
+            data, self._head = self._head[: len(b)], self._head[len(b) :]
+        else:
+            data = self._fh.read(len(b))
+            if self._nul_to_sep:
+                data = data.replace(b"\x00", b"\x01")
+        b[: len(data)] = data
+        return len(data)
+
+
+def _iter_query_to_local_chunks(
+    path: Path,
+    fields: List[str],
+    *,
+    chunk_rows: int = 1_000_000,
+    usecols: List[str] = None,
+    dtypes: dict = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    流式读取 query_to_local 落地文件，每次产出不超过 chunk_rows 行的 DataFrame（列为 usecols，默认全部 fields）。
+
+    分隔符按首行自动探测（见 _detect_field_sep），解析走 pandas C 引擎（QUOTE_NONE、非法 UTF-8 替换），
+    内存只与单个分块相关。不规则行与旧口径一致：缺列补空串、多余列丢弃（含末尾多出的空列）。
+    dtypes 为列名 -> dtype，未声明的列保持字符串；NULL 文本（\\N 等）不做转换，由调用方按列口径处理。
+    """
+    usecols = list(usecols) if usecols else list(fields)
+    with open(path, "rb") as fh:
+        first = fh.readline()
+        if not first:
+            return
+        sep = _detect_field_sep(first.rstrip(b"\r\n"))
+        fh.seek(0)
+
+        if sep is None:
+            # 单列或未知分隔符：当作整行
+            col = fields[0] if fields else "col0"
+            rows: List[str] = []
+            for ln in fh:
+                rows.append(ln.rstrip(b"\r\n").decode("utf-8", errors="replace"))
+                if len(rows) >= chunk_rows:
+                    yield pd.DataFrame({col: rows})[[c for c in usecols if c == col] or [col]]
+                    rows = []
+            if rows:
+                yield pd.DataFrame({col: rows})[[c for c in usecols if c == col] or [col]]
+            return
+
+        sep_c = b"\x01" if sep == b"\x00" else sep
+        pos = [f"c{i}" for i in range(len(fields))]
+        header = sep_c.join(p.encode("ascii") for p in pos) + b"\n"
+        stream = io.BufferedReader(_QueryToLocalStream(fh, header, sep == b"\x00"), buffer_size=1 << 20)
+        rename = dict(zip(pos, fields))
+        dtype = {p: (dtypes or {}).get(f, str) for p, f in rename.items() if f in usecols}
+        reader = pd.read_csv(
+            stream,
+            sep=sep_c.decode("ascii"),
+            header=0,
+            usecols=[p for p, f in rename.items() if f in usecols],
+            dtype=dtype,
+            quoting=csv.QUOTE_NONE,
+            na_filter=False,
+            skip_blank_lines=False,
+            engine="c",
+            encoding="utf-8",
+            encoding_errors="replace",
+            chunksize=max(int(chunk_rows), 1),
+        )
+        with reader:
+            for chunk in reader:
+                yield chunk.rename(columns=rename)[usecols]
+
+
+def _read_datawork_query_to_local_file(
+    path: Path, fields: List[str], *, usecols: List[str] = None, dtypes: dict = None
+) -> pd.DataFrame:
+    """
+    datawork-client query_to_local 输出分隔符在不同环境下可能是 \\0001 被解析成 NUL(\\x00)。
+    按块流式解析（见 _iter_query_to_local_chunks）后拼接，NUL 分隔符在读取时转换，不再整文件读入内存逐字段解码。
+    """
+    usecols = list(usecols) if usecols else list(fields)
+    chunks = list(_iter_query_to_local_chunks(path, fields, usecols=usecols, dtypes=dtypes))
+    if not chunks:
+        return pd.DataFrame(columns=usecols)
+    if len(chunks) == 1:
+        return chunks[0].reset_index(drop=True)
+    return pd.concat(chunks, ignore_index=True)
 
 
 def _split_sql_line_comment(raw_line: str):
@@ -1761,6 +2183,237 @@ def extract_from_table(sql_text: str):
     return m.group(1)
 
 
+def extract_grouping_sets(sql_text: str):
+    """
+    从 SQL 注释中提取 GROUPING SETS 声明（单独一行）：
+        -- grouping_sets: (os_type, func_name), (os_type), ()
+        -- grouping_sets: rollup(os_type, func_name)
+    未声明返回 None。
+    """
+    m = re.search(r"^\s*--\s*grouping_sets\s*[:：]\s*(.+?)\s*$", sql_text or "", flags=re.I | re.M)
+    return m.group(1) if m else None
+
+
+def extract_functional_dependencies(sql_text: str) -> List[tuple]:
+    """
+    从 SQL 注释中提取声明的维度函数依赖（可多行、逗号分隔）：
+        -- fd: country_name -> country_type, app_name_cn -> os_type
+    返回 [(a, b)]，表示 a 的取值决定 b 的取值。
+    """
+    out = []
+    for m in re.finditer(r"^\s*--\s*fd\s*[:：]\s*(.+?)\s*$", sql_text or "", flags=re.I | re.M):
+        for item in m.group(1).split(","):
+            parts = [x.strip() for x in item.split("->")]
+            if len(parts) != 2 or not all(parts):
+                raise ValueError(f"无法解析函数依赖声明: {item.strip()}（应为 a -> b）")
+            if tuple(parts) not in out:
+                out.append(tuple(parts))
+    return out
+
+
+def parse_grouping_sets(spec: str) -> List[List[str]]:
+    """
+    解析 GROUPING SETS 描述，返回维度集合列表（按声明顺序去重）：
+    - `(a, b), (a), ()`：逐个列出保留的维度，`()` 表示全部折叠为“整体”
+    - `rollup(a, b, c)`：展开为 (a,b,c), (a,b), (a), ()
+    两种写法可以用逗号混用。
+    """
+    text = (spec or "").strip()
+    sets = []
+    pos = 0
+    for m in re.finditer(r"(rollup)?\s*\(([^()]*)\)", text, flags=re.I):
+        if text[pos : m.start()].strip(" ,\t\n"):
+            raise ValueError(f"无法解析 grouping sets: {spec}")
+        pos = m.end()
+        cols = [c.strip() for c in m.group(2).split(",") if c.strip()]
+        if m.group(1):
+            sets.extend([cols[:i] for i in range(len(cols), -1, -1)])
+        else:
+            sets.append(cols)
+    if text[pos:].strip(" ,\t\n") or not sets:
+        raise ValueError(f"无法解析 grouping sets: {spec}")
+    out = []
+    for cols in sets:
+        if cols not in out:
+            out.append(cols)
+    return out
+
+
+def _check_grouping_sets(grouping_sets: List[List[str]], dim_cols: List[str]):
+    """grouping sets 只能引用维度字段；拼错的字段名直接报错，不在生成 SQL / mask 时被悄悄丢掉。"""
+    for cols in grouping_sets:
+        unknown = [c for c in cols if c not in dim_cols]
+        if unknown:
+            raise ValueError(f"grouping sets 中的字段不是维度字段: {unknown}（维度: {dim_cols}）")
+
+
+def _grouping_sets_to_masks(grouping_sets: List[List[str]], dim_cols: List[str]) -> List[int]:
+    """维度集合 -> cube mask（第 j 位为 1 表示 dim_cols[j] 折叠为“整体”）。"""
+    _check_grouping_sets(grouping_sets, dim_cols)
+    masks = []
+    for cols in grouping_sets:
+        mask = 0
+        for j, c in enumerate(dim_cols):
+            if c not in cols:
+                mask |= 1 << j
+        if mask not in masks:
+            masks.append(mask)
+    return masks
+
+
+def _approx_distinct_sql(
+    key: str,
+    out_name: str,
+    *,
+    base_sql: str,
+    dim_cols: List[str],
+    no_cube: bool,
+    grouping_sets: List[List[str]] = None,
+    hll_precision: int = 12,
+) -> str:
+    """
+    --distinct-mode hll 的 SparkSQL：按 (维度, 桶) 用 hll_sketch_agg 建草图（列名 <out_name>_sketch），
+    CUBE/GROUPING SETS 与 sum 桶一致；时间累计由调用方在窗口里 hll_union_agg 合并、hll_sketch_estimate 取值
+    （见 _approx_distinct_cum_sql），明细只扫一遍，不与 spine 做 <= 关联。
+    base_sql 为 FROM 项（表名、CTE 名或带别名的子查询）；lgConfigK 取 hll_precision，与本地 HLL 精度一致。
+    """
+    if dim_cols and not no_cube:
+        dim_select = ", ".join([f"coalesce({c},'整体') as {c}" for c in dim_cols])
+        group_by = _sql_cube_group_by(["date_minute"], dim_cols, grouping_sets)
+    elif dim_cols:
+        dim_select = ", ".join(dim_cols)
+        group_by = "group by date_minute, " + ", ".join(dim_cols)
+    else:
+        dim_select = ""
+        group_by = "group by date_minute"
+    return (
+        "select date_minute"
+        + (", " + dim_select if dim_select else "")
+        + f", hll_sketch_agg({key}, {int(hll_precision)}) as {out_name}_sketch\n"
+        + f"from {base_sql}\n"
+        + f"where {key} is not null\n"
+        + group_by
+    )
+
+
+def _approx_distinct_cum_sql(out_name: str, part_by: str) -> str:
+    """hll 草图的时间累计：窗口内合并截至当前桶的全部草图（空桶为 null，不参与合并）再估计。"""
+    return (
+        f"coalesce(hll_sketch_estimate(hll_union_agg({out_name}_sketch) over(partition by {part_by} "
+        f"order by date_minute rows between unbounded preceding and current row)),0) as {out_name}"
+    )
+
+
+def _sql_cube_group_by(lead_cols: List[str], dim_cols: List[str], grouping_sets: List[List[str]] = None) -> str:
+    """
+    CUBE 的 group by 子句：
+    - grouping_sets 为空：`group by <lead>, <dims> with cube`（与历史行为一致）
+    - 否则：`group by <lead>, <dims> grouping sets ((<lead>, s1...), ...)`，lead 列出现在每个集合里，不参与折叠
+    """
+    cols = lead_cols + dim_cols
+    if grouping_sets is None:
+        return "group by " + ", ".join(cols) + " with cube"
+    sets = []
+    for gs in grouping_sets:
+        keep = lead_cols + [c for c in dim_cols if c in gs]
+        sets.append("(" + ", ".join(keep) + ")")
+    return "group by " + ", ".join(cols) + " grouping sets (" + ", ".join(sets) + ")"
+
+
+def _build_duckdb_cum_cube_sql(
+    *,
+    dim_cols: List[str],
+    distinct_fields: List[str],
+    sum_fields: List[str],
+    output_names: dict,
+    start_bucket: int,
+    end_bucket: int,
+    no_cube: bool,
+    grouping_sets: List[List[str]] = None,
+    table: str = "detail",
+) -> str:
+    """
+    --dw-compute-mode duckdb 的查询：与 _build_sparksql_cum_cube_insert 同一套计划（每桶 sum、首次出现、
+    维度 x spine 网格、窗口累计），按 DuckDB 方言改写，输入为已预处理的明细表 table
+    （维度已规范化、无效 distinct 键已置 NULL、时间为桶下标 time_bucket）。
+
+    与 SparkSQL 计划的区别：
+    - distinct 的 CUBE 在 (维度, key) 首次出现上做（group by key, cube(维度)），折叠维度时 key 不会重复计数
+    - 早于 start 的明细并入第一个输出桶（与本地各引擎一致）
+    - grouping(...) 作为组合标识参与分区，维度原值恰为“整体”时与折叠行分开累计，最后按 max 合并（同本地 CUBE）
+    """
+    cube = bool(dim_cols) and not no_cube
+
+    def group_by(lead: List[str]) -> str:
+        if not dim_cols:
+            return "group by " + ", ".join(lead)
+        if not cube:
+            return "group by " + ", ".join(lead + dim_cols)
+        if grouping_sets is None:
+            return "group by " + ", ".join(lead) + ", cube(" + ", ".join(dim_cols) + ")"
+        sets = ["(" + ", ".join(c for c in dim_cols if c in gs) + ")" for gs in grouping_sets]
+        return "group by " + ", ".join(lead) + ", grouping sets (" + ", ".join(sets) + ")"
+
+    if cube:
+        # GROUPING SETS 中从未出现的维度不是分组列，直接输出“整体”
+        used = [c for c in dim_cols if grouping_sets is None or any(c in gs for gs in grouping_sets)]
+        dim_select = [f"coalesce({c}, '整体') as {c}" if c in used else f"'整体' as {c}" for c in dim_cols]
+        dim_select.append(("grouping(" + ", ".join(used) + ")" if used else "0") + " as __g")
+    else:
+        dim_select = list(dim_cols) + ["0 as __g"]
+    keys = dim_cols + ["__g"]
+    sum_outs = [output_names.get(f, f) for f in sum_fields]
+    dist_outs = [output_names.get(f, f) for f in distinct_fields]
+
+    ctes = [
+        f"base as (\n  select * replace (greatest(time_bucket, {int(start_bucket)}) as time_bucket)\n"
+        f"  from {table}\n  where time_bucket <= {int(end_bucket)}\n)",
+        f"spine as (\n  select cast(range as integer) as time_bucket from range({int(start_bucket)}, {int(end_bucket) + 1})\n)",
+    ]
+    sum_cols = [f"sum({f}) as {o}" for f, o in zip(sum_fields, sum_outs)] or ["0 as __dummy"]
+    ctes.append(
+        "sum_bucket as (\n  select time_bucket, "
+        + ", ".join(dim_select + sum_cols)
+        + f"\n  from base\n  {group_by(['time_bucket'])}\n)"
+    )
+    for f, o in zip(distinct_fields, dist_outs):
+        ctes.append(
+            f"{o}_first as (\n  select {f}, "
+            + ", ".join(dim_select)
+            + f", min(time_bucket) as time_bucket\n  from base\n  where {f} is not null\n  {group_by([f])}\n)"
+        )
+        ctes.append(
+            f"{o}_new as (\n  select {', '.join(keys)}, time_bucket, count(*) as {o}\n"
+            f"  from {o}_first\n  group by {', '.join(keys)}, time_bucket\n)"
+        )
+    srcs = ["sum_bucket"] + [f"{o}_new" for o in dist_outs]
+    ctes.append("dims as (\n  " + "\n  union\n  ".join(f"select distinct {', '.join(keys)} from {t}" for t in srcs) + "\n)")
+    ctes.append("grid as (\n  select d.*, s.time_bucket from dims d cross join spine s\n)")
+
+    on = " and ".join(f"g.{c} = {{a}}.{c}" for c in keys + ["time_bucket"])
+    joined = "joined as (\n  select g.*"
+    for o in sum_outs:
+        joined += f", coalesce(b.{o}, 0) as {o}"
+    for o in dist_outs:
+        joined += f", coalesce({o}_new.{o}, 0) as {o}"
+    joined += "\n  from grid g\n  left join sum_bucket b on " + on.format(a="b")
+    for o in dist_outs:
+        joined += f"\n  left join {o}_new on " + on.format(a=f"{o}_new")
+    ctes.append(joined + "\n)")
+
+    win = "over (partition by " + ", ".join(keys) + " order by time_bucket rows between unbounded preceding and current row)"
+    cum = ", ".join(f"sum({o}) {win} as {o}" for o in sum_outs + dist_outs)
+    ctes.append(f"cum as (\n  select {', '.join(keys)}, time_bucket{', ' + cum if cum else ''}\n  from joined\n)")
+
+    out_cols = dim_cols + ["time_bucket"]
+    metrics = ", ".join(f"max({o}) as {o}" for o in sum_outs + dist_outs)
+    return (
+        "with\n"
+        + ",\n".join(ctes)
+        + f"\nselect {', '.join(out_cols)}{', ' + metrics if metrics else ''}\nfrom cum\ngroup by {', '.join(out_cols)}"
+    )
+
+
 def floor_10m(x: int) -> int:
     """
     将时间戳向下取整到10分钟
@@ -1773,6 +2426,48 @@ def floor_10m(x: int) -> int:
     return xi - (xi % 10)
 
 
+_BUCKETS_PER_DAY = 144
+
+
+def _minute_to_bucket(ts, date_p: int) -> np.ndarray:
+    """
+    YYYYMMDDHHmm -> 相对 date_p 当天 00:00 的10分钟桶下标（int16，当天为 0..143）。
+
+    相比 12 位 int64 的 time_minute_10，桶下标作为分组/排序键更窄，桶运算也只是整数加减。
+    跨天的时间按天数偏移（例如次日 00:00 为 144）；无法解析的日期、以及相差太远超出 int16 范围
+    （约 ±227 天）的日期返回 -32768，调用方应丢弃，不能让 astype 回绕成看似合法的桶。
+    """
+    arr = np.asarray(ts, dtype=np.int64)
+    if arr.size == 0:
+        return np.zeros(0, dtype=np.int16)
+    days, inv = np.unique(arr // 10000, return_inverse=True)
+    day0 = pd.Timestamp(str(int(date_p)))
+    day_dt = pd.to_datetime(pd.Series(days.astype(str)), format="%Y%m%d", errors="coerce")
+    day_off = (day_dt - day0).dt.days.to_numpy(dtype=np.float64)
+    minute_of_day = ((arr // 100) % 100) * 60 + (arr % 100)
+    idx = day_off[inv] * _BUCKETS_PER_DAY + (minute_of_day // 10)
+    lim = np.iinfo(np.int16)
+    idx = np.where(np.isnan(idx) | (idx < -lim.max) | (idx > lim.max), lim.min, idx)
+    return idx.astype(np.int16)
+
+
+def _bucket_to_minute(idx, date_p: int) -> np.ndarray:
+    """_minute_to_bucket 的逆变换：桶下标 -> YYYYMMDDHHmm（int64），仅在输出时调用。"""
+    arr = np.asarray(idx, dtype=np.int64)
+    if arr.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    uniq, inv = np.unique(arr, return_inverse=True)
+    t = pd.Timestamp(str(int(date_p))) + pd.to_timedelta(uniq * 10, unit="min")
+    vals = (
+        t.year.to_numpy(dtype=np.int64) * 10**8
+        + t.month.to_numpy(dtype=np.int64) * 10**6
+        + t.day.to_numpy(dtype=np.int64) * 10**4
+        + t.hour.to_numpy(dtype=np.int64) * 100
+        + t.minute.to_numpy(dtype=np.int64)
+    )
+    return vals[inv]
+
+
 def _split_schema_table(dw_table: str):
     parts = dw_table.split(".")
     if len(parts) == 1:
@@ -1801,12 +2496,13 @@ def _resolve_dw_kind(args) -> str:
     return "datawork-client"
 
 
-def _write_to_warehouse_sqlalchemy(df_out: pd.DataFrame, args):
+def _write_to_warehouse_sqlalchemy(df_out: pd.DataFrame, args, *, table: str, rewrite_from_minute: int = None):
     dw_url = args.dw_url or os.environ.get("DW_URL")
     if not dw_url:
         raise ValueError("sqlalchemy写入需要--dw-url或环境变量DW_URL")
 
-    schema, table = _split_schema_table(args.dw_table)
+    target = table
+    schema, table = _split_schema_table(target)
     if schema:
         _validate_identifier(schema)
     _validate_identifier(table)
@@ -1820,12 +2516,21 @@ def _write_to_warehouse_sqlalchemy(df_out: pd.DataFrame, args):
     has_table = inspect(engine).has_table(table, schema=schema)
 
     with engine.begin() as conn:
+        rewrite_from = rewrite_from_minute
         if args.dw_mode == "overwrite" and has_table:
             prep = engine.dialect.identifier_preparer
             full_table = prep.quote(table)
             if schema:
                 full_table = f"{prep.quote(schema)}.{full_table}"
-            conn.execute(text(f"DELETE FROM {full_table} WHERE date_p = :date_p"), {"date_p": args.date_p})
+            if rewrite_from is not None and "date_minute" in df_out.columns:
+                # --late-arrival-check：只删除并重写受影响的时间点
+                conn.execute(
+                    text(f"DELETE FROM {full_table} WHERE date_p = :date_p AND date_minute >= :date_minute"),
+                    {"date_p": args.date_p, "date_minute": int(rewrite_from)},
+                )
+                df_out = df_out[pd.to_numeric(df_out["date_minute"]) >= int(rewrite_from)]
+            else:
+                conn.execute(text(f"DELETE FROM {full_table} WHERE date_p = :date_p"), {"date_p": args.date_p})
 
         df_out.to_sql(
             name=table,
@@ -1837,7 +2542,7 @@ def _write_to_warehouse_sqlalchemy(df_out: pd.DataFrame, args):
             method="multi",
         )
 
-    print(f"已写入数仓表(sqlalchemy): {args.dw_table} (date_p={args.date_p}, mode={args.dw_mode})")
+    print(f"已写入数仓表(sqlalchemy): {target} (date_p={args.date_p}, mode={args.dw_mode})")
 
 
 def build_datawork_insert_sql(
@@ -1893,7 +2598,11 @@ def _run_datawork_query_capture(args, hql: str, sql_engine: str = "Hive") -> str
     return (res.stdout or "") + "\n" + (res.stderr or "")
 
 
-def _run_datawork_query_to_local(args, hql: str, out_path: Path):
+def _run_datawork_query_to_local(args, hql: str, out_path: Path, *, retries: int = 0, sleep_sec: float = 5.0):
+    """
+    datawork-client query_to_local 拉取到 out_path：主引擎（--dw-query-engine）失败时回退到 --dw-query-fallback-engine；
+    两者都失败则按 retries 重试整个过程（间隔 sleep_sec 递增）。
+    """
     import subprocess
 
     def maybe_prefix_presto_settings(engine: str, sql: str) -> str:
@@ -1930,13 +2639,21 @@ def _run_datawork_query_to_local(args, hql: str, out_path: Path):
         ]
         subprocess.check_call(cmd)
 
-    try:
-        run(args.dw_query_engine)
-    except subprocess.CalledProcessError:
-        # Presto 在部分环境会触发 3min 查询超时；按用户要求优先回退到 SparkSql
-        run(args.dw_query_fallback_engine)
-        return
-        raise
+    for i in range(max(0, int(retries)) + 1):
+        try:
+            run(args.dw_query_engine)
+            return
+        except subprocess.CalledProcessError:
+            pass
+        try:
+            # Presto 在部分环境会触发 3min 查询超时；按用户要求优先回退到 SparkSql
+            run(args.dw_query_fallback_engine)
+            return
+        except subprocess.CalledProcessError:
+            if i >= int(retries):
+                raise
+            print(f"[warn] query_to_local 失败，{sleep_sec * (i + 1):.0f}s 后重试（{i + 1}/{int(retries)}）: {out_path}", file=sys.stderr)
+            time.sleep(sleep_sec * (i + 1))
 
 
 def _run_datawork_execute_sql_file(args, sql_text: str, engine: str = None) -> Path:
@@ -2066,10 +2783,10 @@ def _parse_table_location_from_log(log_text: str):
     return None
 
 
-def _get_table_schema_info_and_location_with_retry(args, *, retries: int = 3, sleep_sec: float = 2.0):
+def _get_table_schema_info_and_location_with_retry(args, *, table: str = None, retries: int = 3, sleep_sec: float = 2.0):
     ddl_log_last = None
     for i in range(max(1, int(retries))):
-        ddl_log = _run_datawork_query_capture(args, f"show create table {args.dw_table}", sql_engine="Hive")
+        ddl_log = _run_datawork_query_capture(args, f"show create table {table or args.dw_table}", sql_engine="Hive")
         ddl_log_last = ddl_log
         schema_info = _parse_create_table_schema_from_log(ddl_log)
         location = _parse_table_location_from_log(ddl_log)
@@ -2097,55 +2814,15 @@ def _sql_literal(v):
     return f"'{s}'"
 
 
-def _write_to_warehouse_spark(df_out: pd.DataFrame, args):
+def _build_local_spark_session(args):
     """
-    使用 pyspark + enableHiveSupport 写入目标表的 date_p 分区。
-    优点：不依赖 OneSQL 校验器对常量SQL/UNION/VALUES 的限制，适合写入 ORC 表与大结果集。
-    """
-    if "date_p" not in df_out.columns:
-        raise ValueError("写入数仓需要输出包含date_p列")
-
-    """
-    Spark 写入策略（不依赖直连 Hive Metastore）：
-    1) 通过 datawork-client query(show create table) 解析表 LOCATION 与列类型
-    2) pyspark 在本机 local 模式把 ORC 直接写到 LOCATION/date_p=... 目录
-    3) 通过 datawork-client add_partition 注册分区（存在则忽略）
+    本机 SparkSession（默认 local[*]）：ORC 直写（_write_to_warehouse_spark）与 --dw-compute-mode localspark 共用。
+    注入 Jindo(OSS) jar 与 core-site/hdfs-site，spark.local.dir 落到 --dw-tmp-dir 下。调用方负责 stop()。
     """
     try:
         from pyspark.sql import SparkSession
-        from pyspark.sql import functions as F
-        from pyspark.sql.types import (
-            BooleanType,
-            DecimalType,
-            DoubleType,
-            FloatType,
-            IntegerType,
-            LongType,
-            StringType,
-            StructField,
-            StructType,
-        )
     except Exception as e:  # pragma: no cover
-        raise RuntimeError("当前环境缺少 pyspark，无法使用 spark 写入") from e
-
-    rows = df_out[df_out["date_p"].astype(int) == int(args.date_p)].copy()
-    if len(rows) == 0:
-        print(f"目标分区 date_p={args.date_p} 无数据，跳过写入: {args.dw_table}")
-        return
-
-    # 解析表结构与 LOCATION（走 datawork-client，不依赖本机直连 metastore）
-    schema_info, location = _get_table_schema_info_and_location_with_retry(args, retries=3, sleep_sec=2.0)
-
-    table_cols = schema_info["cols"]
-    col_types = schema_info["col_types"]
-    part_cols = schema_info["part_cols"]
-    if part_cols and "date_p" not in part_cols:
-        raise RuntimeError(f"目标表分区字段未发现date_p，解析到的分区字段: {part_cols}")
-
-    non_part_cols = [c for c in table_cols if c != "date_p"]
-    missing = [c for c in non_part_cols if c not in rows.columns]
-    if missing:
-        raise ValueError(f"输出结果缺少目标表列: {missing}；当前输出列: {rows.columns.tolist()}")
+        raise RuntimeError("当前环境缺少 pyspark，无法创建本机 SparkSession") from e
 
     # Spark 需要能访问 oss://，这里注入 Jindo(OSS) 相关 jar + Hadoop conf（core-site/hdfs-site）
     def pick_existing(paths: List[str]) -> List[str]:
@@ -2201,13 +2878,93 @@ def _write_to_warehouse_spark(df_out: pd.DataFrame, args):
     builder = builder.config("spark.sql.orc.compression.codec", str(orc_compression))
 
     spark = builder.getOrCreate()
+    # 注入 Hadoop conf 以识别 oss:// scheme
+    hconf = spark.sparkContext._jsc.hadoopConfiguration()
+    if core_site and os.path.exists(core_site):
+        hconf.addResource(spark.sparkContext._jvm.org.apache.hadoop.fs.Path(core_site))
+    if hdfs_site and os.path.exists(hdfs_site):
+        hconf.addResource(spark.sparkContext._jvm.org.apache.hadoop.fs.Path(hdfs_site))
+    return spark
+
+
+def _write_to_warehouse_spark(
+    df_out: pd.DataFrame,
+    args,
+    *,
+    table: str = None,
+    rewrite_from_minute: int = None,
+    slice_files: dict = None,
+    spark=None,
+    spark_df=None,
+    schema_info: dict = None,
+    location: str = None,
+) -> dict:
+    """
+    使用 pyspark + enableHiveSupport 写入目标表的 date_p 分区。
+    优点：不依赖 OneSQL 校验器对常量SQL/UNION/VALUES 的限制，适合写入 ORC 表与大结果集。
+
+    spark_df 非空时（--dw-compute-mode localspark）直接写这个 Spark DataFrame（已是目标表列），
+    不经 pandas 与 CSV 中转；此时 spark 为调用方的 session，由调用方关闭。
+    table 默认 --dw-table；rewrite_from_minute/slice_files 为 --late-arrival-check 的部分重写起点与上次的分片文件清单。
+    返回本次的分片文件清单（未分片写入时为空 dict），供下次部分重写使用。
+    """
+    table = table or args.dw_table
+    if spark_df is None and "date_p" not in df_out.columns:
+        raise ValueError("写入数仓需要输出包含date_p列")
+
+    """
+    Spark 写入策略（不依赖直连 Hive Metastore）：
+    1) 通过 datawork-client query(show create table) 解析表 LOCATION 与列类型
+    2) pyspark 在本机 local 模式把 ORC 直接写到 LOCATION/date_p=... 目录
+    3) 通过 datawork-client add_partition 注册分区（存在则忽略）
+    """
+    try:
+        from pyspark.sql import functions as F
+        from pyspark.sql.types import (
+            BooleanType,
+            DecimalType,
+            DoubleType,
+            FloatType,
+            IntegerType,
+            LongType,
+            StringType,
+            StructField,
+            StructType,
+        )
+    except Exception as e:  # pragma: no cover
+        raise RuntimeError("当前环境缺少 pyspark，无法使用 spark 写入") from e
+
+    if spark_df is None:
+        rows = df_out[df_out["date_p"].astype(int) == int(args.date_p)].copy()
+        if len(rows) == 0:
+            print(f"目标分区 date_p={args.date_p} 无数据，跳过写入: {table}")
+            return {}
+    else:
+        rows = spark_df
+
+    # 解析表结构与 LOCATION（走 datawork-client，不依赖本机直连 metastore）
+    if schema_info is None or location is None:
+        schema_info, location = _get_table_schema_info_and_location_with_retry(
+            args, table=table, retries=3, sleep_sec=2.0
+        )
+
+    table_cols = schema_info["cols"]
+    col_types = schema_info["col_types"]
+    part_cols = schema_info["part_cols"]
+    if part_cols and "date_p" not in part_cols:
+        raise RuntimeError(f"目标表分区字段未发现date_p，解析到的分区字段: {part_cols}")
+
+    non_part_cols = [c for c in table_cols if c != "date_p"]
+    missing = [c for c in non_part_cols if c not in rows.columns]
+    if missing:
+        raise ValueError(f"输出结果缺少目标表列: {missing}；当前输出列: {list(rows.columns)}")
+
+    own_session = spark is None
+    if own_session:
+        spark = _build_local_spark_session(args)
+    orc_compression = getattr(args, "dw_orc_compression", "snappy") or "snappy"
     try:
-        # 注入 Hadoop conf 以识别 oss:// scheme
         hconf = spark.sparkContext._jsc.hadoopConfiguration()
-        if core_site and os.path.exists(core_site):
-            hconf.addResource(spark.sparkContext._jvm.org.apache.hadoop.fs.Path(core_site))
-        if hdfs_site and os.path.exists(hdfs_site):
-            hconf.addResource(spark.sparkContext._jvm.org.apache.hadoop.fs.Path(hdfs_site))
 
         # 直接写到 partition 目录（ORC）
         base = location.rstrip("/")
@@ -2273,8 +3030,8 @@ def _write_to_warehouse_spark(df_out: pd.DataFrame, args):
             sdf = spark.read.schema(schema).option("sep", "\x01").csv(stage_uri)
             return sdf, [stage]
 
-        def write_pdf(pdf: pd.DataFrame, *, mode: str):
-            sdf, cleanup_paths = _spark_load_pdf(pdf)
+        def write_pdf(pdf, *, mode: str):
+            sdf, cleanup_paths = (pdf, []) if spark_df is not None else _spark_load_pdf(pdf)
             try:
                 for c in non_part_cols:
                     typ = col_types.get(c, "string")
@@ -2289,7 +3046,28 @@ def _write_to_warehouse_spark(df_out: pd.DataFrame, args):
                     except Exception:
                         pass
 
-        if args.dw_mode == "overwrite" and slice_minutes:
+        # --late-arrival-check：上次按同样的分片写过且记录了各分片的文件时，只替换 rewrite_from 之后的分片
+        start_ts_10 = int(floor_10m(int(args.start_ts)))
+        rewrite_from = rewrite_from_minute
+        manifest = slice_files or {}
+        partial = bool(
+            args.dw_mode == "overwrite"
+            and slice_minutes
+            and rewrite_from is not None
+            and manifest.get("slice_minutes") == slice_minutes
+            and manifest.get("start") == start_ts_10
+        )
+        written = dict(manifest.get("files") or {}) if partial else {}
+        jpath = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(part_path)
+        part_fs = jpath.getFileSystem(hconf)
+
+        def list_part_files() -> set:
+            if not part_fs.exists(jpath):
+                return set()
+            names = {st.getPath().getName() for st in part_fs.listStatus(jpath) if st.isFile()}
+            return {n for n in names if not n.startswith(("_", "."))}
+
+        if args.dw_mode == "overwrite" and slice_minutes and not partial:
             # 先用“空写覆盖”清理旧分区，避免前几个slice无数据导致旧文件残留
             empty_schema = StructType(
                 [StructField(c, hive_type_to_spark(col_types.get(c, "string")), True) for c in non_part_cols]
@@ -2297,12 +3075,26 @@ def _write_to_warehouse_spark(df_out: pd.DataFrame, args):
             empty = spark.createDataFrame([], schema=empty_schema)
             empty.coalesce(1).write.mode("overwrite").format("orc").option("compression", str(orc_compression)).save(part_path)
 
+        def pick(frame, s0: int = None, s1: int = None):
+            """取目标表列；给定 [s0, s1] 时只取该时间分片（pandas 或 Spark DataFrame）。"""
+            if spark_df is not None:
+                if s0 is not None:
+                    dm = F.col("date_minute").cast("bigint")
+                    frame = frame.filter((dm >= s0) & (dm <= s1))
+                return frame.select(*non_part_cols)
+            if s0 is not None:
+                frame = frame[(frame["date_minute"].astype(int) >= s0) & (frame["date_minute"].astype(int) <= s1)]
+            return frame[non_part_cols].copy()
+
+        def is_empty(frame) -> bool:
+            return len(frame.head(1)) == 0
+
         if (not slice_minutes) or ("date_minute" not in rows.columns):
             mode = "append" if args.dw_mode == "append" else "overwrite"
-            write_pdf(rows[non_part_cols].copy(), mode=mode)
+            write_pdf(pick(rows), mode=mode)
+            new_manifest = {}
         else:
-            # 按时间分片写入（对超大结果集更稳）
-            start_ts_10 = int(floor_10m(int(args.start_ts)))
+            # 按时间分片写入（对超大结果集更稳）；记录每个分片写出的文件，供下次只替换受影响的分片
             end_ts_10 = int(floor_10m(int(args.end_ts)))
             cur = datetime.strptime(str(start_ts_10), "%Y%m%d%H%M")
             end_dt = datetime.strptime(str(end_ts_10), "%Y%m%d%H%M")
@@ -2315,23 +3107,38 @@ def _write_to_warehouse_spark(df_out: pd.DataFrame, args):
                 s0 = int(cur.strftime("%Y%m%d%H%M"))
                 s1 = int(slice_end_dt.strftime("%Y%m%d%H%M"))
 
-                chunk = rows[(rows["date_minute"].astype(int) >= s0) & (rows["date_minute"].astype(int) <= s1)]
-                if len(chunk) > 0:
-                    mode = "append" if (args.dw_mode == "append" or (not first)) else "overwrite"
-                    write_pdf(chunk[non_part_cols].copy(), mode=mode)
+                if partial and s1 < rewrite_from:
+                    # 未受影响的分片：保留已有文件
+                    cur = cur + timedelta(minutes=slice_minutes)
+                    continue
+                if partial:
+                    for name in written.pop(s0, []):
+                        part_fs.delete(spark.sparkContext._jvm.org.apache.hadoop.fs.Path(f"{part_path}/{name}"), False)
+                chunk = pick(rows, s0, s1)
+                if not is_empty(chunk):
+                    mode = "append" if (args.dw_mode == "append" or partial or (not first)) else "overwrite"
+                    before = list_part_files()
+                    write_pdf(chunk, mode=mode)
+                    written[s0] = sorted(list_part_files() - before)
                     first = False
                 cur = cur + timedelta(minutes=slice_minutes)
+            new_manifest = {"slice_minutes": slice_minutes, "start": start_ts_10, "files": written}
 
         if prof:
-            prof.end("write_orc", rows=len(rows), extra=f"orc_files={orc_num_files} slice_minutes={slice_minutes}")
+            prof.end(
+                "write_orc",
+                rows=(len(rows) if spark_df is None else None),
+                extra=f"orc_files={orc_num_files} slice_minutes={slice_minutes} partial_from={rewrite_from if partial else None}",
+            )
     finally:
-        try:
-            spark.stop()
-        except Exception:
-            pass
+        if own_session:
+            try:
+                spark.stop()
+            except Exception:
+                pass
 
     # 注册分区（存在则忽略）
-    schema, table = _split_schema_table(args.dw_table)
+    schema, table_name = _split_schema_table(table)
     if not schema:
         raise ValueError("dw-table 必须是 schema.table 形式（便于 add_partition）")
     try:
@@ -2343,7 +3150,7 @@ def _write_to_warehouse_spark(df_out: pd.DataFrame, args):
             "-d",
             schema,
             "-t",
-            table,
+            table_name,
             "-P",
             f"date_p={int(args.date_p)}",
             "-project_name",
@@ -2372,10 +3179,11 @@ def _write_to_warehouse_spark(df_out: pd.DataFrame, args):
         if "分区信息已经存在" not in msg and "errorCode:-4206" not in msg:
             raise
 
-    print(f"已写入数仓表(spark-orc-path): {args.dw_table} (date_p={args.date_p}, mode={args.dw_mode})")
+    print(f"已写入数仓表(spark-orc-path): {table} (date_p={args.date_p}, mode={args.dw_mode})")
+    return new_manifest
 
 
-def _write_to_warehouse_datawork_union(df_out: pd.DataFrame, args, *, schema_info: dict):
+def _write_to_warehouse_datawork_union(df_out: pd.DataFrame, args, *, table: str, schema_info: dict):
     """
     使用 datawork-client execute 写入：常量 SELECT ... FROM anchor + UNION ALL。
     仅适合小结果集（受 UNION 次数上限影响）；但能通过 OneSQL 分区校验。
@@ -2392,14 +3200,14 @@ def _write_to_warehouse_datawork_union(df_out: pd.DataFrame, args, *, schema_inf
     if missing:
         raise ValueError(f"输出结果缺少目标表列: {missing}；当前输出列: {rows.columns.tolist()}")
     if len(rows) == 0:
-        print(f"目标分区 date_p={args.date_p} 无数据，跳过写入: {args.dw_table}")
+        print(f"目标分区 date_p={args.date_p} 无数据，跳过写入: {table}")
         return
 
     anchor_table = getattr(args, "dw_anchor_table", None)
     if not anchor_table:
         raise ValueError("datawork-client 写入需要指定锚点表（--dw-anchor-table）或从输入SQL自动提取FROM表")
 
-    tgt_schema, tgt_table = _split_schema_table(args.dw_table)
+    tgt_schema, tgt_table = _split_schema_table(table)
     q_target = _quote_qualified(tgt_schema, tgt_table)
 
     # 每次 execute 的 UNION 次数上限约100：这里每批最多 99 行（再加一个0行锚点select）
@@ -2449,7 +3257,311 @@ def _write_to_warehouse_datawork_union(df_out: pd.DataFrame, args, *, schema_inf
         start = end
         batch_idx += 1
 
-    print(f"已写入数仓表(datawork-client): {args.dw_table} (date_p={args.date_p}, mode={args.dw_mode})")
+    print(f"已写入数仓表(datawork-client): {table} (date_p={args.date_p}, mode={args.dw_mode})")
+
+
+def _hash_shard_ids(s: pd.Series, n_shards: int) -> np.ndarray:
+    """按取值的 64 位哈希把行分到 n_shards 个分片（同一取值必落在同一分片）。"""
+    h = pd.util.hash_pandas_object(s, index=False).to_numpy()
+    return (h % np.uint64(n_shards)).astype(np.int64)
+
+
+def _run_process_pool(fn, tasks: list, workers: int) -> list:
+    """用进程池并行执行 fn(task)，按 tasks 顺序返回结果；workers<=1 时退化为串行。"""
+    if not workers or workers <= 1 or len(tasks) <= 1:
+        return [fn(t) for t in tasks]
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=min(int(workers), len(tasks))) as ex:
+        return list(ex.map(fn, tasks))
+
+
+def _first_seen_shard_worker(task) -> np.ndarray:
+    """进程池任务：对一个 key 哈希分片标记首次出现行。"""
+    sub, group_cols, key_col, time_col = task
+    return _first_seen_flags(sub, group_cols=group_cols, key_cols=[key_col], time_col=time_col)[key_col]
+
+
+def _first_seen_flags(
+    df: pd.DataFrame, *, group_cols: List[str], key_cols: List[str], time_col: str, workers: int = 1
+) -> dict:
+    """
+    单次按时间稳定排序，为多个 distinct 键同时标记“(group_cols, key) 首次出现”的行。
+
+    返回 {key: bool ndarray}，与 df 行顺序对齐；无效 key（NULL/空值，见 _distinct_key_mask）恒为 False。
+    等价于逐个 key 做 groupby(...)[time].min()，但只排序一次，也不需要把各 key 的结果 merge 回来。
+
+    workers>1 时每个 key 的有效行按 key 哈希分片，在进程池中分别标记后写回：
+    同一 key 只会出现在一个分片里，因此结果与单进程完全一致。
+    """
+    if not key_cols:
+        return {}
+    if workers and workers > 1 and len(df) > 0:
+        tasks = []
+        slots = []
+        for k in key_cols:
+            cols = group_cols + [time_col] + ([k] if k not in group_cols else [])
+            rows = np.flatnonzero(_distinct_key_mask(df[k]).to_numpy())
+            shard = _hash_shard_ids(df[k].iloc[rows], workers)
+            for i in range(workers):
+                r = rows[shard == i]
+                tasks.append((df[cols].iloc[r], group_cols, k, time_col))
+                slots.append((k, r))
+        results = _run_process_pool(_first_seen_shard_worker, tasks, workers)
+        flags = {k: np.zeros(len(df), dtype=bool) for k in key_cols}
+        for (k, r), f in zip(slots, results):
+            flags[k][r] = f
+        return flags
+    order = np.argsort(df[time_col].to_numpy(), kind="stable")
+    d = df[group_cols + [k for k in key_cols if k not in group_cols]].iloc[order]
+    flags = {}
+    for k in key_cols:
+        valid = _distinct_key_mask(d[k]).to_numpy()
+        first_sorted = np.zeros(len(d), dtype=bool)
+        first_sorted[valid] = ~d.loc[valid, group_cols + [k]].duplicated(keep="first").to_numpy()
+        aligned = np.empty(len(d), dtype=bool)
+        aligned[order] = first_sorted
+        flags[k] = aligned
+    return flags
+
+
+def _spine_bucket_index(times: np.ndarray, spine: np.ndarray) -> np.ndarray:
+    """
+    把时间映射为 spine 下标（spine 需升序）：
+    - 早于 spine 起点的并入第 0 桶（累计口径是“从当天开始”，起点之前的增量计入第一个输出桶）
+    - 晚于 spine 终点的返回 -1（调用方应丢弃）
+    """
+    times = np.asarray(times)
+    idx = np.searchsorted(spine, times, side="right") - 1
+    idx = np.maximum(idx, 0)
+    idx[times > spine[-1]] = -1
+    return idx.astype(np.int64)
+
+
+def _fold_pre_start(df: pd.DataFrame, spine_df: pd.DataFrame, time_col: str) -> pd.DataFrame:
+    """
+    把早于 spine 起点的行的时间改成起点（与 _spine_bucket_index 口径一致：起点之前的增量计入第一个输出桶）。
+    时间取 max 是单调变换，(维度, key) 的首次出现桶也随之折叠，不影响之后各桶的新增。
+    """
+    if len(spine_df) == 0 or len(df) == 0:
+        return df
+    start = spine_df[time_col].min()
+    t = df[time_col].to_numpy()
+    if not (t < start).any():
+        return df
+    return df.assign(**{time_col: np.maximum(t, start).astype(t.dtype)})
+
+
+def _dense_cum_kernel(gid: np.ndarray, bidx: np.ndarray, values: np.ndarray, n_groups: int, n_buckets: int) -> np.ndarray:
+    """
+    稠密累计内核：把每行增量按 (组号, 桶下标) scatter-add 到预分配的 [组 x 桶 x 指标] 数组，
+    再沿时间轴做一次 np.cumsum。替代“维度 x 时间”笛卡尔积 merge + sort + groupby.ffill。
+    """
+    n_metrics = values.shape[1] if values.ndim == 2 else 1
+    values = values.reshape(len(gid), n_metrics)
+    size = int(n_groups) * int(n_buckets)
+    flat = gid.astype(np.int64) * int(n_buckets) + bidx.astype(np.int64)
+    arr = np.empty((size, n_metrics), dtype=np.float64)
+    for j in range(n_metrics):
+        arr[:, j] = np.bincount(flat, weights=values[:, j], minlength=size)
+    arr = arr.reshape(int(n_groups), int(n_buckets), n_metrics)
+    np.cumsum(arr, axis=1, out=arr)
+    return arr
+
+
+def _change_only_rows(
+    out: pd.DataFrame, *, dim_cols: List[str], value_cols: List[str], time_col: str, start: int
+) -> pd.DataFrame:
+    """
+    累计结果 -> 只保留“有指标变化”的行（--output-mode changes）。
+
+    输入既可以是完整 维度x时间 网格，也可以是只在有增量的桶上有值的稀疏表（缺失值视为沿用上一桶）：
+    - 早于 start 的行并入 start（累计值取该组 start 之前最后一个）
+    - 每组第一行与 0 比较，其余行与组内上一行比较，任一指标不同即保留
+    - 全天指标都为 0 的组保留 start 一行，保证维度组合不丢失
+    还原见 densify_change_only。
+    """
+    if out is None or len(out) == 0:
+        return out
+    sort_cols = dim_cols + [time_col]
+    out = out.sort_values(sort_cols, kind="mergesort").reset_index(drop=True)
+    for c in value_cols:
+        out[c] = pd.to_numeric(out[c], errors="coerce")
+    if dim_cols:
+        g = out.groupby(dim_cols, dropna=False, sort=False, observed=True)
+        out[value_cols] = g[value_cols].ffill().fillna(0)
+    else:
+        out[value_cols] = out[value_cols].ffill().fillna(0)
+    t = out[time_col].to_numpy()
+    if (t < start).any():
+        out[time_col] = np.maximum(t, start).astype(t.dtype)
+        out = out.drop_duplicates(sort_cols, keep="last").reset_index(drop=True)
+
+    vals = out[value_cols].to_numpy(dtype=np.float64)
+    prev = np.vstack([np.zeros((1, len(value_cols))), vals[:-1]])
+    if dim_cols:
+        gid = out.groupby(dim_cols, dropna=False, sort=False, observed=True).ngroup().to_numpy()
+        first = np.r_[True, gid[1:] != gid[:-1]]
+    else:
+        gid = np.zeros(len(out), dtype=np.int64)
+        first = np.r_[True, np.zeros(len(out) - 1, dtype=bool)]
+    prev[first] = 0
+    keep = (vals != prev).any(axis=1)
+    # 全为 0 的组：保留组内第一行并放到 start
+    has_change = np.zeros(gid.max() + 1, dtype=bool)
+    np.logical_or.at(has_change, gid, keep)
+    placeholder = first & ~has_change[gid]
+    res = out[keep | placeholder].copy()
+    if placeholder.any():
+        res.loc[placeholder[keep | placeholder], time_col] = start
+    return res.reset_index(drop=True)
+
+
+def _coarsen_cum(
+    out: pd.DataFrame, *, dim_cols: List[str], time_col: str, minutes: int, end_bucket: int
+) -> pd.DataFrame:
+    """
+    10 分钟累计结果 -> minutes 粒度的累计结果：粗桶 T（当天按 minutes 对齐，时间点记为窗口起点）
+    的累计值等于窗口内最后一个 10 分钟桶 min(T+k-1, end) 的累计值。
+    dense 输入每个窗口取最后一行即可；changes 输入（见 _change_only_rows）取窗口内最后一次变化，
+    没有变化的窗口沿用上一个窗口，结果仍是粗粒度上的 change-only 表示。
+    """
+    k = int(minutes) // 10
+    if out is None or len(out) == 0 or k <= 1:
+        return out
+    sort_cols = dim_cols + [time_col]
+    res = out.sort_values(sort_cols, kind="mergesort")
+    t = res[time_col].to_numpy()
+    res = res[t <= end_bucket].copy()
+    res[time_col] = ((res[time_col].to_numpy() // k) * k).astype(t.dtype)
+    res = res.drop_duplicates(sort_cols, keep="last")
+    return res.reset_index(drop=True)
+
+
+def _parse_granularities(spec) -> List[int]:
+    """--granularities "10,30,60" -> [10, 30, 60]（去重保序）；为空时只输出 10 分钟。"""
+    if not spec:
+        return [10]
+    out = []
+    for part in str(spec).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        g = int(part)
+        if g <= 0 or g % 10 != 0:
+            raise ValueError(f"--granularities 只支持 10 的正整数倍分钟: {part}")
+        if g not in out:
+            out.append(g)
+    return out or [10]
+
+
+def densify_change_only(
+    df: pd.DataFrame,
+    *,
+    start_ts: int,
+    end_ts: int,
+    metric_cols: List[str],
+    dim_cols: List[str] = None,
+    minutes: int = 10,
+) -> pd.DataFrame:
+    """
+    读取 --output-mode changes 的结果并还原为完整 维度 x date_minute 网格（与默认 dense 输出一致）。
+
+    每个维度组合在 [start_ts, end_ts] 的每个时间点都有一行：沿用该点之前最近一次变化的值，
+    第一次变化之前为 0。dim_cols 默认取除 date_minute/date_p/指标 外的全部列。
+    minutes 为 --granularities 中的粗粒度（如 60），时间点按当天 minutes 对齐。
+    """
+    metric_cols = list(metric_cols)
+    if dim_cols is None:
+        dim_cols = [c for c in df.columns if c not in metric_cols and c not in ("date_minute", "date_p")]
+    date_p = int(start_ts) // 10000
+    lo, hi = _minute_to_bucket([floor_10m(start_ts), floor_10m(end_ts)], date_p)
+    k = max(1, int(minutes) // 10)
+    spine = pd.DataFrame(
+        {"date_minute": _bucket_to_minute(np.arange(int(lo) // k * k, int(hi) // k * k + 1, k), date_p)}
+    )
+    src = df[dim_cols + ["date_minute"] + metric_cols].copy()
+    src["date_minute"] = pd.to_numeric(src["date_minute"], errors="coerce").astype("int64")
+    if dim_cols:
+        grid = src[dim_cols].drop_duplicates().merge(spine, how="cross")
+    else:
+        grid = spine
+    out = grid.merge(src, on=dim_cols + ["date_minute"], how="left")
+    out = out.sort_values(dim_cols + ["date_minute"], kind="mergesort")
+    if dim_cols:
+        out[metric_cols] = out.groupby(dim_cols, dropna=False, sort=False)[metric_cols].ffill().fillna(0)
+    else:
+        out[metric_cols] = out[metric_cols].ffill().fillna(0)
+    if "date_p" in df.columns:
+        out["date_p"] = date_p
+    return out.reset_index(drop=True)
+
+
+def _emit_dense_frame(
+    arr: np.ndarray,
+    dims_tab: pd.DataFrame,
+    dim_cols: List[str],
+    spine: np.ndarray,
+    time_col: str,
+    out_cols: List[str],
+) -> pd.DataFrame:
+    """把 [组 x 桶 x 指标] 数组展开为输出表：维度用 np.repeat、时间用 np.tile，无需 merge。"""
+    n_groups, n_buckets = arr.shape[0], arr.shape[1]
+    if dim_cols:
+        out = dims_tab[dim_cols].iloc[np.repeat(np.arange(n_groups), n_buckets)].reset_index(drop=True)
+    else:
+        out = pd.DataFrame(index=range(n_groups * n_buckets))
+    out[time_col] = np.tile(spine, n_groups)
+    for j, c in enumerate(out_cols):
+        out[c] = arr[:, :, j].reshape(-1)
+    return out
+
+
+def _compute_cum_10m_dense(
+    df: pd.DataFrame,
+    *,
+    dim_cols: List[str],
+    metric_cols: List[str],
+    metric_rules: dict,
+    output_names: dict,
+    spine_df: pd.DataFrame,
+    time_col: str = "time_minute_10",
+    workers: int = 1,
+) -> pd.DataFrame:
+    """_compute_cum_10m_fast 的稠密 NumPy 版本（engine=dense）。"""
+    spine = spine_df[time_col].to_numpy(dtype=np.int64)
+    metric_out_cols = [output_names.get(f, f) for f in metric_cols]
+    if len(spine) == 0 or len(df) == 0:
+        return pd.DataFrame(columns=dim_cols + [time_col] + metric_out_cols)
+
+    bidx = _spine_bucket_index(df[time_col].to_numpy(dtype=np.int64), spine)
+    keep = bidx >= 0
+    if not keep.all():
+        df = df[keep]
+        bidx = bidx[keep]
+    gid, dims_tab = _factorize_dims(df, dim_cols)
+    n_groups = len(dims_tab)
+    n_buckets = len(spine)
+
+    distinct_fields = [f for f in metric_cols if metric_rules.get(f) == "distinct" and f in df.columns]
+    key_frame = pd.DataFrame({"__gid": gid, time_col: df[time_col].to_numpy()})
+    for f in distinct_fields:
+        key_frame[f] = df[f].array
+    first_flags = _first_seen_flags(
+        key_frame, group_cols=["__gid"], key_cols=distinct_fields, time_col=time_col, workers=workers
+    )
+    values = np.zeros((len(df), len(metric_cols)), dtype=np.float64)
+    for j, f in enumerate(metric_cols):
+        if f not in df.columns:
+            continue
+        if metric_rules.get(f) == "sum":
+            values[:, j] = np.nan_to_num(pd.to_numeric(df[f], errors="coerce").to_numpy(dtype=np.float64))
+        elif metric_rules.get(f) == "distinct":
+            # 首次出现：每个(组号,key)只在最早的桶上记 1；同一(组号,桶)上的多个新 key 由 bincount 累加
+            values[:, j] = first_flags[f]
+
+    arr = _dense_cum_kernel(gid, bidx, values, n_groups, n_buckets)
+    return _emit_dense_frame(arr, dims_tab, dim_cols, spine, time_col, metric_out_cols)
 
 
 def _compute_cum_10m_fast(
@@ -2460,60 +3572,101 @@ def _compute_cum_10m_fast(
     metric_rules: dict,
     output_names: dict,
     spine_df: pd.DataFrame,
+    engine: str = "groupby",
+    time_col: str = "time_minute_10",
+    workers: int = 1,
+    output_mode: str = "dense",
 ) -> pd.DataFrame:
     """
     更高效的10分钟累计实现：
-    - sum 指标：先按(维度,time_minute_10)聚合，再按时间做 groupby.cumsum
-    - distinct 指标：先求每个(维度,distinct_key)的首次出现时间，再转为“新增数”并按时间 cumsum
+    - sum 指标：先按(维度,时间桶)聚合，再按时间做 groupby.cumsum
+    - distinct 指标：一次按时间排序标记每个(维度,distinct_key)的首次出现行（见 _first_seen_flags），
+      作为“新增数”与 sum 增量放在同一张对齐的增量表里，一次 groupby + cumsum
+
+    engine：
+    - groupby（默认）：直接在字符串维度列上做 groupby/sort/merge
+    - codes：先把全部维度编码为单个 int64 组号（见 _factorize_dims），聚合/首次出现/cumsum/ffill
+      都在组号上完成，仅在组装输出时解码回字符串；维度多、预聚合行数大时明显减少字符串哈希开销
+    - dense：在组号基础上直接 scatter-add 到 [组 x 桶 x 指标] 数组并一次 cumsum（见 _dense_cum_kernel），
+      不再构造网格 merge/sort/ffill
+    三种引擎都把早于 spine 起点的增量并入第一个输出桶（见 _fold_pre_start / _spine_bucket_index）。
+
+    workers>1 时 distinct 指标的首次出现标记按 key 哈希分片并行计算（见 _first_seen_flags）。
+    output_mode=changes 时（groupby/codes）只返回有增量的 (维度, 桶) 行，跳过 维度x时间 网格，
+    由调用方用 _change_only_rows 整理；dense 引擎仍输出完整网格。
     """
-    if "time_minute_10" not in df.columns:
-        raise ValueError("缺少 time_minute_10")
+    if time_col not in df.columns:
+        raise ValueError(f"缺少时间列 {time_col}")
 
-    # 分离 distinct/sum 指标
-    distinct_fields = [f for f in metric_cols if metric_rules.get(f) == "distinct" and f in df.columns]
-    sum_fields = [f for f in metric_cols if metric_rules.get(f) == "sum" and f in df.columns]
+    if engine == "dense":
+        return _compute_cum_10m_dense(
+            df,
+            dim_cols=dim_cols,
+            metric_cols=metric_cols,
+            metric_rules=metric_rules,
+            output_names=output_names,
+            spine_df=spine_df,
+            time_col=time_col,
+            workers=workers,
+        )
 
-    frames = []
+    if engine == "codes" and dim_cols:
+        gid, dims_tab = _factorize_dims(df, dim_cols)
+        work_cols = [c for c in df.columns if c not in dim_cols]
+        work = df[work_cols].reset_index(drop=True)
+        work.insert(0, "__gid", gid)
+        out = _compute_cum_10m_fast(
+            work,
+            dim_cols=["__gid"],
+            metric_cols=metric_cols,
+            metric_rules=metric_rules,
+            output_names=output_names,
+            spine_df=spine_df,
+            time_col=time_col,
+            workers=workers,
+            output_mode=output_mode,
+        )
+        return _decode_dims(out, dims_tab)
 
-    # sum 指标：按时间桶聚合并累计
-    if sum_fields:
-        gcols = (dim_cols + ["time_minute_10"]) if dim_cols else ["time_minute_10"]
-        sums = df.groupby(gcols, dropna=False, sort=False, observed=True)[sum_fields].sum().reset_index()
-        sums = sums.sort_values(gcols, kind="mergesort")
-        if dim_cols:
-            sums[sum_fields] = sums.groupby(dim_cols, dropna=False, sort=False, observed=True)[sum_fields].cumsum()
-        else:
-            sums[sum_fields] = sums[sum_fields].cumsum()
+    # 早于 spine 起点的增量并入第一个输出桶（与 engine=dense 一致），否则起点要等到下一次有变化的桶才计入
+    df = _fold_pre_start(df, spine_df, time_col)
 
-        rename_map = {c: output_names.get(c, c) for c in sum_fields}
-        sums = sums.rename(columns=rename_map)
-        frames.append(sums)
+    # 分离 distinct/sum 指标
+    distinct_fields = [f for f in metric_cols if metric_rules.get(f) == "distinct" and f in df.columns]
+    sum_fields = [f for f in metric_cols if metric_rules.get(f) == "sum" and f in df.columns]
 
-    # distinct 指标：首次出现时间 -> 新增 -> 累计
-    for f in distinct_fields:
-        out_name = output_names.get(f, f)
-        # 过滤掉 NULL/空值，避免把 NULL 当成一个 distinct 值（与 Hive count(distinct) 对齐）
-        dff = df[_distinct_key_mask(df[f])] if f in df.columns else df
-        gcols = (dim_cols + [f]) if dim_cols else [f]
-        first = dff.groupby(gcols, dropna=False, sort=False, observed=True)["time_minute_10"].min().reset_index()
-        # 每个时间桶“新增”的去重数
-        ngcols = (dim_cols + ["time_minute_10"]) if dim_cols else ["time_minute_10"]
-        new_cnt = first.groupby(ngcols, dropna=False, sort=False, observed=True).size().reset_index(name=out_name)
-        new_cnt = new_cnt.sort_values(ngcols, kind="mergesort")
+    # 对齐的增量表：每行 = 维度 + 时间 + 各指标增量（sum 取原值；distinct 取“是否首次出现”0/1），
+    # 所有 distinct 键共用一次按时间的排序，然后一次 groupby + cumsum，不再逐个指标 outer merge
+    gcols = dim_cols + [time_col]
+    if sum_fields or distinct_fields:
+        first_flags = _first_seen_flags(
+            df, group_cols=dim_cols, key_cols=distinct_fields, time_col=time_col, workers=workers
+        )
+        inc = df[gcols].reset_index(drop=True)
+        inc_cols = []
+        for f in sum_fields:
+            out_name = output_names.get(f, f)
+            inc[out_name] = df[f].to_numpy()
+            inc_cols.append(out_name)
+        for f in distinct_fields:
+            out_name = output_names.get(f, f)
+            inc[out_name] = first_flags[f].astype(np.int64)
+            inc_cols.append(out_name)
+        metrics = inc.groupby(gcols, dropna=False, sort=False, observed=True)[inc_cols].sum().reset_index()
+        metrics = metrics.sort_values(gcols, kind="mergesort")
         if dim_cols:
-            new_cnt[out_name] = new_cnt.groupby(dim_cols, dropna=False, sort=False, observed=True)[out_name].cumsum()
+            metrics[inc_cols] = metrics.groupby(dim_cols, dropna=False, sort=False, observed=True)[inc_cols].cumsum()
         else:
-            new_cnt[out_name] = new_cnt[out_name].cumsum()
-        frames.append(new_cnt)
-
-    if frames:
-        # 合并所有指标
-        gcols = (dim_cols + ["time_minute_10"]) if dim_cols else ["time_minute_10"]
-        metrics = frames[0]
-        for f in frames[1:]:
-            metrics = metrics.merge(f, on=gcols, how="outer")
+            metrics[inc_cols] = metrics[inc_cols].cumsum()
     else:
-        metrics = pd.DataFrame(columns=(dim_cols + ["time_minute_10"]))
+        metrics = pd.DataFrame(columns=gcols)
+
+    if output_mode == "changes" and dim_cols:
+        for f in metric_cols:
+            out_name = output_names.get(f, f)
+            if out_name not in metrics.columns:
+                metrics[out_name] = 0
+        return metrics[gcols + [output_names.get(f, f) for f in metric_cols]]
 
     # 构造完整的 time×维度 网格，缺失填0
     spine_df = spine_df.copy()
@@ -2522,9 +3675,9 @@ def _compute_cum_10m_fast(
         dims = df[dim_cols].drop_duplicates().copy()
         dims["__key"] = 1
         grid = dims.merge(spine_df, on="__key", how="inner").drop(columns=["__key"])
-        out = grid.merge(metrics, on=dim_cols + ["time_minute_10"], how="left")
+        out = grid.merge(metrics, on=dim_cols + [time_col], how="left")
     else:
-        out = spine_df.drop(columns=["__key"]).merge(metrics, on=["time_minute_10"], how="left")
+        out = spine_df.drop(columns=["__key"]).merge(metrics, on=[time_col], how="left")
 
     # 缺失指标填0
     metric_out_cols = []
@@ -2537,7 +3690,7 @@ def _compute_cum_10m_fast(
 
     # 累计结果需要在“无新增/无消耗”的时间桶上保持上一个时间点的累计值：
     # 先按时间排序，再按维度组内 forward-fill，最后把起始的 NaN 填 0
-    sort_cols = (dim_cols + ["time_minute_10"]) if dim_cols else ["time_minute_10"]
+    sort_cols = (dim_cols + [time_col]) if dim_cols else [time_col]
     out = out.sort_values(sort_cols, kind="mergesort")
     if dim_cols:
         out[metric_out_cols] = (
@@ -2547,23 +3700,195 @@ def _compute_cum_10m_fast(
         out[metric_out_cols] = out[metric_out_cols].ffill().fillna(0)
 
     # 列顺序：维度 + time + 指标
-    ordered = dim_cols + ["time_minute_10"] + metric_out_cols
+    ordered = dim_cols + [time_col] + metric_out_cols
     ordered = [c for c in ordered if c in out.columns]
     out = out[ordered]
     return out
 
 
+def _cube_schedule(n: int, masks: List[int] = None) -> List[List[int]]:
+    """
+    待计算的 mask（不含 mask=0 的叶子层）按 popcount 分层；masks 为空表示完整 CUBE（全部 2^n 个）。
+    同层 mask 互不包含、互不依赖；每个 mask 只从更低层中被它包含的 mask 派生。
+    """
+    todo = range(1, 1 << n) if masks is None else sorted(set(masks) - {0})
+    layers = {}
+    for m in todo:
+        layers.setdefault(bin(m).count("1"), []).append(m)
+    return [layers[k] for k in sorted(layers)]
+
+
+def _cube_smallest_parent(mask: int, sizes: dict) -> int:
+    """
+    在已物化的祖先（被 mask 包含、折叠维度更少的 mask）中选行数最少的一个；
+    行数相同时优先折叠维度多的，再优先去掉最低位的那个（与 mask ^ lsb 一致）。
+    维度基数差异大时（例如先折叠 func_name 这类高基数维度），比固定取 mask ^ lsb 少扫很多行。
+    """
+    best = None
+    best_key = None
+    for p, rows in sizes.items():
+        if p == mask or (p & ~mask):
+            continue
+        key = (rows, -bin(p).count("1"), -p)
+        if best_key is None or key < best_key:
+            best, best_key = p, key
+    return best
+
+
+def _cube_fd_sources(schedule: List[List[int]], fd_bits: List[tuple]) -> dict:
+    """
+    函数依赖 a -> b（b 的取值由 a 决定）：mask 保留 a、折叠 b 时，其分组与“再保留 b”的 mask 一一对应，
+    因此直接复制那个 mask 的表、把 b 改成“整体”即可，不必再做一次 groupby。
+    fd_bits 为 (a 的位, b 的位) 列表；返回 {mask: 来源 mask}（来源须在 schedule 中更早算出或为叶子层 0）。
+    """
+    avail = {0}
+    src = {}
+    for layer in schedule:
+        for m in layer:
+            for a, b in fd_bits:
+                if not (m >> a) & 1 and (m >> b) & 1 and (m & ~(1 << b)) in avail:
+                    src[m] = m & ~(1 << b)
+                    break
+        avail.update(layer)
+    return src
+
+
+def _cube_releasable(sizes: dict, remaining: List[int], pinned=()) -> List[int]:
+    """
+    已物化的 mask 中，之后不会再被选作 parent 的那些：剩余每个包含它的 mask，都另有一个更近的已物化祖先
+    （同时包含它、又被该 mask 包含）。行数沿包含关系单调不增，更近的祖先一定不比它差。
+    完整 CUBE 下即“第 L 层算完释放第 L-1 层”。pinned 中的 mask（后续还要被函数依赖复用）不释放。
+    """
+    out = []
+    for p in sizes:
+        if p in pinned:
+            continue
+        closer = [q for q in sizes if q != p and not (p & ~q)]
+        needed = any(not (p & ~m) and not any(not (q & ~m) for q in closer) for m in remaining)
+        if not needed:
+            out.append(p)
+    return out
+
+
+def _walk_cube_lattice(
+    n: int, root, derive, emit, masks: List[int] = None, relabel=None, fd_bits: List[tuple] = None
+) -> None:
+    """
+    按层（popcount）遍历 cube 格：mask 从行数最少的已物化祖先（见 _cube_smallest_parent）
+    用 derive(parent_frame, mask) 得到，算完立即交给 emit(mask, frame)。
+    每层算完后释放不再需要的祖先（见 _cube_releasable），完整 CUBE 时常驻内存约为相邻两层，
+    而不是把 2^n 个中间表全部留到最后。
+
+    masks 非空时只计算这些 mask（GROUPING SETS），叶子层 mask=0 仅在 masks 包含 0 时输出。
+    fd_bits 非空时，可由函数依赖得到的 mask 改用 relabel(source_frame, mask) 复制改名（见 _cube_fd_sources）。
+    """
+    frames = {0: root}
+    if masks is None or 0 in masks:
+        emit(0, root)
+    schedule = _cube_schedule(n, masks)
+    fd_src = _cube_fd_sources(schedule, fd_bits) if (fd_bits and relabel is not None) else {}
+    for i, layer in enumerate(schedule):
+        sizes = {m: len(f) for m, f in frames.items()}
+        for mask in layer:
+            if mask in fd_src:
+                frames[mask] = relabel(frames[fd_src[mask]], mask)
+            else:
+                frames[mask] = derive(frames[_cube_smallest_parent(mask, sizes)], mask)
+            emit(mask, frames[mask])
+        remaining = [m for later in schedule[i + 1 :] for m in later]
+        pinned = {fd_src[m] for m in remaining if m in fd_src}
+        for m in _cube_releasable({m: len(f) for m, f in frames.items()}, remaining, pinned):
+            del frames[m]
+
+
+def _cube_relabel(frame: pd.DataFrame, mask: int, dim_cols: List[str]) -> pd.DataFrame:
+    """复制来源 mask 的表，把 mask 折叠的维度全部改成“整体”（函数依赖剪枝用）。"""
+    out = frame.copy()
+    for j, col in enumerate(dim_cols):
+        if mask & (1 << j):
+            out[col] = "整体"
+    return out
+
+
+def _fd_bits(fds: List[tuple], dim_cols: List[str]) -> List[tuple]:
+    """函数依赖 [(a, b)]（维度名）-> [(a 的位, b 的位)]，忽略不在 dim_cols 中的维度。"""
+    return [(dim_cols.index(a), dim_cols.index(b)) for a, b in (fds or []) if a in dim_cols and b in dim_cols]
+
+
+def _detect_functional_dependencies(df: pd.DataFrame, dim_cols: List[str], candidates: List[tuple] = None) -> List[tuple]:
+    """
+    在数据上检查维度间的精确函数依赖 a -> b（每个 a 取值只对应一个 b 取值，NULL 也视作一个取值）。
+    candidates 为空时检查全部有序维度对；否则只校验给定的 (a, b)。
+    """
+    if df is None or len(df) == 0 or len(dim_cols) < 2:
+        return []
+    codes = {}
+    card = {}
+    for c in dim_cols:
+        cc, uniq = pd.factorize(df[c], use_na_sentinel=False)
+        codes[c] = cc.astype(np.int64)
+        card[c] = len(uniq)
+    pairs = candidates if candidates is not None else [(a, b) for a in dim_cols for b in dim_cols if a != b]
+    out = []
+    for a, b in pairs:
+        if a not in codes or b not in codes or a == b:
+            continue
+        if card[b] > card[a]:
+            continue
+        n_pairs = len(pd.unique(codes[a] * card[b] + codes[b]))
+        if n_pairs == card[a]:
+            out.append((a, b))
+    return out
+
+
+class _CubeSink:
+    """
+    cube 各 mask 成品表的收集器：
+    - spill_dir 为空：留在内存
+    - 否则每个 mask 落盘为 pickle（spill_dir 下的临时目录），遍历期间不占内存；collect() 时按 mask 顺序读回拼接并删除
+    """
+
+    def __init__(self, spill_dir: str = None):
+        self._items = {}
+        self._dir = Path(tempfile.mkdtemp(prefix="cum10m_cube_spill_", dir=spill_dir)) if spill_dir else None
+
+    def put(self, mask: int, frame: pd.DataFrame):
+        if self._dir is None:
+            self._items[mask] = frame
+            return
+        path = self._dir / f"m{mask}.pkl"
+        frame.to_pickle(path)
+        self._items[mask] = path
+
+    def collect(self) -> pd.DataFrame:
+        try:
+            frames = [
+                self._items[m] if self._dir is None else pd.read_pickle(self._items[m]) for m in sorted(self._items)
+            ]
+            return pd.concat(frames, ignore_index=True)
+        finally:
+            self._items = {}
+            if self._dir is not None:
+                shutil.rmtree(self._dir, ignore_errors=True)
+
+
 def _cube_sum_fast(
     base: pd.DataFrame,
     *,
     dim_cols: List[str],
     metric_cols: List[str],
     time_col: str = "time_minute_10",
+    spill_dir: str = None,
+    masks: List[int] = None,
+    fds: List[tuple] = None,
 ) -> pd.DataFrame:
     """
     更高效的 CUBE(sum) 实现：
-    - 动态规划：每个 mask（表示被置为“整体”的维度集合）从 parent(mask去掉一位) 聚合得到
+    - 动态规划：每个 mask（表示被置为“整体”的维度集合）从行数最少的 parent(mask去掉一位) 聚合得到
     - 避免对原始大表重复做 2^n 次 groupby（仅 1-bit mask 会直接 groupby 大表）
+    - 按层遍历并及时释放上一层（见 _walk_cube_lattice）；spill_dir 非空时各 mask 成品先落盘（见 _CubeSink）
+    - masks 非空时只输出这些维度组合（GROUPING SETS，见 _grouping_sets_to_masks）
+    - fds 为维度间函数依赖 [(a, b)]：保留 a、折叠 b 的组合直接复制改名，不再 groupby（见 _cube_fd_sources）
 
     注意：
     - 这里对指标统一做 sum（与历史实现一致）。
@@ -2581,12 +3906,7 @@ def _cube_sum_fast(
     df0 = base[cols].copy()
     n = len(dim_cols)
 
-    dfs = {0: df0}
-    for mask in range(1, 1 << n):
-        lsb = mask & -mask
-        parent = mask ^ lsb
-        parent_df = dfs[parent]
-
+    def derive(parent_df: pd.DataFrame, mask: int) -> pd.DataFrame:
         keep_dims = [dim_cols[j] for j in range(n) if not (mask & (1 << j))]
         gcols = keep_dims + [time_col]
         agg = parent_df.groupby(gcols, dropna=False, sort=False, observed=True, as_index=False)[metric_cols].sum()
@@ -2594,14 +3914,67 @@ def _cube_sum_fast(
         for j, col in enumerate(dim_cols):
             if mask & (1 << j):
                 agg[col] = "整体"
-        agg = agg[dim_cols + [time_col] + metric_cols]
-        dfs[mask] = agg
-
-    out = pd.concat(dfs.values(), ignore_index=True)
+        return agg[dim_cols + [time_col] + metric_cols]
+
+    sink = _CubeSink(spill_dir)
+    _walk_cube_lattice(
+        n,
+        df0,
+        derive,
+        sink.put,
+        masks=masks,
+        relabel=lambda f, m: _cube_relabel(f, m, dim_cols),
+        fd_bits=_fd_bits(fds, dim_cols),
+    )
+    del df0
+    out = sink.collect()
     out = out.groupby(dim_cols + [time_col], dropna=False, sort=False, observed=True, as_index=False)[metric_cols].sum()
     return out
 
 
+def _cube_sum_over_increments(
+    df: pd.DataFrame,
+    *,
+    dim_cols: List[str],
+    metric_cols: List[str],
+    output_names: dict,
+    spine_df: pd.DataFrame,
+    time_col: str = "time_minute_10",
+    spill_dir: str = None,
+    masks: List[int] = None,
+    fds: List[tuple] = None,
+) -> pd.DataFrame:
+    """
+    sum 指标的 CUBE：先在稀疏的“(维度, 桶) 增量”上做 CUBE(sum)，再对全部 mask 的结果一次性
+    scatter + cumsum + 稠密展开（见 _dense_cum_kernel / _emit_dense_frame）。
+
+    与“先累计成 维度x时间 稠密表再 CUBE(sum)”结果一致（早于 spine 起点的增量并入第一个输出桶），
+    但进入 CUBE 的行数只取决于有变化的 (维度, 桶) 个数，而不是 组数 x 桶数。
+    """
+    out_cols = [output_names.get(f, f) for f in metric_cols]
+    spine = spine_df[time_col].to_numpy(dtype=np.int64)
+    if len(df) == 0 or len(spine) == 0:
+        return pd.DataFrame(columns=dim_cols + [time_col] + out_cols)
+
+    inc = df[dim_cols + [time_col]].reset_index(drop=True)
+    for f, o in zip(metric_cols, out_cols):
+        inc[o] = np.nan_to_num(pd.to_numeric(df[f], errors="coerce").to_numpy(dtype=np.float64))
+    inc = inc.groupby(dim_cols + [time_col], dropna=False, sort=False, observed=True, as_index=False)[out_cols].sum()
+    cube = _cube_sum_fast(
+        inc, dim_cols=dim_cols, metric_cols=out_cols, time_col=time_col, spill_dir=spill_dir, masks=masks, fds=fds
+    )
+    del inc
+
+    bidx = _spine_bucket_index(cube[time_col].to_numpy(dtype=np.int64), spine)
+    keep = bidx >= 0
+    if not keep.all():
+        cube = cube[keep]
+        bidx = bidx[keep]
+    gid, dims_tab = _factorize_dims(cube, dim_cols)
+    arr = _dense_cum_kernel(gid, bidx, cube[out_cols].to_numpy(dtype=np.float64), len(dims_tab), len(spine))
+    return _emit_dense_frame(arr, dims_tab, dim_cols, spine, time_col, out_cols)
+
+
 def _cube_distinct_cum_fast(
     df: pd.DataFrame,
     *,
@@ -2610,6 +3983,15 @@ def _cube_distinct_cum_fast(
     out_col: str,
     spine_df: pd.DataFrame,
     time_col: str = "time_minute_10",
+    engine: str = "groupby",
+    workers: int = 1,
+    executor: str = "serial",
+    tmp_dir: str = None,
+    spill_dir: str = None,
+    masks: List[int] = None,
+    fds: List[tuple] = None,
+    first_seen: str = "groupby",
+    output_mode: str = "dense",
 ) -> pd.DataFrame:
     """
     CUBE + distinct 的累计计算（对齐 Hive/SparkSQL 的 count(distinct ...) with cube 语义）：
@@ -2620,12 +4002,25 @@ def _cube_distinct_cum_fast(
 
     实现方式（动态规划）：
     1) mask=0：先求每个(维度,key)的首次出现时间
-    2) mask>0：从 parent(mask 去掉一位) 聚合得到，把更多维度折叠成“整体”
+    2) mask>0：从行数最少的 parent(mask 去掉一位) 聚合得到，把更多维度折叠成“整体”
     3) 对每个 mask 产生的表，按(维度,time)统计新增 key 数量并做 cumsum
     4) 构造 dim×time 的完整网格，对缺失时间点做 forward-fill（保持累计值）
+       engine=dense 时 3)+4) 改为稠密 NumPy 内核（见 _cube_distinct_emit_dense），不再构造网格
+
+    workers>1 时按 key 的哈希把行分成 workers 个分片，用进程池分别计算 1)~3) 的“每桶新增数”再相加：
+    同一个 key 只会落在一个分片里，因此各分片的新增数严格可加，结果与单进程完全一致。
+    executor=levels 时改为按 mask 层级并行（见 _cube_distinct_new_counts_levels），workers 作为进程池大小。
+    spill_dir 非空时各 mask 的“每桶新增数”先落盘，遍历结束再读回（见 _CubeSink）。
+    masks 非空时只计算这些维度组合（GROUPING SETS）；fds 为维度间函数依赖，可推出的组合直接复制改名。
+    first_seen=sort 时各 mask 的首次出现改用“按时间排序一次 + drop_duplicates”（见 _cube_distinct_new_counts）；
+    first_seen=bitmap 时改为按桶 OR 压缩位图（见 _cube_bitmap_new_counts）。
+    output_mode=changes 时（engine=groupby）跳过 4)，只返回各组合有新增 key 的桶（见 _change_only_rows）。
     """
     if df is None or len(df) == 0:
         return pd.DataFrame(columns=(dim_cols + [time_col, out_col]))
+    if time_col in df.columns:
+        # 早于 spine 起点的首次出现并入第一个输出桶（与 engine=dense / _cube_hll_cum 一致）
+        df = _fold_pre_start(df, spine_df, time_col)
     if not dim_cols:
         # 无维度时，相当于全局 distinct key 的累计
         first = df.groupby([key_col], dropna=False, sort=False, observed=True)[time_col].min().reset_index()
@@ -2641,39 +4036,56 @@ def _cube_distinct_cum_fast(
     if key_col not in df.columns:
         raise ValueError(f"缺少去重键列 {key_col}")
 
-    dff = df[_distinct_key_mask(df[key_col])]
-    base_first = (
-        dff.groupby(dim_cols + [key_col], dropna=False, sort=False, observed=True)[time_col].min().reset_index()
-    )
-
-    n = len(dim_cols)
-    dfs = {0: base_first}
-    for mask in range(1, 1 << n):
-        lsb = mask & -mask
-        parent = mask ^ lsb
-        parent_df = dfs[parent]
-
-        keep_dims = [dim_cols[j] for j in range(n) if not (mask & (1 << j))]
-        gcols = keep_dims + [key_col]
-        agg = parent_df.groupby(gcols, dropna=False, sort=False, observed=True, as_index=False)[time_col].min()
+    dff = df.loc[_distinct_key_mask(df[key_col]), dim_cols + [key_col, time_col]]
+    if executor == "levels":
+        new_counts = _cube_distinct_new_counts_levels(
+            dff,
+            dim_cols=dim_cols,
+            key_col=key_col,
+            time_col=time_col,
+            workers=workers,
+            tmp_dir=tmp_dir,
+            spill_dir=spill_dir,
+            masks=masks,
+            fds=fds,
+            first_seen=first_seen,
+        )
+    elif workers and workers > 1:
+        shard = _hash_shard_ids(dff[key_col], workers)
+        tasks = [
+            (dff[shard == i], dim_cols, key_col, time_col, spill_dir, masks, fds, first_seen) for i in range(workers)
+        ]
+        parts = _run_process_pool(_cube_distinct_shard_worker, tasks, workers)
+        new_counts = pd.concat(parts, ignore_index=True)
+        new_counts = new_counts.groupby(
+            ["__mask"] + dim_cols + [time_col], dropna=False, sort=False, observed=True, as_index=False
+        )["__new"].sum()
+    else:
+        new_counts = _cube_distinct_new_counts(
+            dff,
+            dim_cols=dim_cols,
+            key_col=key_col,
+            time_col=time_col,
+            spill_dir=spill_dir,
+            masks=masks,
+            fds=fds,
+            first_seen=first_seen,
+        )
 
-        for j, col in enumerate(dim_cols):
-            if mask & (1 << j):
-                agg[col] = "整体"
-        agg = agg[dim_cols + [key_col, time_col]]
-        dfs[mask] = agg
+    if engine == "dense":
+        frames = [g.drop(columns=["__mask"]) for _, g in new_counts.groupby("__mask", sort=True)]
+        return _cube_distinct_emit_dense(
+            frames, dim_cols=dim_cols, time_col=time_col, out_col=out_col, spine_df=spine_df, weight_col="__new"
+        )
 
     # 每个 mask 生成“累计 distinct”时间序列（只在 key 首次出现的桶上有值）
-    frames = []
-    for dfm in dfs.values():
-        new_cnt = dfm.groupby(dim_cols + [time_col], dropna=False, sort=False, observed=True).size().reset_index(name=out_col)
-        new_cnt = new_cnt.sort_values(dim_cols + [time_col], kind="mergesort")
-        new_cnt[out_col] = new_cnt.groupby(dim_cols, dropna=False, sort=False, observed=True)[out_col].cumsum()
-        frames.append(new_cnt)
-
-    metrics = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=(dim_cols + [time_col, out_col]))
+    metrics = new_counts.rename(columns={"__new": out_col})
+    metrics = metrics.sort_values(["__mask"] + dim_cols + [time_col], kind="mergesort")
+    metrics[out_col] = metrics.groupby(["__mask"] + dim_cols, dropna=False, sort=False, observed=True)[out_col].cumsum()
     # 同一(维度,time)可能出现重复（例如原始维度值本身就是“整体”），这里按 max 取累计值
     metrics = metrics.groupby(dim_cols + [time_col], dropna=False, sort=False, observed=True, as_index=False)[out_col].max()
+    if output_mode == "changes":
+        return metrics[dim_cols + [time_col, out_col]]
 
     # 构造完整 dim×time 网格并 ffill（保持累计值）
     spine_df = spine_df.copy()
@@ -2688,36 +4100,1367 @@ def _cube_distinct_cum_fast(
     return out[dim_cols + [time_col, out_col]]
 
 
-def _write_to_warehouse_datawork(df_out: pd.DataFrame, args):
-    if "date_p" not in df_out.columns:
-        raise ValueError("写入数仓需要输出包含date_p列")
-
-    if args.dw_write_method == "spark":
-        # spark 写 ORC 文件到 LOCATION/date_p=...，再 add_partition
-        _write_to_warehouse_spark(df_out, args)
-        return
-
-    ddl_log = _run_datawork_query_capture(args, f"show create table {args.dw_table}", sql_engine="Hive")
-    schema_info = _parse_create_table_schema_from_log(ddl_log)
+def _cube_distinct_new_counts(
+    df: pd.DataFrame,
+    *,
+    dim_cols: List[str],
+    key_col: str,
+    time_col: str,
+    spill_dir: str = None,
+    masks: List[int] = None,
+    fds: List[tuple] = None,
+    first_seen: str = "groupby",
+) -> pd.DataFrame:
+    """
+    计算每个 cube mask 下“每桶新增 key 数”（未累计），返回列：__mask + 维度 + 时间 + __new。
+    输入 df 需已过滤无效 key（见 _distinct_key_mask）。
+    首次出现表按层遍历、及时释放（见 _walk_cube_lattice），只有体量小得多的“每桶新增数”交给 sink。
+
+    first_seen：
+    - groupby（默认）：每个 mask 做 groupby(维度, key)[时间].min()
+    - sort：叶子表按时间稳定排序一次，之后每个 mask 只做 drop_duplicates(keep="first")；
+      drop_duplicates 保持行序，子表依旧按时间有序，排序在整个 cube 格上只做一次
+    - bitmap：每个 (维度, 桶) 一个压缩位图，父组合由子组合位图按桶 OR 得到（见 _cube_bitmap_new_counts）
+    """
+    if first_seen == "bitmap":
+        return _cube_bitmap_new_counts(
+            df, dim_cols=dim_cols, key_col=key_col, time_col=time_col, spill_dir=spill_dir, masks=masks, fds=fds
+        )
+    if first_seen == "sort":
+        order = np.argsort(df[time_col].to_numpy(), kind="stable")
+        base_first = df[dim_cols + [key_col, time_col]].iloc[order].drop_duplicates(dim_cols + [key_col])
+    else:
+        base_first = (
+            df.groupby(dim_cols + [key_col], dropna=False, sort=False, observed=True)[time_col].min().reset_index()
+        )
+
+    n = len(dim_cols)
+
+    def derive(parent_df: pd.DataFrame, mask: int) -> pd.DataFrame:
+        keep_dims = [dim_cols[j] for j in range(n) if not (mask & (1 << j))]
+        gcols = keep_dims + [key_col]
+        if first_seen == "sort":
+            agg = parent_df.drop_duplicates(gcols)
+        else:
+            agg = parent_df.groupby(gcols, dropna=False, sort=False, observed=True, as_index=False)[time_col].min()
+
+        for j, col in enumerate(dim_cols):
+            if mask & (1 << j):
+                agg[col] = "整体"
+        return agg[dim_cols + [key_col, time_col]]
+
+    sink = _CubeSink(spill_dir)
+
+    def emit(mask: int, dfm: pd.DataFrame):
+        new_cnt = dfm.groupby(dim_cols + [time_col], dropna=False, sort=False, observed=True).size().reset_index(name="__new")
+        new_cnt.insert(0, "__mask", mask)
+        sink.put(mask, new_cnt)
+
+    _walk_cube_lattice(
+        n,
+        base_first,
+        derive,
+        emit,
+        masks=masks,
+        relabel=lambda f, m: _cube_relabel(f, m, dim_cols),
+        fd_bits=_fd_bits(fds, dim_cols),
+    )
+    del base_first
+    return sink.collect()
+
+
+def _distinct_key_uint64(s: pd.Series) -> np.ndarray:
+    """distinct 键 -> uint64 位图下标：整数键直接按位重解释（含 --key-encoding int64 的哈希值），其余先 factorize。"""
+    if pd.api.types.is_integer_dtype(s.dtype):
+        return s.to_numpy(dtype=np.int64).view(np.uint64)
+    codes, _ = pd.factorize(s)
+    return codes.astype(np.uint64)
+
+
+def _cube_bitmap_new_counts(
+    df: pd.DataFrame,
+    *,
+    dim_cols: List[str],
+    key_col: str,
+    time_col: str,
+    spill_dir: str = None,
+    masks: List[int] = None,
+    fds: List[tuple] = None,
+) -> pd.DataFrame:
+    """
+    _cube_distinct_new_counts 的位图实现（first_seen=bitmap），返回列同样是 __mask + 维度 + 时间 + __new。
+
+    - 叶子层：每个 (维度, 桶) 一个 roaring 位图，存该组合下“首次出现在这个桶”的 key
+    - 父组合：按 (保留维度, 桶) 把子组合位图 OR 起来，再按时间顺序减去该组已出现的 key，
+      剩下的就是父组合在这个桶的首次出现 key；得到的位图仍是“首次出现”口径，可以继续往上折叠
+    - 每桶新增数 = 位图基数
+
+    cube 格上流转的是 (维度, 桶) 粒度的位图而不是 (维度, key) 粒度的首次出现表，结果与 groupby 完全一致。
+    依赖 pyroaring（BitMap64）。
+    """
+    try:
+        from pyroaring import BitMap64
+    except Exception as e:
+        raise RuntimeError("当前环境缺少 pyroaring，无法使用 --first-seen-method bitmap；请先 pip install pyroaring") from e
+
+    first = df.groupby(dim_cols + [key_col], dropna=False, sort=False, observed=True)[time_col].min().reset_index()
+    keys = _distinct_key_uint64(first[key_col])
+    gid = first.groupby(dim_cols + [time_col], dropna=False, sort=False, observed=True).ngroup().to_numpy()
+    order = np.argsort(gid, kind="stable")
+    bounds = np.flatnonzero(np.diff(gid[order])) + 1
+    # 空输入（如 --workers 下某个 key 哈希分片没有 key）没有组起点
+    starts = order[np.r_[0, bounds]] if len(order) else order
+    root = first[dim_cols + [time_col]].iloc[starts].reset_index(drop=True)
+    root["__bm"] = [BitMap64(part) for part in np.split(keys[order], bounds)] if len(order) else []
+    del first, keys, gid, order
+
+    n = len(dim_cols)
+
+    def derive(parent_df: pd.DataFrame, mask: int) -> pd.DataFrame:
+        keep_dims = [dim_cols[j] for j in range(n) if not (mask & (1 << j))]
+        merged = parent_df.groupby(keep_dims + [time_col], dropna=False, sort=False, observed=True, as_index=False)[
+            "__bm"
+        ].agg(lambda s: BitMap64.union(*s))
+        if keep_dims:
+            grp = merged.groupby(keep_dims, dropna=False, sort=False, observed=True).ngroup().to_numpy()
+        else:
+            grp = np.zeros(len(merged), dtype=np.int64)
+        order = np.lexsort((merged[time_col].to_numpy(), grp))
+        rows, bms = [], []
+        seen, prev = None, None
+        for i, g, bm in zip(order, grp[order], merged["__bm"].to_numpy()[order]):
+            if g != prev:
+                seen, prev = BitMap64(), g
+            new = bm - seen
+            if new:
+                seen |= new
+                rows.append(i)
+                bms.append(new)
+        agg = merged.iloc[rows].reset_index(drop=True)
+        agg["__bm"] = bms
+        for j, col in enumerate(dim_cols):
+            if mask & (1 << j):
+                agg[col] = "整体"
+        return agg[dim_cols + [time_col, "__bm"]]
+
+    sink = _CubeSink(spill_dir)
+
+    def emit(mask: int, dfm: pd.DataFrame):
+        new_cnt = dfm[dim_cols + [time_col]].copy()
+        new_cnt["__new"] = np.fromiter((len(b) for b in dfm["__bm"]), dtype=np.int64, count=len(dfm))
+        new_cnt = new_cnt.groupby(dim_cols + [time_col], dropna=False, sort=False, observed=True, as_index=False)[
+            "__new"
+        ].sum()
+        new_cnt.insert(0, "__mask", mask)
+        sink.put(mask, new_cnt)
+
+    _walk_cube_lattice(
+        n,
+        root,
+        derive,
+        emit,
+        masks=masks,
+        relabel=lambda f, m: _cube_relabel(f, m, dim_cols),
+        fd_bits=_fd_bits(fds, dim_cols),
+    )
+    del root
+    return sink.collect()
+
+
+def _cube_distinct_shard_worker(task) -> pd.DataFrame:
+    """进程池任务：对一个 key 哈希分片计算各 mask 的每桶新增数。"""
+    sub, dim_cols, key_col, time_col, spill_dir, masks, fds, first_seen = task
+    return _cube_distinct_new_counts(
+        sub,
+        dim_cols=dim_cols,
+        key_col=key_col,
+        time_col=time_col,
+        spill_dir=spill_dir,
+        masks=masks,
+        fds=fds,
+        first_seen=first_seen,
+    )
+
+
+def _cube_code_new_counts(arr: np.ndarray, n: int) -> np.ndarray:
+    """编码后的首次出现矩阵 [行 x (n 个维度, key, 时间)] -> 每桶新增数矩阵 [行 x (n 个维度, 时间, 新增数)]。"""
+    gcols = list(range(n)) + [n + 1]
+    frame = pd.DataFrame({j: arr[:, j] for j in gcols})
+    cnt = frame.groupby(gcols, sort=False).size()
+    idx = cnt.index.to_frame(index=False).to_numpy(dtype=np.int64)
+    return np.column_stack([idx.reshape(len(cnt), len(gcols)), cnt.to_numpy(dtype=np.int64)])
+
+
+def _cube_levels_worker(task) -> tuple:
+    """
+    进程池任务：从父 mask 的首次出现矩阵（.npy，mmap 只读打开）聚合出本 mask 的首次出现矩阵，
+    落盘供下一层使用，返回 (首次出现表行数, 每桶新增数矩阵)。折叠掉的维度编码为 -1（即“整体”）。
+    relabel=True 时父 mask 是函数依赖来源，直接复制改名，不做 groupby。
+    first_seen=sort 时父矩阵按时间有序，改用 drop_duplicates 取每组第一行。
+    """
+    parent_path, out_path, mask, n, relabel, first_seen = task
+    parent = np.load(parent_path, mmap_mode="r")
+    keep = [j for j in range(n) if not (mask & (1 << j))]
+    if relabel:
+        # 函数依赖：分组与来源 mask 一一对应，只需把折叠维度改成 -1
+        out = np.array(parent, dtype=np.int64, order="F")
+        for j in range(n):
+            if mask & (1 << j):
+                out[:, j] = -1
+        np.save(out_path, out)
+        return len(out), _cube_code_new_counts(out, n)
+    frame = pd.DataFrame({j: parent[:, j] for j in keep + [n, n + 1]})
+    if first_seen == "sort":
+        # 父矩阵已按时间有序：每组第一行即首次出现，且结果保持有序
+        first = frame.drop_duplicates(keep + [n])
+    else:
+        first = frame.groupby(keep + [n], sort=False)[n + 1].min().reset_index()
+    out = np.full((len(first), n + 2), -1, dtype=np.int64, order="F")
+    for j in keep + [n, n + 1]:
+        out[:, j] = first[j].to_numpy(dtype=np.int64)
+    np.save(out_path, out)
+    return len(out), _cube_code_new_counts(out, n)
+
+
+def _cube_distinct_new_counts_levels(
+    df: pd.DataFrame,
+    *,
+    dim_cols: List[str],
+    key_col: str,
+    time_col: str,
+    workers: int = 1,
+    tmp_dir: str = None,
+    spill_dir: str = None,
+    masks: List[int] = None,
+    fds: List[tuple] = None,
+    first_seen: str = "groupby",
+) -> pd.DataFrame:
+    """
+    _cube_distinct_new_counts 的分层并行版本（--cube-executor levels），返回列相同。
+
+    - 维度与 key 先编码为 int64（维度 NULL 也单独编码），每个 mask 的首次出现表是一个列存 int64 矩阵
+    - 按 popcount 分层，同层 mask 互不依赖，整层提交到进程池并行 groupby
+    - 父层矩阵落成 .npy（列存），子进程用 mmap 只读打开，各进程共享同一份页缓存，不经 pickle 复制大表
+    - 仅在输出“每桶新增数”时把编码解回原始维度值；每层算完即删除不再需要的祖先 .npy，临时目录在结束后删除
+    """
+    n = len(dim_cols)
+    dim_tabs = []
+    base = np.empty((len(df), n + 2), dtype=np.int64, order="F")
+    for j, c in enumerate(dim_cols):
+        codes, uniques = pd.factorize(df[c], use_na_sentinel=False)
+        base[:, j] = codes
+        dim_tabs.append(np.asarray(uniques, dtype=object))
+    base[:, n] = pd.factorize(df[key_col], use_na_sentinel=False)[0]
+    base[:, n + 1] = df[time_col].to_numpy(dtype=np.int64)
+    if first_seen == "sort":
+        base = np.asfortranarray(base[np.argsort(base[:, n + 1], kind="stable")])
+
+    root = Path(tempfile.mkdtemp(prefix="cum10m_cube_", dir=tmp_dir))
+    ex = None
+    try:
+        np.save(root / "m0_in.npy", base)
+        del base
+        time_dtype = df[time_col].dtype
+        sink = _CubeSink(spill_dir)
+
+        def emit(mask: int, nc: np.ndarray):
+            part = {"__mask": np.full(len(nc), mask, dtype=np.int64)}
+            for j, c in enumerate(dim_cols):
+                codes = nc[:, j]
+                if len(dim_tabs[j]):
+                    vals = dim_tabs[j].take(np.maximum(codes, 0))
+                else:
+                    vals = np.full(len(codes), None, dtype=object)
+                vals[codes < 0] = "整体"
+                part[c] = vals
+            part[time_col] = nc[:, n].astype(time_dtype)
+            part["__new"] = nc[:, n + 1]
+            sink.put(mask, pd.DataFrame(part))
+
+        rows0, nc0 = _cube_levels_worker((str(root / "m0_in.npy"), str(root / "m0.npy"), 0, n, False, first_seen))
+        if masks is None or 0 in masks:
+            emit(0, nc0)
+        (root / "m0_in.npy").unlink()
+        if workers and workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            ex = ProcessPoolExecutor(max_workers=int(workers))
+        mapper = ex.map if ex is not None else map
+        sizes = {0: rows0}
+        schedule = _cube_schedule(n, masks)
+        fd_src = _cube_fd_sources(schedule, _fd_bits(fds, dim_cols)) if fds else {}
+        for i, layer in enumerate(schedule):
+            tasks = []
+            for m in layer:
+                src = fd_src.get(m)
+                parent = src if src is not None else _cube_smallest_parent(m, sizes)
+                tasks.append((str(root / f"m{parent}.npy"), str(root / f"m{m}.npy"), m, n, src is not None, first_seen))
+            for m, (rows, nc) in zip(layer, mapper(_cube_levels_worker, tasks)):
+                sizes[m] = rows
+                emit(m, nc)
+            remaining = [m for later in schedule[i + 1 :] for m in later]
+            pinned = {fd_src[m] for m in remaining if m in fd_src}
+            for m in _cube_releasable(sizes, remaining, pinned):
+                (root / f"m{m}.npy").unlink()
+                del sizes[m]
+    finally:
+        if ex is not None:
+            ex.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    return sink.collect()
+
+
+def _cube_distinct_emit_dense(
+    frames: List[pd.DataFrame],
+    *,
+    dim_cols: List[str],
+    time_col: str,
+    out_col: str,
+    spine_df: pd.DataFrame,
+    weight_col: str = None,
+) -> pd.DataFrame:
+    """
+    把各 mask 的首次出现表（维度, key, 首次时间；或带 weight_col 的“每桶新增数”表）直接 scatter 成
+    [组 x 桶] 新增数并 cumsum，
+    按 np.repeat/np.tile 展开输出；同一维度组合在多个 mask 中重复出现时取累计值的 max（与 groupby 版一致）。
+    """
+    spine = spine_df[time_col].to_numpy(dtype=np.int64)
+    tabs = []
+    arrs = []
+    for dfm in frames:
+        if dfm is None or len(dfm) == 0 or len(spine) == 0:
+            continue
+        bidx = _spine_bucket_index(dfm[time_col].to_numpy(dtype=np.int64), spine)
+        keep = bidx >= 0
+        if not keep.all():
+            dfm = dfm[keep]
+            bidx = bidx[keep]
+        gid, tab = _factorize_dims(dfm, dim_cols)
+        if weight_col:
+            weights = dfm[weight_col].to_numpy(dtype=np.float64)
+        else:
+            weights = np.ones(len(dfm), dtype=np.float64)
+        arr = _dense_cum_kernel(gid, bidx, weights, len(tab), len(spine))
+        tabs.append(tab)
+        arrs.append(arr[:, :, 0])
+    if not tabs:
+        return pd.DataFrame(columns=(dim_cols + [time_col, out_col]))
+
+    all_tab = pd.concat(tabs, ignore_index=True)
+    stacked = np.vstack(arrs)
+    gid_all, uniq_tab = _factorize_dims(all_tab, dim_cols)
+    if len(uniq_tab) < len(all_tab):
+        merged = np.zeros((len(uniq_tab), len(spine)), dtype=np.float64)
+        np.maximum.at(merged, gid_all, stacked)
+        stacked, all_tab = merged, uniq_tab
+    return _emit_dense_frame(stacked[:, :, None], all_tab, dim_cols, spine, time_col, [out_col])
+
+
+def _clz64(x: np.ndarray) -> np.ndarray:
+    """uint64 数组的前导零个数（x=0 时为 64），按 32/16/8/4/2/1 位二分移位，结果精确。"""
+    x = np.asarray(x, dtype=np.uint64)
+    n = np.zeros(len(x), dtype=np.int64)
+    y = x.copy()
+    for shift in (32, 16, 8, 4, 2, 1):
+        top_zero = y < (np.uint64(1) << np.uint64(64 - shift))
+        n[top_zero] += shift
+        y[top_zero] <<= np.uint64(shift)
+    n[x == 0] = 64
+    return n
+
+
+def _hll_registers(keys: pd.Series, precision: int):
+    """
+    HyperLogLog：key -> (寄存器下标, rho)。
+    64 位哈希的高 precision 位选寄存器，其余位的前导零个数 + 1 为 rho（上限 64 - precision + 1）。
+    """
+    h = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+    reg = (h >> np.uint64(64 - precision)).astype(np.int64)
+    rest = h << np.uint64(precision)
+    rho = np.minimum(_clz64(rest), 64 - precision) + 1
+    return reg, rho.astype(np.int8)
+
+
+def _hll_alpha(m: int) -> float:
+    if m == 16:
+        return 0.673
+    if m == 32:
+        return 0.697
+    if m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+def _cube_hll_cum(
+    df: pd.DataFrame,
+    *,
+    dim_cols: List[str],
+    key_col: str,
+    out_col: str,
+    spine_df: pd.DataFrame,
+    time_col: str = "time_minute_10",
+    precision: int = 12,
+    masks: List[int] = None,
+    fds: List[tuple] = None,
+    spill_dir: str = None,
+) -> pd.DataFrame:
+    """
+    近似 distinct 的累计 + CUBE（--distinct-mode hll），标准误差约 1.04 / sqrt(2^precision)。
+
+    - 每个 (维度, 桶) 维护一个 HyperLogLog 草图，稀疏存成 (维度, 桶, 寄存器, rho) 行，只保留有值的寄存器
+    - 草图可合并（寄存器取 max），因此 CUBE 和 sum 一样沿 cube 格向上聚合（见 _walk_cube_lattice），
+      不再需要 (维度, key) 粒度的首次出现表
+    - 时间累计也是寄存器 max：对每个 (维度, 寄存器) 按时间做 cummax，只有寄存器变大的桶才产生增量；
+      估计值需要的 sum(2^-M) 与“零寄存器个数”都可写成每桶增量，交给稠密内核 scatter + cumsum（见 _dense_cum_kernel）
+    - masks=[0] 即不做 CUBE（只有叶子维度）
+    """
+    m = 1 << int(precision)
+    spine = spine_df[time_col].to_numpy(dtype=np.int64)
+    if df is None or len(df) == 0 or len(spine) == 0:
+        return pd.DataFrame(columns=dim_cols + [time_col, out_col])
+
+    valid = _distinct_key_mask(df[key_col]).to_numpy()
+    dff = df.loc[valid, dim_cols + [time_col]].reset_index(drop=True)
+    reg, rho = _hll_registers(df.loc[valid, key_col], int(precision))
+    dff["__reg"] = reg
+    dff["__rho"] = rho
+    gcols = dim_cols + [time_col, "__reg"]
+    leaf = dff.groupby(gcols, dropna=False, sort=False, observed=True, as_index=False)["__rho"].max()
+    del dff
+
+    n = len(dim_cols)
+
+    def derive(parent_df: pd.DataFrame, mask: int) -> pd.DataFrame:
+        keep_dims = [dim_cols[j] for j in range(n) if not (mask & (1 << j))]
+        agg = parent_df.groupby(
+            keep_dims + [time_col, "__reg"], dropna=False, sort=False, observed=True, as_index=False
+        )["__rho"].max()
+        for j, col in enumerate(dim_cols):
+            if mask & (1 << j):
+                agg[col] = "整体"
+        return agg[gcols + ["__rho"]]
+
+    sink = _CubeSink(spill_dir)
+    _walk_cube_lattice(
+        n,
+        leaf,
+        derive,
+        sink.put,
+        masks=masks,
+        relabel=lambda f, mm: _cube_relabel(f, mm, dim_cols),
+        fd_bits=_fd_bits(fds, dim_cols),
+    )
+    del leaf
+    sk = sink.collect()
+    # 原始维度值本身就是“整体”时，不同 mask 可能落到同一组合：草图直接按 max 合并
+    sk = sk.groupby(gcols, dropna=False, sort=False, observed=True, as_index=False)["__rho"].max()
+
+    # 寄存器按时间 cummax，只保留寄存器变大的行
+    sk = sk.sort_values(time_col, kind="stable")
+    reg_cols = dim_cols + ["__reg"]
+    run = sk.groupby(reg_cols, dropna=False, sort=False, observed=True)["__rho"].cummax().to_numpy(dtype=np.int64)
+    prev = sk.assign(__run=run).groupby(reg_cols, dropna=False, sort=False, observed=True)["__run"].shift(1)
+    prev = prev.fillna(0).to_numpy(dtype=np.int64)
+    rise = run > prev
+    sk = sk[rise]
+    run = run[rise]
+    prev = prev[rise]
+
+    # 增量：sum(2^-M) 变化量、零寄存器个数变化量（寄存器首次变为非零时 -1）
+    values = np.column_stack(
+        [np.exp2(-run.astype(np.float64)) - np.exp2(-prev.astype(np.float64)), -(prev == 0).astype(np.float64)]
+    )
+    bidx = _spine_bucket_index(sk[time_col].to_numpy(dtype=np.int64), spine)
+    keep = bidx >= 0
+    gid, dims_tab = _factorize_dims(sk[keep], dim_cols)
+    arr = _dense_cum_kernel(gid, bidx[keep], values[keep], len(dims_tab), len(spine))
+
+    z = m + arr[:, :, 0]
+    zeros = m + arr[:, :, 1]
+    est = _hll_alpha(m) * m * m / z
+    small = (est <= 2.5 * m) & (zeros > 0)
+    est = np.where(small, m * np.log(m / np.maximum(zeros, 1)), est)
+    est = np.round(est)
+    return _emit_dense_frame(est[:, :, None], dims_tab, dim_cols, spine, time_col, [out_col])
+
+
+def _write_to_warehouse_datawork(
+    df_out: pd.DataFrame, args, *, table: str, rewrite_from_minute: int = None, slice_files: dict = None
+):
+    if "date_p" not in df_out.columns:
+        raise ValueError("写入数仓需要输出包含date_p列")
+
+    if args.dw_write_method == "spark":
+        # spark 写 ORC 文件到 LOCATION/date_p=...，再 add_partition
+        return _write_to_warehouse_spark(
+            df_out, args, table=table, rewrite_from_minute=rewrite_from_minute, slice_files=slice_files
+        )
+
+    ddl_log = _run_datawork_query_capture(args, f"show create table {table}", sql_engine="Hive")
+    schema_info = _parse_create_table_schema_from_log(ddl_log)
     if not schema_info:
         raise RuntimeError("无法通过 datawork-client query 解析目标表DDL（show create table），请确认有权限且返回包含建表SQL")
 
     # 兼容：仍可指定 datawork-client 常量写入（适合小结果集）
-    _write_to_warehouse_datawork_union(df_out, args, schema_info=schema_info)
+    _write_to_warehouse_datawork_union(df_out, args, table=table, schema_info=schema_info)
+    return {}
 
 
-def write_to_warehouse(df_out: pd.DataFrame, args):
-    if not args.dw_table:
-        return
+def write_to_warehouse(
+    df_out: pd.DataFrame, args, *, table: str = None, rewrite_from_minute: int = None, slice_files: dict = None
+) -> dict:
+    """
+    写入目标表（默认 --dw-table；--granularities 的粗粒度结果传 <dw-table>_<分钟>m，表需已存在）。
+    rewrite_from_minute 非空时只重写该时间点及之后（--late-arrival-check），slice_files 为上次 spark 分片写入的文件清单。
+    返回本次 spark 分片写入的文件清单，其他写法返回空 dict。
+    """
+    table = table or args.dw_table
+    if not table:
+        return {}
     kind = _resolve_dw_kind(args)
     if kind == "sqlalchemy":
-        _write_to_warehouse_sqlalchemy(df_out, args)
+        _write_to_warehouse_sqlalchemy(df_out, args, table=table, rewrite_from_minute=rewrite_from_minute)
+        return {}
     elif kind == "datawork-client":
-        _write_to_warehouse_datawork(df_out, args)
+        return _write_to_warehouse_datawork(
+            df_out, args, table=table, rewrite_from_minute=rewrite_from_minute, slice_files=slice_files
+        )
     else:  # pragma: no cover
         raise ValueError(f"未知dw-kind: {kind}")
 
 
+def _clean_detail_frame(df: pd.DataFrame, args, *, fields: List[str], metric_rules: dict, computed: dict) -> pd.DataFrame:
+    """
+    明细预处理第一段：计算本地生成列（COALESCE）、校验并只保留 SELECT 字段、time_minute 转整数、按 date_p 过滤。
+    整表读入与 --stream-chunk-rows 分块读入共用。
+    """
+    df.columns = [str(c).strip() for c in df.columns]
+
+    # 处理本地可计算的表达式列（目前仅支持COALESCE；如果已在输入中存在同名列则跳过）
+    for out_col, rule in computed.items():
+        if out_col in df.columns:
+            continue
+        if rule.get("op") == "coalesce":
+            cols = [c for c in (rule.get("cols") or []) if c]
+            missing = [c for c in cols if c not in df.columns]
+            if missing:
+                raise ValueError(f"COALESCE生成列 {out_col} 缺少输入列: {missing}")
+            s = df[cols[0]]
+            for c in cols[1:]:
+                s = s.where(s.notna(), df[c])
+            df[out_col] = s
+
+    # 校验：维度/指标字段必须存在（时间字段允许缺省，除time_minute外）
+    metric_fields = [f for f in fields if f in metric_rules]
+    time_cols = {"time_hour", "time_minute", "date_p", "date_minute", "time_minute_10"}
+    missing_metrics = [f for f in metric_fields if f not in df.columns]
+    missing_dims = [f for f in fields if f not in metric_rules and f not in time_cols and f not in df.columns]
+    if missing_metrics or missing_dims:
+        msg_parts = []
+        if missing_metrics:
+            msg_parts.append(f"缺少指标列: {missing_metrics}")
+        if missing_dims:
+            msg_parts.append(f"缺少维度列: {missing_dims}")
+        raise ValueError("输入数据列不完整，" + "；".join(msg_parts))
+
+    # 只保留SQL中指定的字段
+    use_cols = [c for c in fields if c in df.columns]
+    if not use_cols:
+        raise ValueError("输入数据中未找到SELECT字段")
+    df = df[use_cols]
+
+    # 标准化time_minute列（处理可能的浮点数格式）
+    if "time_minute" not in df.columns:
+        raise ValueError("输入数据必须包含time_minute列")
+    # 将time_minute转换为整数（移除小数部分）
+    df["time_minute"] = pd.to_numeric(
+        df["time_minute"].astype(str).str.replace(r"\..*$", "", regex=True), errors="coerce"
+    )
+    df = df.dropna(subset=["time_minute"])
+    df["time_minute"] = df["time_minute"].astype("int64")
+
+    # 过滤date_p（如果存在）
+    if "date_p" in df.columns:
+        df["date_p"] = pd.to_numeric(df["date_p"], errors="coerce")
+        df = df[df["date_p"] == args.date_p]
+    return df
+
+
+def _bucket_detail_frame(
+    df: pd.DataFrame, args, *, fields: List[str], metric_rules: dict, end_bucket: int, prof=None
+) -> pd.DataFrame:
+    """明细预处理第二段：时间转 10 分钟桶下标并截到 end_ts、sum 指标转数值、distinct 键编码、维度值标准化。"""
+    # 时间统一转为“当天10分钟桶下标”（int16，0..143），后续分组/排序/spine 都用桶下标，
+    # 仅在输出时转换回 date_minute（YYYYMMDDHHmm）。
+    # 注意：累计计算按桶过滤，而不是按原始 time_minute 过滤
+    df["time_bucket"] = _minute_to_bucket(df["time_minute"].to_numpy(), args.date_p)
+    # 对于累计计算，我们需要从当天开始到end_ts的所有数据（按时间桶计算）
+    # start_ts和end_ts仅用于确定输出的时间轴范围
+    df = df[(df["time_bucket"] > np.iinfo(np.int16).min) & (df["time_bucket"] <= end_bucket)]
+
+    # 指标字段（按SELECT顺序）
+    metric_cols = [f for f in fields if f in metric_rules]
+    # 确保sum类指标是数值类型（避免object字符串sum变成拼接）
+    for c in metric_cols:
+        if metric_rules.get(c) == "sum" and c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
+
+    # distinct 键压缩为 int64（--key-encoding int64）：有效性判断只在这里做一次
+    if getattr(args, "key_encoding", "raw") == "int64":
+        if prof:
+            prof.start("encode_keys")
+        for c in metric_cols:
+            if metric_rules.get(c) == "distinct" and c in df.columns:
+                df[c] = _encode_distinct_key(df[c], collision_check=bool(getattr(args, "key_collision_check", False)))
+        if prof:
+            prof.end("encode_keys")
+
+    # 维度值标准化（含 func_name 特殊规则）
+    time_cols = {"time_hour", "time_minute", "date_p", "date_minute", "time_minute_10"}
+    dim_cols = [c for c in fields if c not in metric_cols and c not in time_cols and c in df.columns]
+    return _normalize_dim_values(df, dim_cols)
+
+
+def _stream_reduce_query_to_local(
+    paths,
+    args,
+    *,
+    fields: List[str],
+    metric_rules: dict,
+    computed: dict,
+    end_bucket: int,
+    chunk_rows: int,
+    after_bucket: int = None,
+):
+    """
+    --stream-chunk-rows：分块读取 query_to_local 文件，每块预处理后立即归约为叶子层状态
+    （(维度, 桶) 的 sum 增量 + (维度, key) 的首次出现桶，见 _leaf_state_from_detail）并与之前的块合并，
+    完整明细从不同时驻留内存，峰值内存由叶子层状态大小决定。
+    after_bucket 非空（--state-dir 已覆盖到该桶）时每块只保留其后的桶。
+    paths 为单个文件或文件序列（--dw-pull-slice-minutes 时按分片完成顺序逐个给出）。
+
+    返回 (与原明细等价的紧凑明细, 叶子层状态, 原始行数)。
+    """
+    metric_cols = [f for f in fields if f in metric_rules]
+    sum_fields = [f for f in metric_cols if metric_rules.get(f) == "sum"]
+    distinct_fields = [f for f in metric_cols if metric_rules.get(f) == "distinct"]
+    time_cols = {"time_hour", "time_minute", "date_p", "date_minute", "time_minute_10"}
+    # 维度只取 SELECT 中的非指标非时间字段（COALESCE 生成列也在 fields 中）
+    dim_cols = [c for c in fields if c not in metric_cols and c not in time_cols]
+    kw = dict(dim_cols=dim_cols, time_col="time_bucket")
+
+    # 按二进制计数器做树形合并：栈中每层状态覆盖 2^level 个块，同层相遇才合并，
+    # 每行只参与 O(log 块数) 次合并；逐块并入整体状态则每块都要重排一遍累积状态，总耗时随块数平方增长
+    stack, n_raw = [], 0
+    paths = [paths] if isinstance(paths, (str, Path)) else paths
+    chunks = itertools.chain.from_iterable(_iter_query_to_local_chunks(p, fields, chunk_rows=chunk_rows) for p in paths)
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            if stack:
+                break
+            # 空文件：仍走一遍预处理，得到列齐全的空状态
+            chunk = pd.DataFrame({c: pd.Series(dtype=object) for c in fields})
+        n_raw += len(chunk)
+        chunk = _clean_detail_frame(chunk, args, fields=fields, metric_rules=metric_rules, computed=computed)
+        chunk = _bucket_detail_frame(chunk, args, fields=fields, metric_rules=metric_rules, end_bucket=end_bucket)
+        if after_bucket is not None:
+            chunk = chunk[chunk["time_bucket"] > int(after_bucket)]
+        part = _leaf_state_from_detail(chunk, sum_fields=sum_fields, distinct_fields=distinct_fields, **kw)
+        level = 0
+        while stack and stack[-1][0] == level:
+            part = _merge_leaf_state(stack.pop()[1], part, **kw)
+            level += 1
+        stack.append((level, part))
+    leaf = stack[0][1] if len(stack) == 1 else _merge_leaf_state(*(x[1] for x in stack), **kw)
+    detail = _detail_from_leaf_state(leaf, sum_fields=sum_fields, distinct_fields=distinct_fields, **kw)
+    return detail, leaf, n_raw
+
+
+def _resolve_cube_fds(args, sql_text: str, df: pd.DataFrame, dim_cols: List[str]) -> List[tuple]:
+    """
+    本地 CUBE 使用的维度函数依赖：SQL 注释 `-- fd: a -> b` 声明的（在数据上校验，不成立的告警并忽略），
+    加上 --cube-fd-detect 时从数据中自动检测到的。
+    """
+    declared = [(a, b) for a, b in extract_functional_dependencies(sql_text) if a in dim_cols and b in dim_cols]
+    fds = _detect_functional_dependencies(df, dim_cols, candidates=declared) if declared else []
+    for a, b in declared:
+        if (a, b) not in fds:
+            print(f"[warn] 声明的函数依赖在数据中不成立，已忽略: {a} -> {b}", file=sys.stderr)
+    if getattr(args, "cube_fd_detect", False):
+        for fd in _detect_functional_dependencies(df, dim_cols):
+            if fd not in fds:
+                fds.append(fd)
+    prof = getattr(args, "_profiler", None)
+    if fds and prof:
+        prof.info("CUBE 函数依赖: " + ", ".join(f"{a}->{b}" for a, b in fds))
+    return fds
+
+
+def _duckdb_detail_frame(
+    df: pd.DataFrame, *, dim_cols: List[str], distinct_fields: List[str], sum_fields: List[str]
+) -> pd.DataFrame:
+    """已预处理的 pandas 明细 -> DuckDB 输入表（维度 object、无效 distinct 键置 NULL、桶下标 int32）。"""
+    detail = df[dim_cols + distinct_fields + sum_fields + ["time_bucket"]].copy()
+    for c in dim_cols:
+        detail[c] = detail[c].astype(object)
+    for f in distinct_fields:
+        # 无效键（NULL/空串/\N/null，见 _distinct_key_mask）统一置 NULL，SQL 里只需 is not null
+        valid = _distinct_key_mask(detail[f])
+        detail[f] = detail[f].where(valid, None) if not pd.api.types.is_integer_dtype(detail[f].dtype) else detail[f]
+    detail["time_bucket"] = detail["time_bucket"].astype(np.int32)
+    return detail
+
+
+def _duckdb_query_to_local_sql(
+    paths: List[Path],
+    sep: bytes,
+    *,
+    fields: List[str],
+    dim_cols: List[str],
+    distinct_fields: List[str],
+    sum_fields: List[str],
+    date_p: int,
+    end_bucket: int,
+) -> str:
+    """
+    --dw-compute-mode duckdb 直接读取 query_to_local 落地文件的明细查询（列同 _duckdb_detail_frame），
+    与 _clean_detail_frame + _bucket_detail_frame 口径一致：
+    - 不解析引号、缺列补空、多余列丢弃；文件里没有 NULL，空字段按空串处理（同 na_filter=False）
+    - time_minute 去掉小数部分后转整数，无法解析的行丢弃；有 date_p 列时只保留当天
+    - 桶下标同 _minute_to_bucket，只保留 end_bucket 及之前
+    - 维度空串为“未知”（func_name 保持原值）；无效 distinct 键（见 _distinct_key_mask）置 NULL；sum 指标无法解析按 0
+    """
+    files = ", ".join("'" + str(p).replace("'", "''") + "'" for p in paths)
+    columns = ", ".join(f"'{c}': 'VARCHAR'" for c in fields)
+    day0 = pd.Timestamp(str(int(date_p))).strftime("%Y-%m-%d")
+    src = (
+        f"read_csv([{files}], delim = chr({sep[0]}), header = false, quote = '', escape = '', "
+        f"columns = {{{columns}}}, auto_detect = false, null_padding = true, strict_mode = false)"
+    )
+    tm = "try_cast(regexp_replace(coalesce(time_minute, ''), '\\..*$', '') as bigint)"
+    bucket = (
+        f"date_diff('day', date '{day0}', cast(try_strptime(cast(__tm // 10000 as varchar), '%Y%m%d') as date)) * {_BUCKETS_PER_DAY}"
+        " + ((__tm // 100) % 100 * 60 + __tm % 100) // 10"
+    )
+    cols = []
+    for c in dim_cols:
+        cols.append(f"coalesce({c}, '') as {c}" if c == "func_name" else f"coalesce(nullif({c}, ''), '未知') as {c}")
+    for f in distinct_fields:
+        k = f"regexp_replace({f}, '^\\s+|\\s+$', '', 'g')"
+        cols.append(f"case when {k} in ('', '\\N') or lower({k}) = 'null' then null else {f} end as {f}")
+    for f in sum_fields:
+        cols.append(f"coalesce(try_cast({f} as double), 0) as {f}")
+    date_filter = f" and try_cast(date_p as double) = {int(date_p)}" if "date_p" in fields else ""
+    return (
+        f"select {', '.join(cols + ['time_bucket'])}\n"
+        f"from (\n  select *, cast({bucket} as integer) as time_bucket\n"
+        f"  from (select *, {tm} as __tm from {src})\n"
+        f"  where __tm is not null{date_filter}\n)\n"
+        f"where time_bucket between {np.iinfo(np.int16).min + 1} and {int(end_bucket)}"
+    )
+
+
+def _compute_cum_cube_duckdb(
+    df: pd.DataFrame,
+    args,
+    *,
+    dim_cols: List[str],
+    metric_cols: List[str],
+    metric_rules: dict,
+    output_names: dict,
+    start_bucket: int,
+    end_bucket: int,
+    grouping_sets: List[List[str]] = None,
+    local_paths: List[Path] = None,
+    fields: List[str] = None,
+    computed: dict = None,
+) -> pd.DataFrame:
+    """
+    --dw-compute-mode duckdb：在内嵌 DuckDB 中执行累计 + CUBE（见 _build_duckdb_cum_cube_sql），
+    DuckDB 多线程向量化执行，超出内存时落盘到 --dw-tmp-dir。返回列与本地 pandas 计算一致：维度 + time_bucket + 指标。
+
+    local_paths 非空时 df 不用：DuckDB 直接扫描 query_to_local 落地文件，清洗与分桶也在 SQL 里做
+    （见 _duckdb_query_to_local_sql），明细不进 pandas，峰值内存由 DuckDB 的聚合状态决定。
+    文件分隔符不一致/无法探测、或含非法 UTF-8 时回退为 pandas 读取（替换非法字节）再交给 DuckDB。
+    """
+    try:
+        import duckdb
+    except Exception as e:
+        raise RuntimeError("当前环境缺少 duckdb，无法使用 --dw-compute-mode duckdb；请先 pip install duckdb") from e
+
+    distinct_fields = [f for f in metric_cols if metric_rules.get(f) == "distinct"]
+    sum_fields = [f for f in metric_cols if metric_rules.get(f) == "sum"]
+    detail_kw = dict(dim_cols=dim_cols, distinct_fields=distinct_fields, sum_fields=sum_fields)
+
+    def pandas_detail() -> pd.DataFrame:
+        parts = [_read_datawork_query_to_local_file(p, fields) for p in local_paths]
+        raw = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=fields)
+        prep_kw = dict(fields=fields, metric_rules=metric_rules)
+        raw = _clean_detail_frame(raw, args, computed=computed or {}, **prep_kw)
+        return _duckdb_detail_frame(_bucket_detail_frame(raw, args, end_bucket=end_bucket, **prep_kw), **detail_kw)
+
+    detail_sql = None
+    if local_paths is not None:
+        seps = set()
+        for p in local_paths:
+            with open(p, "rb") as fh:
+                first = fh.readline()
+            if first:
+                seps.add(_detect_field_sep(first.rstrip(b"\r\n")))
+        nonempty = [p for p in local_paths if Path(p).stat().st_size > 0]
+        if len(seps) == 1 and None not in seps:
+            detail_sql = _duckdb_query_to_local_sql(
+                nonempty, seps.pop(), fields=fields, date_p=args.date_p, end_bucket=end_bucket, **detail_kw
+            )
+
+    sql = _build_duckdb_cum_cube_sql(
+        dim_cols=dim_cols,
+        distinct_fields=distinct_fields,
+        sum_fields=sum_fields,
+        output_names=output_names,
+        start_bucket=start_bucket,
+        end_bucket=end_bucket,
+        no_cube=bool(args.no_cube),
+        grouping_sets=grouping_sets,
+    )
+    con = duckdb.connect()
+    try:
+        spill = Path(args.dw_tmp_dir) / f"cum10m_duckdb_{args.date_p}_{int(time.time() * 1000)}"
+        args._tmp_paths.append(spill)
+        con.execute(f"set temp_directory = '{spill}'")
+        workers = int(getattr(args, "workers", 1) or 1)
+        if workers > 1:
+            con.execute(f"set threads = {workers}")
+        out = None
+        if detail_sql is not None:
+            con.execute(f"create view detail as\n{detail_sql}")
+            try:
+                out = con.execute(sql).df()
+            except duckdb.InvalidInputException as e:
+                print(f"[warn] DuckDB 直接读取落地文件失败，回退为 pandas 读取: {str(e).splitlines()[0]}", file=sys.stderr)
+                con.execute("drop view detail")
+        if out is None:
+            con.register("detail", pandas_detail() if local_paths is not None else _duckdb_detail_frame(df, **detail_kw))
+            out = con.execute(sql).df()
+    finally:
+        con.close()
+    out["time_bucket"] = out["time_bucket"].astype(np.int16)
+    # 列顺序与本地计算一致：非 CUBE 按 SELECT 顺序；CUBE 为 sum 指标在前、distinct 指标在后
+    ordered = metric_cols if (args.no_cube or not dim_cols) else sum_fields + distinct_fields
+    for f in ordered:
+        o = output_names.get(f, f)
+        out[o] = pd.to_numeric(out[o], errors="coerce").fillna(0)
+    return out[dim_cols + ["time_bucket"] + [output_names.get(f, f) for f in ordered]]
+
+
+def _compute_cum_cube_localspark(
+    args,
+    local_paths,
+    *,
+    fields: List[str],
+    metric_rules: dict,
+    output_names: dict,
+    grouping_sets: List[List[str]] = None,
+):
+    """
+    --dw-compute-mode localspark：把 query_to_local 落地文件读进本机 SparkSession（与 ORC 直写共用一个 session），
+    用 _build_sparksql_cum_cube_insert(select_only=True) 的同一套 SQL 计算累计 + CUBE，
+    结果 Spark DataFrame 直接交给 _write_to_warehouse_spark 写 ORC，全程不经 pandas。
+    local_paths 为单个文件或多个文件（--dw-pull-slice-minutes 的各分片，分隔符一致）。
+    """
+    try:
+        from pyspark.sql import functions as F
+    except Exception as e:  # pragma: no cover
+        raise RuntimeError("当前环境缺少 pyspark，无法使用 --dw-compute-mode localspark") from e
+
+    time_cols = {"time_hour", "time_minute", "date_p", "date_minute", "time_minute_10"}
+    distinct_fields = {f for f in fields if metric_rules.get(f) == "distinct"}
+    schema_info, location = _get_table_schema_info_and_location_with_retry(args, retries=3, sleep_sec=2.0)
+
+    local_paths = [local_paths] if isinstance(local_paths, (str, Path)) else list(local_paths)
+    sep = None
+    for path in local_paths:
+        with open(path, "rb") as fh:
+            first = fh.readline()
+        if first:
+            sep = _detect_field_sep(first.rstrip(b"\r\n"))
+            break
+
+    prof = getattr(args, "_profiler", None)
+    spark = _build_local_spark_session(args)
+    try:
+        if prof:
+            prof.start("compute_localspark")
+        lines = spark.read.text([Path(p).resolve().as_uri() for p in local_paths])
+        # 与 _read_datawork_query_to_local_file 同口径：按探测到的分隔符切分，缺列补空串、多余列丢弃
+        parts = F.split(F.col("value"), f"\\x{ord(sep):02x}", -1) if sep is not None else None
+        cols = []
+        for i, f in enumerate(fields):
+            if parts is not None:
+                v = F.coalesce(parts.getItem(i), F.lit(""))
+            else:
+                v = F.col("value") if i == 0 else F.lit("")
+            if f in distinct_fields:
+                # 无效键（空串/\N/null，见 _distinct_key_mask）置 NULL，不计入 distinct
+                v = F.when(F.lower(F.trim(v)).isin("", "\\n", "null"), F.lit(None)).otherwise(v)
+            elif f not in metric_rules and f not in time_cols and f != "func_name":
+                # 维度空串视为未知（见 _normalize_dim_values），SQL 里 coalesce 为 '未知'
+                v = F.when(v == "", F.lit(None)).otherwise(v)
+            cols.append(v.alias(f))
+        lines.select(*cols).createOrReplaceTempView("cum10m_detail")
+
+        select_sql = _build_sparksql_cum_cube_insert(
+            raw_hql="select * from cum10m_detail",
+            output_table=args.dw_table,
+            date_p=int(args.date_p),
+            start_ts=int(args.start_ts),
+            end_ts=int(args.end_ts),
+            fields=fields,
+            metric_rules=metric_rules,
+            output_names=output_names,
+            schema_info=schema_info,
+            no_cube=bool(args.no_cube),
+            # 拉数时已按 _build_preagg_hql 预聚合，这里不再重复
+            preagg=False,
+            grouping_sets=grouping_sets,
+            distinct_mode=getattr(args, "distinct_mode", "exact"),
+            hll_precision=int(getattr(args, "hll_precision", 12) or 12),
+            select_only=True,
+        )
+        # 分片写入会多次扫描结果，先缓存
+        result = spark.sql(select_sql).persist()
+        if prof:
+            prof.end("compute_localspark", extra=f"sep={sep!r}")
+        try:
+            _write_to_warehouse_spark(
+                None, args, spark=spark, spark_df=result, schema_info=schema_info, location=location
+            )
+        finally:
+            result.unpersist()
+    finally:
+        try:
+            spark.stop()
+        except Exception:
+            pass
+
+
+def _state_signature(args, sql_text: str) -> str:
+    """增量状态的签名：SQL 文本 + 影响状态内容的参数；任一变化都视为不同的状态，不复用。"""
+    h = hashlib.sha1()
+    h.update((sql_text or "").encode("utf-8"))
+    h.update(f"|date_p={int(args.date_p)}|key_encoding={getattr(args, 'key_encoding', 'raw')}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _state_path(args, signature: str) -> Path:
+    return Path(args.state_dir) / f"cum10m_state_{int(args.date_p)}_{signature[:16]}.pkl"
+
+
+def _load_cum_state(args, signature: str, end_bucket: int):
+    """
+    读取 --state-dir 下的增量状态；不存在、签名不一致或状态比本次 end_ts 更新（回补更早的时间点）时返回 None，
+    本次按全量计算并覆盖状态。
+    """
+    path = _state_path(args, signature)
+    if not path.exists():
+        return None
+    try:
+        state = pd.read_pickle(path)
+    except Exception as e:
+        print(f"[warn] 增量状态读取失败，按全量计算: {path}: {e}", file=sys.stderr)
+        return None
+    if state.get("signature") != signature or int(state.get("date_p", -1)) != int(args.date_p):
+        return None
+    if int(state["end_bucket"]) > int(end_bucket):
+        print(f"[warn] 增量状态已覆盖到比 end_ts 更晚的时间点，按全量计算: {path}", file=sys.stderr)
+        return None
+    return state
+
+
+def _save_cum_state(args, signature: str, state: dict) -> Path:
+    """原子写入增量状态（先写临时文件再 rename，避免中断后留下半个文件）。"""
+    path = _state_path(args, signature)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + f".tmp{os.getpid()}")
+    pd.to_pickle({**state, "signature": signature, "date_p": int(args.date_p)}, tmp)
+    os.replace(tmp, path)
+    return path
+
+
+def _leaf_state_from_detail(
+    df: pd.DataFrame, *, dim_cols: List[str], sum_fields: List[str], distinct_fields: List[str], time_col: str
+) -> dict:
+    """
+    明细 -> 叶子层增量状态（CUBE 的各组合都能由叶子层推出，因此只存叶子层）：
+    - sums：每个 (维度, 桶) 的 sum 指标增量
+    - first：每个 distinct 字段一张 (维度, key) -> 首次出现桶 的表（即该组合下已出现过的 key 集合）
+    """
+    gcols = dim_cols + [time_col]
+    if sum_fields:
+        sums = df.groupby(gcols, dropna=False, sort=False, observed=True, as_index=False)[sum_fields].sum()
+    else:
+        # 没有 sum 指标也保留出现过的 (维度, 桶)，保证只有无效 key 的维度组合仍然输出
+        sums = df[gcols].drop_duplicates()
+    first = {}
+    for f in distinct_fields:
+        sub = df.loc[_distinct_key_mask(df[f]), dim_cols + [f, time_col]]
+        first[f] = sub.groupby(dim_cols + [f], dropna=False, sort=False, observed=True, as_index=False)[time_col].min()
+    return {"sums": sums, "first": first}
+
+
+def _merge_leaf_state(*states: dict, dim_cols: List[str], time_col: str) -> dict:
+    """合并多份叶子层状态（一次 concat + groupby）：sum 增量按 (维度, 桶) 相加，key 首次出现桶取 min。"""
+    gcols = dim_cols + [time_col]
+    sums = pd.concat([x["sums"] for x in states], ignore_index=True)
+    sum_fields = [c for c in sums.columns if c not in gcols]
+    if sum_fields:
+        sums = sums.groupby(gcols, dropna=False, sort=False, observed=True, as_index=False)[sum_fields].sum()
+    else:
+        sums = sums.drop_duplicates()
+    first = {}
+    for f in set().union(*(x["first"] for x in states)):
+        parts = [x["first"][f] for x in states if f in x["first"]]
+        both = pd.concat(parts, ignore_index=True)
+        first[f] = both.groupby(dim_cols + [f], dropna=False, sort=False, observed=True, as_index=False)[time_col].min()
+    return {"sums": sums, "first": first}
+
+
+def _detail_from_leaf_state(
+    state: dict, *, dim_cols: List[str], sum_fields: List[str], distinct_fields: List[str], time_col: str
+) -> pd.DataFrame:
+    """
+    叶子层状态 -> 与原明细等价的紧凑明细：sum 增量行（distinct 键为空）+ 每个 distinct 字段的首次出现行（sum 为 0）。
+    空的 distinct 键会被 _distinct_key_mask 过滤，因此后续累计 / CUBE / 各引擎的计算结果与原明细一致。
+    """
+    parts = [state["sums"]]
+    for f in distinct_fields:
+        part = state["first"][f].copy()
+        for c in sum_fields:
+            part[c] = 0.0
+        parts.append(part)
+    out = pd.concat(parts, ignore_index=True)
+    for f in distinct_fields:
+        dtype = state["first"][f][f].dtype
+        out[f] = out[f].astype(dtype) if pd.api.types.is_extension_array_dtype(dtype) else out[f].astype(object)
+    for c in sum_fields:
+        out[c] = pd.to_numeric(out[c], errors="coerce").fillna(0)
+    out[time_col] = out[time_col].astype(np.int16)
+    return out[dim_cols + distinct_fields + sum_fields + [time_col]]
+
+
+def _truncate_cum_state(state: dict, bucket: int, *, time_col: str = "time_bucket") -> dict:
+    """把叶子层状态回退到 bucket 之前：丢弃 >= bucket 的 sum 增量与首次出现记录，之后从 bucket 起重新拉取合并。"""
+    sums = state["sums"]
+    first = {f: t[t[time_col] < bucket] for f, t in state["first"].items()}
+    return {
+        **state,
+        "sums": sums[sums[time_col] < bucket],
+        "first": first,
+        "end_bucket": min(int(state["end_bucket"]), int(bucket) - 1),
+    }
+
+
+def _build_bucket_fingerprint_hql(raw_hql: str, *, fields: List[str], engine: str) -> str:
+    """
+    明细SQL -> 每个10分钟桶的指纹（行数 + 行内容 crc32 之和），用于发现上次运行之后才落地的迟到数据。
+    Presto 与 Hive/SparkSql 的字符串函数不同，按 engine 生成；不同引擎得到的指纹不可互相比较。
+    """
+    if engine == "Presto":
+        cast_t = "varchar"
+        row_expr = "crc32(to_utf8(concat_ws('|', {})))"
+    else:
+        cast_t = "string"
+        row_expr = "crc32(concat_ws('|', {}))"
+    cols = ", ".join(f"coalesce(cast({f} as {cast_t}), 'null')" for f in fields)
+    tm_expr = f"concat(substr(cast(time_minute as {cast_t}),1,11),'0')"
+    inner = raw_hql.strip().rstrip(";").strip()
+    return (
+        f"select {tm_expr} as time_minute_10, count(1) as cnt, sum({row_expr.format(cols)}) as chk"
+        + "\nfrom (\n"
+        + inner
+        + "\n) fp\n"
+        + f"group by {tm_expr}"
+    )
+
+
+def _local_bucket_fingerprints(df: pd.DataFrame, *, fields: List[str], date_p: int) -> pd.DataFrame:
+    """本地明细的每桶指纹（time_bucket, cnt, chk），chk 为行哈希之和（按 2^64 回绕）。"""
+    cols = [c for c in fields if c in df.columns]
+    fp = pd.DataFrame({"time_bucket": _minute_to_bucket(df["time_minute"].to_numpy(), date_p)})
+    fp["chk"] = pd.util.hash_pandas_object(df[cols], index=False).to_numpy().view(np.int64)
+    return fp.groupby("time_bucket", as_index=False).agg(cnt=("chk", "size"), chk=("chk", "sum"))
+
+
+def _earliest_changed_bucket(prev_fp: pd.DataFrame, cur_fp: pd.DataFrame, end_bucket: int):
+    """对比上次记录与本次的每桶指纹（只看上次已覆盖的桶），返回最早发生变化的桶；都没变返回 None。"""
+    prev = prev_fp[prev_fp["time_bucket"] <= end_bucket]
+    cur = cur_fp[cur_fp["time_bucket"] <= end_bucket]
+    m = prev.merge(cur, on="time_bucket", how="outer", suffixes=("_prev", ""))
+    changed = (m["cnt_prev"] != m["cnt"]) | (m["chk_prev"] != m["chk"])
+    if not changed.any():
+        return None
+    return int(m.loc[changed, "time_bucket"].min())
+
+
+def _apply_late_arrivals(args, state: dict, cur_fp: pd.DataFrame):
+    """
+    --late-arrival-check：用本次指纹校验增量状态，从最早变化的桶起回退状态（见 _truncate_cum_state）。
+    状态里没有可比的指纹（首次开启、或上次用的拉取引擎不同）时回退整个状态，即全量重算。
+    """
+    if state is None:
+        return None
+    prev_fp = state.get("fingerprints")
+    if prev_fp is None or state.get("fingerprint_kind") != getattr(args, "_fingerprint_kind", None):
+        print("[warn] 增量状态中没有可比较的每桶指纹，本次全量重算", file=sys.stderr)
+        return None
+    bucket = _earliest_changed_bucket(prev_fp, cur_fp, int(state["end_bucket"]))
+    if bucket is None:
+        return state
+    minute = int(_bucket_to_minute([bucket], args.date_p)[0])
+    print(f"[warn] 检测到迟到数据：{minute} 起的桶与上次运行不一致，从该桶开始重算", file=sys.stderr)
+    return _truncate_cum_state(state, bucket)
+
+
+def _state_resume_minute(state: dict, date_p: int) -> int:
+    """
+    增量状态下次拉取的起点：只取 time_minute 大于它的明细。
+    状态只记录已完整覆盖的桶（end_ts 所在桶当时可能还在落数，不算覆盖，见 _covered_cum_state），
+    因此起点就是第一个未覆盖桶之前的最后一分钟。
+    """
+    return int(_bucket_to_minute([int(state["end_bucket"])], date_p)[0]) + 9
+
+
+def _covered_cum_state(leaf: dict, end_bucket: int) -> dict:
+    """
+    本次运行结束后要保存的状态：end_ts 所在桶（滚动调度下仍在落数）不算已覆盖，
+    其 sum 增量与首次出现记录都不保存，下次从该桶起重新拉取合并。
+    """
+    state = _truncate_cum_state({**leaf, "end_bucket": int(end_bucket)}, int(end_bucket))
+    # 已输出到的时间点（--dw-mode append 只追加其后的时间点）
+    state["output_end_bucket"] = int(end_bucket)
+    return state
+
+
+def _sorted_contains(sorted_arr: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """values 中每个值是否出现在升序数组 sorted_arr 里（二分查找，只随 values 的个数增长）。"""
+    if len(sorted_arr) == 0 or len(values) == 0:
+        return np.zeros(len(values), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_arr, values), len(sorted_arr) - 1)
+    return sorted_arr[pos] == values
+
+
+def _incremental_cube_cum(
+    leaf: dict,
+    cube_state: dict,
+    *,
+    dim_cols: List[str],
+    sum_fields: List[str],
+    distinct_fields: List[str],
+    output_names: dict,
+    masks: List[int],
+    no_cube: bool,
+    spine: np.ndarray,
+    covered: int,
+    time_col: str = "time_bucket",
+):
+    """
+    --state-dir + --dw-mode append 的增量累计 + CUBE：只计算 spine 上的新桶。
+
+    cube_state 为上次保存的各维度组合状态（None 表示从空状态开始，此时 leaf 为全部叶子层）：
+    - totals：每个 (mask, 组合) 在 bucket 桶的累计值（sum 与 distinct 个数）
+    - seen：每个 distinct 字段、每个 mask 截至 bucket 已出现的 (组合维度, key) 的 64 位哈希（升序数组）
+    leaf 只含 bucket 之后的叶子层增量；各 mask 的 sum 增量与 (组合, key) 首次出现从叶子层逐层派生
+    （见 _walk_cube_lattice），首次出现再剔除 seen 中已有的 key，得到新增数；
+    上次的累计值作为起点增量并入第一个输出桶，一次 scatter + cumsum 得到新桶的累计（见 _dense_cum_kernel）。
+    多个 mask 落到同一组维度取值（原始维度值本身就是“整体”）时，sum 相加、distinct 取 max（与 engine=dense 一致）。
+
+    返回 (稠密累计表, covered 桶的新状态)；covered 不在 spine 上且没有前进时沿用旧状态，否则返回 None（下次全量）。
+    """
+    n = len(dim_cols)
+    sum_out = [output_names.get(f, f) for f in sum_fields]
+    dist_out = [output_names.get(f, f) for f in distinct_fields]
+    value_cols = sum_out + dist_out
+    # 输出哪些组合与全量计算一致：有 sum 指标或不做 CUBE 时是全部出现过的组合，否则只有出现过有效 key 的组合
+    all_groups = bool(sum_fields) or no_cube
+
+    def keep_dims(mask: int) -> List[str]:
+        return [dim_cols[j] for j in range(n) if not (mask & (1 << j))]
+
+    def rollup(parent_df: pd.DataFrame, mask: int, by: List[str], cols: List[str], how: str) -> pd.DataFrame:
+        if cols:
+            g = parent_df.groupby(keep_dims(mask) + by, dropna=False, sort=False, observed=True, as_index=False)
+            agg = getattr(g[cols], how)()
+        else:
+            agg = parent_df[keep_dims(mask) + by].drop_duplicates()
+        for j, col in enumerate(dim_cols):
+            if mask & (1 << j):
+                agg[col] = "整体"
+        return agg[dim_cols + by + cols]
+
+    parts = []
+    if cube_state is not None:
+        parts.append(cube_state["totals"].assign(**{time_col: cube_state["bucket"]}))
+
+    if all_groups:
+        sums = leaf["sums"].rename(columns=dict(zip(sum_fields, sum_out)))
+
+        def emit_sum(mask: int, frame: pd.DataFrame):
+            parts.append(frame.assign(__mask=mask))
+
+        _walk_cube_lattice(
+            n,
+            sums[dim_cols + [time_col] + sum_out],
+            lambda p, m: rollup(p, m, [time_col], sum_out, "sum"),
+            emit_sum,
+            masks=masks,
+        )
+
+    seen_next = {}
+    for f, o in zip(distinct_fields, dist_out):
+        seen = cube_state["seen"][f] if cube_state is not None else {}
+        seen_next[f] = {}
+
+        def emit_first(mask: int, frame: pd.DataFrame, f=f, o=o, seen=seen):
+            old = seen.get(mask, np.zeros(0, dtype=np.uint64))
+            h = pd.util.hash_pandas_object(frame[keep_dims(mask) + [f]], index=False).to_numpy()
+            is_new = ~_sorted_contains(old, h)
+            new = frame[is_new]
+            counts = new.groupby(dim_cols + [time_col], dropna=False, sort=False, observed=True).size()
+            parts.append(counts.reset_index(name=o).assign(__mask=mask))
+            # frame 按 (组合, key) 唯一，哈希无需再去重，排序后插入即可
+            add = np.sort(h[is_new][new[time_col].to_numpy() <= covered])
+            seen_next[f][mask] = np.insert(old, np.searchsorted(old, add), add)
+
+        _walk_cube_lattice(
+            n,
+            leaf["first"][f][dim_cols + [f, time_col]],
+            lambda p, m, f=f: rollup(p, m, [f], [time_col], "min"),
+            emit_first,
+            masks=masks,
+        )
+
+    parts = [p for p in parts if len(p)]
+    if parts:
+        inc = pd.concat(parts, ignore_index=True)
+    else:
+        inc = pd.DataFrame(columns=dim_cols + ["__mask", time_col])
+    for c in value_cols:
+        inc[c] = np.nan_to_num(pd.to_numeric(inc[c], errors="coerce").to_numpy(dtype=np.float64)) if c in inc else 0.0
+    bidx = _spine_bucket_index(inc[time_col].to_numpy(dtype=np.int64), spine) if len(inc) else np.zeros(0, np.int64)
+    keep = bidx >= 0
+    inc, bidx = inc[keep], bidx[keep]
+    gid, dims_tab = _factorize_dims(inc, dim_cols + ["__mask"])
+    arr = _dense_cum_kernel(gid, bidx, inc[value_cols].to_numpy(dtype=np.float64), len(dims_tab), len(spine))
+
+    if covered >= spine[0]:
+        j = int(np.searchsorted(spine, covered))
+        totals = dims_tab.reset_index(drop=True)
+        for k, c in enumerate(value_cols):
+            totals[c] = arr[:, j, k]
+        next_state = {"bucket": int(covered), "totals": totals, "seen": seen_next}
+    elif cube_state is not None and covered == int(cube_state["bucket"]):
+        next_state = cube_state
+    else:
+        next_state = None
+
+    out = _emit_dense_frame(arr, dims_tab, dim_cols, spine, time_col, value_cols)
+    if dims_tab[dim_cols].duplicated().any():
+        agg = {**{c: "sum" for c in sum_out}, **{c: "max" for c in dist_out}}
+        out = out.groupby(dim_cols + [time_col], dropna=False, sort=False, observed=True, as_index=False).agg(agg)
+    out[time_col] = out[time_col].astype(np.int16)
+    return out[dim_cols + [time_col] + value_cols], next_state
+
+
+def _build_incremental_hql(hql: str, *, fields: List[str], after_minute: int) -> str:
+    """拉取SQL外包一层时间过滤，只取 time_minute > after_minute（上一次状态覆盖到的最后一分钟）的明细。"""
+    inner = hql.strip().rstrip(";").strip()
+    return (
+        "select "
+        + ", ".join(fields)
+        + "\nfrom (\n"
+        + inner
+        + "\n) inc\n"
+        + f"where cast(time_minute as bigint) > {int(after_minute)}"
+    )
+
+
+def _pull_time_slices(date_p: int, end_ts: int, slice_minutes: int, after_minute: int = None) -> List[tuple]:
+    """
+    --dw-pull-slice-minutes 的时间分片：从当天 0 点（或 after_minute 之后）到 end_ts 每 slice_minutes 一片，
+    返回 [(lo, hi), ...]（time_minute >= lo 且 < hi）。首片不设下界、末片不设上界，保证分片并集与原SQL一致。
+    """
+    if slice_minutes <= 0 or slice_minutes % 10:
+        raise ValueError(f"--dw-pull-slice-minutes 需要是 10 的正整数倍: {slice_minutes}")
+    start = datetime.strptime(f"{int(date_p)}0000", "%Y%m%d%H%M")
+    if after_minute is not None:
+        start = datetime.strptime(str(int(after_minute)), "%Y%m%d%H%M") + timedelta(minutes=1)
+    end = datetime.strptime(str(floor_10m(int(end_ts))), "%Y%m%d%H%M")
+    cuts = []
+    cur = start + timedelta(minutes=slice_minutes)
+    while cur <= end:
+        cuts.append(int(cur.strftime("%Y%m%d%H%M")))
+        cur += timedelta(minutes=slice_minutes)
+    bounds = [None] + cuts + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _build_time_slice_hql(hql: str, *, fields: List[str], lo_minute: int = None, hi_minute: int = None) -> str:
+    """拉取SQL外包一层时间分片过滤：time_minute >= lo_minute 且 < hi_minute（None 表示该侧不限）。"""
+    conds = []
+    if lo_minute is not None:
+        conds.append(f"cast(time_minute as bigint) >= {int(lo_minute)}")
+    if hi_minute is not None:
+        conds.append(f"cast(time_minute as bigint) < {int(hi_minute)}")
+    if not conds:
+        return hql
+    inner = hql.strip().rstrip(";").strip()
+    return "select " + ", ".join(fields) + "\nfrom (\n" + inner + "\n) sl\nwhere " + " and ".join(conds)
+
+
+def _check_query_to_local_size(args, nbytes: int):
+    max_bytes = int(getattr(args, "dw_query_to_local_max_bytes", 0) or 0)
+    if max_bytes > 0 and nbytes > max_bytes:
+        raise RuntimeError(
+            f"query_to_local 落地文件过大（{nbytes} bytes > {max_bytes} bytes）；"
+            f"请改用 --dw-compute-mode sparksql 在集群侧计算写入，或显式关闭限制。"
+        )
+
+
+def _pull_query_to_local_parallel(args, hqls: List[str], *, out_prefix: Path):
+    """
+    多条拉取SQL的 query_to_local 在线程池（--dw-pull-workers）中并发执行（每条各自做引擎回退与重试），
+    按完成先后产出 (序号, 落地文件)，调用方可边拉边解析。任一条最终失败时取消未开始的部分并抛出。
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    workers = max(1, int(getattr(args, "dw_pull_workers", 4) or 1))
+    retries = int(getattr(args, "dw_pull_retries", 0) or 0)
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(hqls))))
+    ok = False
+    try:
+        futures = {}
+        for i, hql in enumerate(hqls):
+            path = Path(f"{out_prefix}_s{i:03d}.txt")
+            args._tmp_paths.append(path)
+            futures[pool.submit(_run_datawork_query_to_local, args, hql, path, retries=retries)] = (i, path)
+        total = 0
+        for fut in as_completed(futures):
+            fut.result()
+            i, path = futures[fut]
+            total += path.stat().st_size if path.exists() else 0
+            _check_query_to_local_size(args, total)
+            yield i, path
+        ok = True
+    finally:
+        pool.shutdown(wait=ok, cancel_futures=not ok)
+
+
+def _pull_query_to_local_sliced(args, hql: str, *, fields: List[str], slices: List[tuple], out_prefix: Path):
+    """按时间分片（见 _pull_time_slices）并发拉取同一条SQL，产出同 _pull_query_to_local_parallel。"""
+    hqls = [_build_time_slice_hql(hql, fields=fields, lo_minute=lo, hi_minute=hi) for lo, hi in slices]
+    return _pull_query_to_local_parallel(args, hqls, out_prefix=out_prefix)
+
+
 def main():
     """主函数：执行累计统计计算"""
     args = parse_args()
@@ -2735,10 +5478,42 @@ def main():
         prof.start("parse_select")
         fields, metric_rules, output_names, computed = parse_select_fields(sql_text)
         prof.end("parse_select", extra=f"fields={len(fields)} metrics={len(metric_rules)}")
+        gs_spec = getattr(args, "grouping_sets", None) or extract_grouping_sets(sql_text)
+        grouping_sets = parse_grouping_sets(gs_spec) if gs_spec else None
+        if grouping_sets:
+            # 各计算模式（sparksql/localspark/duckdb/pandas）共用的维度口径：SELECT 中的非指标非时间字段
+            time_cols = {"time_hour", "time_minute", "date_p", "date_minute", "time_minute_10"}
+            _check_grouping_sets(grouping_sets, [c for c in fields if c not in metric_rules and c not in time_cols])
         if args.dw_table and _resolve_dw_kind(args) == "datawork-client" and not args.dw_anchor_table:
             args.dw_anchor_table = extract_from_table(sql_text)
 
+        # --state-dir：读取上一次运行的叶子层状态，本次只需处理其后的明细
+        state_sig, state = None, None
+        if getattr(args, "state_dir", None):
+            state_sig = _state_signature(args, sql_text)
+            state = _load_cum_state(args, state_sig, int(_minute_to_bucket([args.end_ts], args.date_p)[0]))
+            if state is not None:
+                prof.info(f"增量状态: 已覆盖到桶 {int(state['end_bucket'])}，本次只处理其后的明细")
+        late_check = bool(getattr(args, "late_arrival_check", False))
+        if late_check and state_sig is None:
+            print("[warn] --late-arrival-check 需要配合 --state-dir，已忽略", file=sys.stderr)
+            late_check = False
+        if late_check and args.dw_mode != "overwrite":
+            print("[warn] --late-arrival-check 需要 --dw-mode overwrite（重算的时间点要覆盖旧值），已忽略", file=sys.stderr)
+            late_check = False
+        cur_fp = None
+        pushdown_hqls = None
+        local_paths = None
+        # --late-arrival-check：只重写该时间点之后；prev_slice_files 为上次 spark 分片写入的文件清单
+        rewrite_from, prev_slice_files = None, None
+        stream_rows = int(getattr(args, "stream_chunk_rows", 0) or 0)
+        if stream_rows > 0 and args.source == "excel":
+            print("[warn] --stream-chunk-rows 只作用于 source=datawork 的 query_to_local 文件，Excel 仍整表读入", file=sys.stderr)
+            stream_rows = 0
+
         if args.source == "excel":
+            if getattr(args, "dw_compute_mode", "pandas") == "localspark":
+                raise ValueError("dw-compute-mode=localspark 仅支持 source=datawork（读取 query_to_local 落地文件）")
             if not args.input:
                 raise ValueError("source=excel 时必须提供 --input")
             prof.start("read_excel")
@@ -2759,12 +5534,64 @@ def main():
             # - sparksql 模式：由 _build_sparksql_cum_cube_insert 以 CTE 方式展开（避免 OneSQL 解析不支持子查询）
             if compute_mode == "sparksql":
                 hql = hql_raw
+                if getattr(args, "output_mode", "dense") == "changes":
+                    print("[warn] --output-mode changes 仅作用于本地（pandas）计算，sparksql 模式仍输出完整网格", file=sys.stderr)
+                if getattr(args, "granularities", None):
+                    print("[warn] --granularities 仅作用于本地（pandas）计算，sparksql 模式只输出 10 分钟", file=sys.stderr)
+                if getattr(args, "dw_pushdown_first_seen", False):
+                    print("[warn] --dw-pushdown-first-seen 只作用于 query_to_local 拉取，sparksql 模式已忽略", file=sys.stderr)
+                if state_sig is not None:
+                    print("[warn] --state-dir 仅作用于本地（pandas）计算，sparksql 模式仍按全天计算", file=sys.stderr)
+                    state_sig, state, late_check = None, None, False
             else:
+                if compute_mode == "localspark":
+                    if not args.dw_table:
+                        raise ValueError("dw-compute-mode=localspark 需要指定 --output_table/--dw-table")
+                    if getattr(args, "output", None):
+                        print("[warn] dw-compute-mode=localspark 直接写表，不输出 Excel（--output 已忽略）", file=sys.stderr)
+                    if getattr(args, "output_mode", "dense") == "changes":
+                        print("[warn] --output-mode changes 仅作用于本地（pandas）计算，localspark 模式仍输出完整网格", file=sys.stderr)
+                    if getattr(args, "granularities", None):
+                        print("[warn] --granularities 仅作用于本地（pandas）计算，localspark 模式只输出 10 分钟", file=sys.stderr)
+                    if state_sig is not None:
+                        print("[warn] --state-dir 仅作用于本地（pandas）计算，localspark 模式仍按全天计算", file=sys.stderr)
+                        state_sig, state, late_check = None, None, False
                 hql = (
                     _build_preagg_hql(hql_raw, fields=fields, metric_rules=metric_rules)
                     if getattr(args, "dw_preagg", True)
                     else hql_raw
                 )
+                if late_check and "time_minute" in fields:
+                    fp_path = Path(args.dw_tmp_dir) / f"cum10m_fingerprint_{args.date_p}_{int(time.time() * 1000)}.txt"
+                    args._tmp_paths.append(fp_path)
+                    prof.start("query_fingerprints")
+                    fp_hql = _build_bucket_fingerprint_hql(hql_raw, fields=fields, engine=args.dw_query_engine)
+                    _run_datawork_query_to_local(args, fp_hql, fp_path)
+                    fp_raw = _read_datawork_query_to_local_file(fp_path, ["time_minute_10", "cnt", "chk"])
+                    fp_min = pd.to_numeric(fp_raw["time_minute_10"], errors="coerce")
+                    fp_raw = fp_raw[fp_min.notna()]
+                    cur_fp = pd.DataFrame(
+                        {
+                            "time_bucket": _minute_to_bucket(fp_min.dropna().astype("int64").to_numpy(), args.date_p),
+                            "cnt": pd.to_numeric(fp_raw["cnt"], errors="coerce").fillna(0).astype("int64").to_numpy(),
+                            "chk": pd.to_numeric(fp_raw["chk"], errors="coerce").fillna(0).astype("int64").to_numpy(),
+                        }
+                    )
+                    args._fingerprint_kind = f"datawork:{args.dw_query_engine}"
+                    prof.end("query_fingerprints", rows=len(cur_fp))
+                    state = _apply_late_arrivals(args, state, cur_fp)
+                if getattr(args, "dw_pushdown_first_seen", False):
+                    pushdown_hqls = _build_first_seen_pushdown_hqls(
+                        hql_raw, fields=fields, metric_rules=metric_rules, end_ts=args.end_ts
+                    )
+                if state is not None and "time_minute" in fields:
+                    after_minute = _state_resume_minute(state, args.date_p)
+                    hql = _build_incremental_hql(hql, fields=fields, after_minute=after_minute)
+                    if pushdown_hqls:
+                        # 首次出现晚于状态的 key 才是新增；更早出现过的已在状态里，合并时取 min 结果不变
+                        pushdown_hqls = [
+                            _build_incremental_hql(q, fields=fields, after_minute=after_minute) for q in pushdown_hqls
+                        ]
 
             if compute_mode == "sparksql":
                 if not args.dw_table:
@@ -2785,6 +5612,9 @@ def main():
                     schema_info=schema_info,
                     no_cube=bool(args.no_cube),
                     preagg=bool(getattr(args, "dw_preagg", True)),
+                    grouping_sets=grouping_sets,
+                    distinct_mode=getattr(args, "distinct_mode", "exact"),
+                    hll_precision=int(getattr(args, "hll_precision", 12) or 12),
                 )
                 prof.start("compute_sparksql")
                 _run_datawork_execute_sql_file(args, insert_sql, engine=args.dw_compute_engine)
@@ -2793,95 +5623,118 @@ def main():
                 ok = True
                 return
 
+            # duckdb 模式直接扫描落地文件，不整表读进 pandas（--state-dir/--stream-chunk-rows 需要 pandas 侧的叶子层状态，仍按原流程）
+            duck_direct = compute_mode == "duckdb" and state_sig is None and stream_rows <= 0 and "time_minute" in fields
             tmp_dir = Path(args.dw_tmp_dir)
             tmp_dir.mkdir(parents=True, exist_ok=True)
             stamp = int(time.time() * 1000)
             out_path = tmp_dir / f"cum10m_source_{args.date_p}_{stamp}.txt"
-            args._tmp_paths.append(out_path)
-            prof.start("query_to_local")
-            _run_datawork_query_to_local(args, hql, out_path)
-            try:
-                sz = out_path.stat().st_size
-            except Exception:
-                sz = None
-            max_bytes = int(getattr(args, "dw_query_to_local_max_bytes", 0) or 0)
-            if (sz is not None) and max_bytes > 0 and sz > max_bytes:
-                raise RuntimeError(
-                    f"query_to_local 落地文件过大（{sz} bytes > {max_bytes} bytes）；"
-                    f"请改用 --dw-compute-mode sparksql 在集群侧计算写入，或显式关闭限制。"
+            slice_minutes = int(getattr(args, "dw_pull_slice_minutes", 0) or 0)
+            pull_hqls = None
+            if slice_minutes > 0 and "time_minute" in fields:
+                # --dw-pull-slice-minutes：按时间分片并发拉取，完成一片解析一片（流式模式下直接边拉边归约）
+                slices = _pull_time_slices(
+                    args.date_p,
+                    args.end_ts,
+                    slice_minutes,
+                    # 与增量拉取同一个起点：end_ts 所在桶不算已覆盖，从该桶起重新拉取（见 _state_resume_minute）
+                    after_minute=(_state_resume_minute(state, args.date_p) if state is not None else None),
                 )
-            prof.end(
-                "query_to_local",
-                extra=(f"file={out_path} bytes={sz}" if sz is not None else f"file={out_path}"),
-            )
-            prof.start("read_local_file")
-            df = _read_datawork_query_to_local_file(out_path, fields)
-            prof.end("read_local_file", rows=len(df))
-
-        df.columns = [str(c).strip() for c in df.columns]
+                # 下推首次出现时只切 sum 查询；min(桶) 查询按时间切分会让每片都重新全量分组，不切
+                head = pushdown_hqls[0] if pushdown_hqls else hql
+                pull_hqls = [_build_time_slice_hql(head, fields=fields, lo_minute=lo, hi_minute=hi) for lo, hi in slices]
+                pull_hqls += (pushdown_hqls or [])[1:]
+            elif pushdown_hqls:
+                pull_hqls = pushdown_hqls
+            if pull_hqls:
+                prof.info(f"明细拉取分 {len(pull_hqls)} 条并发执行（workers={getattr(args, 'dw_pull_workers', 4)}）")
+                pulled = _pull_query_to_local_parallel(
+                    args, pull_hqls, out_prefix=tmp_dir / f"cum10m_source_{args.date_p}_{stamp}"
+                )
+                if compute_mode == "localspark" or duck_direct:
+                    prof.start("query_to_local")
+                    pull_paths = [p for _, p in sorted(pulled)]
+                    prof.end("query_to_local", extra=f"queries={len(pull_hqls)}")
+                elif stream_rows > 0:
+                    pull_paths = (p for _, p in pulled)
+                else:
+                    prof.start("query_to_local_and_read")
+                    parts = dict((i, _read_datawork_query_to_local_file(p, fields)) for i, p in pulled)
+                    df = pd.concat([parts[i] for i in sorted(parts)], ignore_index=True)
+                    prof.end("query_to_local_and_read", rows=len(df), extra=f"queries={len(pull_hqls)}")
+            else:
+                args._tmp_paths.append(out_path)
+                prof.start("query_to_local")
+                _run_datawork_query_to_local(args, hql, out_path, retries=int(getattr(args, "dw_pull_retries", 0) or 0))
+                try:
+                    sz = out_path.stat().st_size
+                except Exception:
+                    sz = None
+                if sz is not None:
+                    _check_query_to_local_size(args, sz)
+                prof.end(
+                    "query_to_local",
+                    extra=(f"file={out_path} bytes={sz}" if sz is not None else f"file={out_path}"),
+                )
+                pull_paths = [out_path]
+                if compute_mode != "localspark" and stream_rows <= 0 and not duck_direct:
+                    prof.start("read_local_file")
+                    df = _read_datawork_query_to_local_file(out_path, fields)
+                    prof.end("read_local_file", rows=len(df))
+            if compute_mode == "localspark":
+                _compute_cum_cube_localspark(
+                    args,
+                    pull_paths,
+                    fields=fields,
+                    metric_rules=metric_rules,
+                    output_names=output_names,
+                    grouping_sets=grouping_sets,
+                )
+                ok = True
+                return
+            if stream_rows > 0:
+                df = None
+            elif duck_direct:
+                local_paths = pull_paths
 
         if not fields:
             raise ValueError("SQL SELECT 字段列表为空")
         if not metric_rules:
             raise ValueError("未在SQL注释中识别到任何指标聚合规则（distinct/sum）")
-
-        # 处理本地可计算的表达式列（目前仅支持COALESCE；如果已在输入中存在同名列则跳过）
-        for out_col, rule in computed.items():
-            if out_col in df.columns:
-                continue
-            if rule.get("op") == "coalesce":
-                cols = [c for c in (rule.get("cols") or []) if c]
-                missing = [c for c in cols if c not in df.columns]
-                if missing:
-                    raise ValueError(f"COALESCE生成列 {out_col} 缺少输入列: {missing}")
-                s = df[cols[0]]
-                for c in cols[1:]:
-                    s = s.where(s.notna(), df[c])
-                df[out_col] = s
-
-        # 校验：维度/指标字段必须存在（时间字段允许缺省，除time_minute外）
-        metric_fields = [f for f in fields if f in metric_rules]
+        metric_cols = [f for f in fields if f in metric_rules]
         time_cols = {"time_hour", "time_minute", "date_p", "date_minute", "time_minute_10"}
-        missing_metrics = [f for f in metric_fields if f not in df.columns]
-        missing_dims = [f for f in fields if f not in metric_rules and f not in time_cols and f not in df.columns]
-        if missing_metrics or missing_dims:
-            msg_parts = []
-            if missing_metrics:
-                msg_parts.append(f"缺少指标列: {missing_metrics}")
-            if missing_dims:
-                msg_parts.append(f"缺少维度列: {missing_dims}")
-            raise ValueError("输入数据列不完整，" + "；".join(msg_parts))
-
-        # 只保留SQL中指定的字段
-        use_cols = [c for c in fields if c in df.columns]
-        if not use_cols:
-            raise ValueError("输入数据中未找到SELECT字段")
-        df = df[use_cols]
-
-        # 标准化time_minute列（处理可能的浮点数格式）
-        if "time_minute" not in df.columns:
-            raise ValueError("输入数据必须包含time_minute列")
-        # 将time_minute转换为整数（移除小数部分）
-        df["time_minute"] = pd.to_numeric(
-            df["time_minute"].astype(str).str.replace(r"\..*$", "", regex=True), errors="coerce"
-        )
-        df = df.dropna(subset=["time_minute"])
-        df["time_minute"] = df["time_minute"].astype("int64")
-
-        # 过滤date_p（如果存在）
-        if "date_p" in df.columns:
-            df["date_p"] = pd.to_numeric(df["date_p"], errors="coerce")
-            df = df[df["date_p"] == args.date_p]
-
-        # 先计算time_minute_10，然后按time_minute_10过滤，而不是按time_minute过滤
-        # 这很重要，因为累计计算使用的是time_minute_10，而不是time_minute
-        # 向下取整到10分钟（向量化，避免逐行 datetime 解析）
-        df["time_minute_10"] = (df["time_minute"] - (df["time_minute"] % 10)).astype("int64")
-
-        # 对于累计计算，我们需要从当天开始到end_ts的所有数据（按time_minute_10计算）
-        # start_ts和end_ts仅用于确定输出的时间轴范围
-        end_ts_10 = floor_10m(args.end_ts)
-        df = df[df["time_minute_10"] <= end_ts_10]
+        start_bucket = int(_minute_to_bucket([args.start_ts], args.date_p)[0])
+        end_bucket = int(_minute_to_bucket([args.end_ts], args.date_p)[0])
+        prep_kw = dict(fields=fields, metric_rules=metric_rules, end_bucket=end_bucket)
+
+        stream_leaf = None
+        if local_paths is not None:
+            # 明细留在落地文件里，由 DuckDB 直接读取并清洗（见 _compute_cum_cube_duckdb），这里只保留空表结构
+            df = pd.DataFrame({c: pd.Series(dtype=object) for c in fields})
+        elif df is None:
+            # --stream-chunk-rows：逐块预处理并归约到叶子层状态（见 _stream_reduce_query_to_local），不保留完整明细
+            prof.start("stream_reduce")
+            df, stream_leaf, n_raw = _stream_reduce_query_to_local(
+                pull_paths,
+                args,
+                computed=computed,
+                chunk_rows=stream_rows,
+                after_bucket=(int(state["end_bucket"]) if state is not None else None),
+                **prep_kw,
+            )
+            prof.end("stream_reduce", rows=len(df), extra=f"raw_rows={n_raw} chunk_rows={stream_rows}")
+            use_cols = [c for c in fields if c in df.columns]
+        else:
+            df = _clean_detail_frame(df, args, fields=fields, metric_rules=metric_rules, computed=computed)
+            use_cols = list(df.columns)
+
+            # --late-arrival-check（本地来源）：明细已全部读入，直接在本地算每桶指纹
+            if late_check and cur_fp is None:
+                cur_fp = _local_bucket_fingerprints(df, fields=use_cols, date_p=args.date_p)
+                args._fingerprint_kind = "local"
+                state = _apply_late_arrivals(args, state, cur_fp)
+
+            df = _bucket_detail_frame(df, args, prof=prof, **prep_kw)
         if getattr(args, "profile", False):
             try:
                 mem_mb = df.memory_usage(deep=True).sum() / 1024 / 1024
@@ -2889,112 +5742,354 @@ def main():
             except Exception:
                 prof.info(f"预处理后 df 行数={len(df)}")
 
-        # 指标字段（按SELECT顺序）
-        metric_cols = [f for f in fields if f in metric_rules]
-        # 确保sum类指标是数值类型（避免object字符串sum变成拼接）
-        for c in metric_cols:
-            if metric_rules.get(c) == "sum" and c in df.columns:
-                df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
-
         # 维度列 = SELECT字段中排除指标列和时间列
         dim_cols = [c for c in fields if c not in metric_cols and c not in time_cols]
         dim_cols = [c for c in dim_cols if c in df.columns]
 
-        # 维度值标准化（含 func_name 特殊规则）
-        df = _normalize_dim_values(df, dim_cols)
+        # --state-dir：本次明细（已去掉状态覆盖过的桶）并入叶子层状态，再展开成等价的紧凑明细继续计算
+        inc_out = None
+        if state_sig is not None:
+            prof.start("apply_state")
+            st_sum = [f for f in metric_cols if metric_rules.get(f) == "sum" and f in df.columns]
+            st_dist = [f for f in metric_cols if metric_rules.get(f) == "distinct" and f in df.columns]
+            st_kw = dict(dim_cols=dim_cols, time_col="time_bucket")
+            if state is not None:
+                df = df[df["time_bucket"] > int(state["end_bucket"])]
+            new_rows = len(df)
+            delta = (
+                stream_leaf
+                if stream_leaf is not None
+                else _leaf_state_from_detail(df, sum_fields=st_sum, distinct_fields=st_dist, **st_kw)
+            )
+            leaf = _merge_leaf_state(state, delta, **st_kw) if state is not None else delta
+            new_state = _covered_cum_state(leaf, end_bucket)
+            if late_check:
+                new_state["fingerprints"] = cur_fp[cur_fp["time_bucket"] <= end_bucket].reset_index(drop=True)
+                new_state["fingerprint_kind"] = getattr(args, "_fingerprint_kind", None)
+                # 只重写状态之后（含迟到数据回退到的桶）的时间点
+                prev_slice_files = (state or {}).get("slice_files") or {}
+                rewrite_from = (
+                    int(_bucket_to_minute([int(state["end_bucket"]) + 1], args.date_p)[0]) if state is not None else None
+                )
+            # --dw-mode append 只输出新的时间点：各维度组合的累计值与已出现 key 也存进状态，
+            # 只计算上次之后的桶（见 _incremental_cube_cum）；overwrite 要重写全天，仍展开叶子层全量重算
+            inc_cube = (
+                args.dw_mode == "append"
+                and bool(dim_cols)
+                and getattr(args, "distinct_mode", "exact") == "exact"
+                and getattr(args, "dw_compute_mode", "pandas") != "duckdb"
+            )
+            if inc_cube:
+                if args.no_cube:
+                    cube_masks = [0]
+                elif grouping_sets:
+                    cube_masks = _grouping_sets_to_masks(grouping_sets, dim_cols)
+                else:
+                    cube_masks = list(range(1 << len(dim_cols)))
+                cube_meta = dict(
+                    dims=dim_cols,
+                    masks=cube_masks,
+                    no_cube=bool(args.no_cube),
+                    sum=st_sum,
+                    distinct=st_dist,
+                    names=[output_names.get(f, f) for f in metric_cols],
+                )
+                prev_cube = (state or {}).get("cube")
+                if prev_cube is not None and (
+                    prev_cube.get("meta") != cube_meta or int(prev_cube["bucket"]) != int(state["end_bucket"])
+                ):
+                    prev_cube = None
+                lo = start_bucket if prev_cube is None else max(start_bucket, int(prev_cube["bucket"]) + 1)
+                inc_out, cube_state = _incremental_cube_cum(
+                    leaf if prev_cube is None else delta,
+                    prev_cube,
+                    dim_cols=dim_cols,
+                    sum_fields=st_sum,
+                    distinct_fields=st_dist,
+                    output_names=output_names,
+                    masks=cube_masks,
+                    no_cube=bool(args.no_cube),
+                    spine=np.arange(lo, end_bucket + 1, dtype=np.int64),
+                    covered=end_bucket - 1,
+                    time_col="time_bucket",
+                )
+                for f in metric_cols:
+                    if output_names.get(f, f) not in inc_out.columns:
+                        inc_out[output_names.get(f, f)] = 0
+                if args.no_cube:
+                    inc_out = inc_out[dim_cols + ["time_bucket"] + [output_names.get(f, f) for f in metric_cols]]
+                if cube_state is not None:
+                    new_state["cube"] = {**cube_state, "meta": cube_meta}
+                prof.end(
+                    "apply_state",
+                    rows=len(inc_out),
+                    extra=f"new_rows={new_rows} incremental_from={lo if prev_cube is not None else None}",
+                )
+            else:
+                df = _detail_from_leaf_state(leaf, sum_fields=st_sum, distinct_fields=st_dist, **st_kw)
+                prof.end("apply_state", rows=len(df), extra=f"new_rows={new_rows}")
 
-        # 生成时间轴（10分钟间隔）
-        start_dt = datetime.strptime(str(args.start_ts), "%Y%m%d%H%M")
-        end_dt = datetime.strptime(str(args.end_ts), "%Y%m%d%H%M")
-        # 将开始和结束时间向下取整到10分钟
-        start_dt = start_dt.replace(minute=(start_dt.minute // 10) * 10, second=0, microsecond=0)
-        end_dt = end_dt.replace(minute=(end_dt.minute // 10) * 10, second=0, microsecond=0)
-        spine = pd.date_range(start=start_dt, end=end_dt, freq="10min")
-        spine_df = pd.DataFrame({"time_minute_10": spine.strftime("%Y%m%d%H%M").astype(int)})
+        # 生成时间轴（10分钟桶下标，start/end 已向下取整到10分钟）
+        spine_df = pd.DataFrame({"time_bucket": np.arange(start_bucket, end_bucket + 1, dtype=np.int16)})
+
+        # --distinct-mode hll：distinct 指标改为 HyperLogLog 近似（见 _cube_hll_cum）
+        hll = getattr(args, "distinct_mode", "exact") == "hll"
+        hll_precision = int(getattr(args, "hll_precision", 12) or 12)
+        granularities = _parse_granularities(getattr(args, "granularities", None))
+        if state is not None and args.dw_mode == "append" and any(g != 10 for g in granularities):
+            print("[warn] --dw-mode append 的增量输出下，跨越上次 end_ts 的粗粒度时间点不会被更新", file=sys.stderr)
+        # --output-mode changes：只输出有指标变化的行（还原见 densify_change_only）
+        output_mode = getattr(args, "output_mode", "dense")
 
         # 累计计算
-        if len(df) == 0:
-            cum = pd.DataFrame(columns=(dim_cols + ["time_minute_10"] + [output_names.get(f, f) for f in metric_cols]))
-            cum = spine_df.merge(cum, on="time_minute_10", how="left") if not dim_cols else cum
+        # --cube-over-increments：sum CUBE 直接基于明细增量、distinct CUBE 基于明细，叶子层稠密累计表用不到
+        over_inc = (
+            bool(getattr(args, "cube_over_increments", False))
+            and (not args.no_cube)
+            and any(metric_rules.get(f) in ("sum", "distinct") for f in metric_cols)
+        )
+        # --dw-compute-mode duckdb：累计 + CUBE 整体交给 DuckDB（见 _compute_cum_cube_duckdb）
+        use_duckdb = getattr(args, "dw_compute_mode", "pandas") == "duckdb"
+        if use_duckdb and hll:
+            print("[warn] --dw-compute-mode duckdb 只支持精确 distinct，已忽略 --distinct-mode hll", file=sys.stderr)
+            hll = False
+        if inc_out is not None:
+            cum = None
+        elif len(df) == 0:
+            cum = pd.DataFrame(columns=(dim_cols + ["time_bucket"] + [output_names.get(f, f) for f in metric_cols]))
+            cum = spine_df.merge(cum, on="time_bucket", how="left") if not dim_cols else cum
             for f in metric_cols:
                 out_name = output_names.get(f, f)
                 if out_name not in cum.columns:
                     cum[out_name] = 0
+        elif over_inc or use_duckdb:
+            cum = None
         else:
             prof.start("compute_cum")
             cum = _compute_cum_10m_fast(
                 df,
                 dim_cols=dim_cols,
                 metric_cols=metric_cols,
-                metric_rules=metric_rules,
+                # hll 模式下 distinct 指标由 _cube_hll_cum 单独计算，这里只占位为 0
+                metric_rules=(
+                    {f: ("hll" if r == "distinct" else r) for f, r in metric_rules.items()} if hll else metric_rules
+                ),
                 output_names=output_names,
                 spine_df=spine_df,
+                engine=getattr(args, "cum_engine", "groupby"),
+                time_col="time_bucket",
+                workers=max(1, int(getattr(args, "workers", 1) or 1)),
+                # CUBE(sum) 与 hll 合并都需要完整网格，只有直接输出时才能跳过网格
+                output_mode=output_mode if (args.no_cube and not hll) else "dense",
             )
-            prof.end("compute_cum", rows=len(cum))
+            prof.end("compute_cum", rows=len(cum), extra=f"engine={getattr(args, 'cum_engine', 'groupby')}")
+            if hll and args.no_cube:
+                prof.start("compute_hll")
+                gcols = dim_cols + ["time_bucket"]
+                for f in [x for x in metric_cols if metric_rules.get(x) == "distinct"]:
+                    out_name = output_names.get(f, f)
+                    approx = _cube_hll_cum(
+                        df,
+                        dim_cols=dim_cols,
+                        key_col=f,
+                        out_col=out_name,
+                        spine_df=spine_df,
+                        time_col="time_bucket",
+                        precision=hll_precision,
+                        masks=[0],
+                    )
+                    cum = cum.drop(columns=[out_name]).merge(approx, on=gcols, how="left")
+                    cum[out_name] = cum[out_name].fillna(0)
+                prof.end("compute_hll", rows=len(cum))
 
         # CUBE聚合：生成所有维度组合（包括"整体"）
-        if args.no_cube:
+        if inc_out is not None:
+            out = inc_out
+        elif use_duckdb and (len(df) or local_paths is not None):
+            prof.start("compute_duckdb")
+            out = _compute_cum_cube_duckdb(
+                df,
+                args,
+                dim_cols=dim_cols,
+                metric_cols=metric_cols,
+                metric_rules=metric_rules,
+                output_names=output_names,
+                start_bucket=start_bucket,
+                end_bucket=end_bucket,
+                grouping_sets=grouping_sets,
+                local_paths=local_paths,
+                fields=fields,
+                computed=computed,
+            )
+            if not len(out) and cum is not None:
+                # 落地文件没有有效明细：与 pandas 路径输出同样的占位结果
+                out = cum
+            prof.end("compute_duckdb", rows=len(out), extra=("direct_file" if local_paths is not None else None))
+        elif args.no_cube:
             out = cum
         else:
             prof.start("compute_cube")
             # sum 指标可加：对累计值做 CUBE(sum) 可以对齐校验 SQL 的行为
             sum_metric_cols = [f for f in metric_cols if metric_rules.get(f) == "sum"]
             sum_out_cols = [output_names.get(f, f) for f in sum_metric_cols]
-            sum_out_cols = [c for c in sum_out_cols if c in cum.columns]
-            cum = _maybe_categorize_dims(cum, dim_cols)
+            spill_dir = args.dw_tmp_dir if getattr(args, "cube_spill", False) else None
+            masks = _grouping_sets_to_masks(grouping_sets, dim_cols) if grouping_sets else None
+            fds = _resolve_cube_fds(args, sql_text, df, dim_cols)
 
             parts = []
+            if cum is None:
+                inc_fields = [f for f in sum_metric_cols if f in df.columns]
+                if inc_fields:
+                    cube_sum = _cube_sum_over_increments(
+                        df,
+                        dim_cols=dim_cols,
+                        metric_cols=inc_fields,
+                        output_names=output_names,
+                        spine_df=spine_df,
+                        time_col="time_bucket",
+                        spill_dir=spill_dir,
+                        masks=masks,
+                        fds=fds,
+                    )
+                    parts.append(cube_sum)
+                sum_out_cols = []
+            else:
+                sum_out_cols = [c for c in sum_out_cols if c in cum.columns]
+                cum = _maybe_categorize_dims(cum, dim_cols)
             if sum_out_cols:
-                cube_sum = _cube_sum_fast(cum, dim_cols=dim_cols, metric_cols=sum_out_cols, time_col="time_minute_10")
+                cube_sum = _cube_sum_fast(
+                    cum,
+                    dim_cols=dim_cols,
+                    metric_cols=sum_out_cols,
+                    time_col="time_bucket",
+                    spill_dir=spill_dir,
+                    masks=masks,
+                    fds=fds,
+                )
                 parts.append(cube_sum)
 
             # distinct 指标不可加：必须重新计算 count(distinct) with cube 的累计
             for f in [x for x in metric_cols if metric_rules.get(x) == "distinct"]:
                 out_name = output_names.get(f, f)
-                cube_dist = _cube_distinct_cum_fast(
-                    df,
-                    dim_cols=dim_cols,
-                    key_col=f,
-                    out_col=out_name,
-                    spine_df=spine_df,
-                    time_col="time_minute_10",
-                )
+                if hll:
+                    cube_dist = _cube_hll_cum(
+                        df,
+                        dim_cols=dim_cols,
+                        key_col=f,
+                        out_col=out_name,
+                        spine_df=spine_df,
+                        time_col="time_bucket",
+                        precision=hll_precision,
+                        masks=masks,
+                        fds=fds,
+                        spill_dir=spill_dir,
+                    )
+                else:
+                    cube_dist = _cube_distinct_cum_fast(
+                        df,
+                        dim_cols=dim_cols,
+                        key_col=f,
+                        out_col=out_name,
+                        spine_df=spine_df,
+                        time_col="time_bucket",
+                        engine=getattr(args, "cum_engine", "groupby"),
+                        workers=max(1, int(getattr(args, "workers", 1) or 1)),
+                        executor=getattr(args, "cube_executor", "serial"),
+                        tmp_dir=args.dw_tmp_dir,
+                        spill_dir=spill_dir,
+                        masks=masks,
+                        fds=fds,
+                        first_seen=getattr(args, "first_seen_method", "groupby"),
+                        output_mode=output_mode,
+                    )
                 parts.append(cube_dist)
 
             if not parts:
                 out = cum
             else:
                 # 合并各类指标（sum cube + distinct cube）
-                gcols = dim_cols + ["time_minute_10"]
+                gcols = dim_cols + ["time_bucket"]
                 out = parts[0]
                 for p2 in parts[1:]:
                     out = out.merge(p2, on=gcols, how="outer")
 
-                # 缺失指标填 0
+                # 缺失指标填 0（changes 模式下各部分可能是稀疏的，缺失值留给 _change_only_rows 沿用上一桶）
                 for f in metric_cols:
                     out_name = output_names.get(f, f)
                     if out_name not in out.columns:
                         out[out_name] = 0
-                    out[out_name] = pd.to_numeric(out[out_name], errors="coerce").fillna(0)
+                    out[out_name] = pd.to_numeric(out[out_name], errors="coerce")
+                    if output_mode != "changes":
+                        out[out_name] = out[out_name].fillna(0)
 
             prof.end("compute_cube", rows=len(out))
 
-        out = out.rename(columns={"time_minute_10": "date_minute"})
-        out["date_p"] = args.date_p
-
-        if args.dw_table:
-            write_to_warehouse(out, args)
-
-        if args.output:
-            out_excel = out.copy()
-            out_excel["date_minute"] = out_excel["date_minute"].astype(str)
-            out_excel["date_p"] = out_excel["date_p"].astype(str)
-            out_excel.to_excel(args.output, index=False)
-            print(f"已写入: {args.output}")
+        if output_mode == "changes" and out is not None and len(out):
+            prof.start("change_only")
+            dense_rows = len(out)
+            out = _change_only_rows(
+                out,
+                dim_cols=dim_cols,
+                value_cols=[output_names.get(f, f) for f in metric_cols],
+                time_col="time_bucket",
+                start=start_bucket,
+            )
+            prof.end("change_only", rows=len(out), extra=f"in={dense_rows}")
 
         if (not args.output) and (not args.dw_table):
             raise ValueError("必须至少指定一个输出：--output 或 --dw-table")
 
+        # --granularities：更粗粒度的累计表都由同一份 10 分钟累计结果推出（见 _coarsen_cum）
+        outputs = []
+        for g in granularities:
+            if g == 10:
+                outputs.append(("", out))
+            else:
+                prof.start(f"coarsen_{g}m")
+                coarse = _coarsen_cum(
+                    out,
+                    dim_cols=dim_cols,
+                    time_col="time_bucket",
+                    minutes=g,
+                    end_bucket=end_bucket,
+                )
+                prof.end(f"coarsen_{g}m", rows=len(coarse))
+                outputs.append((f"_{g}m", coarse))
+
+        slice_manifest = {}
+        for suffix, frame in outputs:
+            # 增量 + 追加写入：之前的时间点已写过，只输出新的时间点
+            if state is not None and args.dw_mode == "append":
+                frame = frame[frame["time_bucket"] > int(state.get("output_end_bucket", state["end_bucket"]))]
+
+            frame = frame.rename(columns={"time_bucket": "date_minute"})
+            frame["date_minute"] = _bucket_to_minute(frame["date_minute"].to_numpy(), args.date_p)
+            frame["date_p"] = args.date_p
+
+            if args.dw_table:
+                if suffix:
+                    # 粗粒度表不参与 --late-arrival-check 的分片替换，整分区覆盖
+                    write_to_warehouse(frame, args, table=args.dw_table + suffix)
+                else:
+                    slice_manifest = write_to_warehouse(
+                        frame, args, rewrite_from_minute=rewrite_from, slice_files=prev_slice_files
+                    )
+
+            if args.output:
+                out_path = Path(args.output)
+                out_path = out_path.with_name(out_path.stem + suffix + out_path.suffix)
+                out_excel = frame.copy()
+                out_excel["date_minute"] = out_excel["date_minute"].astype(str)
+                out_excel["date_p"] = out_excel["date_p"].astype(str)
+                out_excel.to_excel(out_path, index=False)
+                print(f"已写入: {out_path}")
+
+        if state_sig is not None:
+            if late_check and slice_manifest:
+                new_state["slice_files"] = slice_manifest
+            state_path = _save_cum_state(args, state_sig, new_state)
+            prof.info(f"增量状态已保存: {state_path}")
+
         ok = True
     finally:
         # 默认：成功后清理本次产生的 cum10m_* 临时文件；失败保留便于排查
@@ -1,23 +1,65 @@
+import importlib.util
 import subprocess
 import sys
 from pathlib import Path
 
 import pandas as pd
+import pytest
 
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 
 from cum10m import (
+    _bucket_to_minute,
+    _change_only_rows,
+    _clean_detail_frame,
+    _coarsen_cum,
     _compute_cum_10m_fast,
+    _compute_cum_cube_duckdb,
     _cube_distinct_cum_fast,
+    _cube_hll_cum,
+    _cube_smallest_parent,
+    _cube_sum_over_increments,
+    _cube_sum_fast,
+    _detect_field_sep,
+    _detail_from_leaf_state,
+    _detect_functional_dependencies,
+    _build_first_seen_pushdown_hqls,
+    _bucket_detail_frame,
+    _build_incremental_hql,
+    _build_sparksql_cum_cube_insert,
+    _build_time_slice_hql,
     _build_sparksql_cum_cube_insert_subquery,
     _distinct_key_mask,
+    _earliest_changed_bucket,
+    _encode_distinct_key,
+    _first_seen_flags,
+    _grouping_sets_to_masks,
+    _iter_query_to_local_chunks,
+    _leaf_state_from_detail,
+    _local_bucket_fingerprints,
+    _merge_leaf_state,
+    _minute_to_bucket,
     _normalize_dim_values,
     _parse_create_table_columns_from_log,
+    _parse_granularities,
+    _pull_query_to_local_sliced,
+    _pull_time_slices,
+    _read_datawork_query_to_local_file,
+    _run_datawork_query_to_local,
+    _state_resume_minute,
+    _stream_reduce_query_to_local,
+    _truncate_cum_state,
     build_datawork_insert_sql,
+    densify_change_only,
+    extract_functional_dependencies,
+    extract_grouping_sets,
     floor_10m,
+    parse_args,
+    parse_grouping_sets,
     parse_select_fields,
+    write_to_warehouse,
 )
 
 
@@ -60,6 +102,18 @@ def test_floor_10m():
     assert floor_10m(202512260000) == 202512260000
 
 
+def test_minute_bucket_round_trip():
+    ts = [202512260000, 202512260047, 202512262359, 202512270005]
+    idx = _minute_to_bucket(ts, 20251226)
+    assert idx.dtype.name == "int16"
+    assert idx.tolist() == [0, 4, 143, 144]
+    assert _bucket_to_minute(idx, 20251226).tolist() == [202512260000, 202512260040, 202512262350, 202512270000]
+
+    # 相差一年的时间超出 int16，必须落到丢弃哨兵，不能回绕成 -12976（被当作当天之前的增量）或 12976
+    far = _minute_to_bucket([202612300005, 202412300005, 202512290005, 20251230], 20251230)
+    assert far.tolist() == [-32768, -32768, -144, -32768]
+
+
 def test_parse_select_fields_coalesce_expr():
     sql = """
     SELECT
@@ -263,6 +317,27 @@ def test_cli_writes_to_dw_sqlite_overwrite_partition(tmp_path):
         assert date_ps == [20251226]
 
 
+def test_write_to_warehouse_target_and_rewrite_are_arguments(tmp_path):
+    from types import SimpleNamespace
+
+    import sqlalchemy as sa
+
+    dw_url = f"sqlite:///{tmp_path / 'dw.db'}"
+    args = SimpleNamespace(dw_table="cum", dw_kind="auto", dw_url=dw_url, dw_mode="overwrite", date_p=20251226, dw_chunk_size=500)
+    frame = pd.DataFrame({"d1": ["a", "a"], "n": [1, 2], "date_minute": [202512260000, 202512260010], "date_p": [20251226] * 2})
+
+    assert write_to_warehouse(frame, args) == {}
+    write_to_warehouse(frame.assign(n=[9, 9]), args, table="cum_30m")
+    # 只重写 rewrite_from_minute 之后的时间点，之前的保持原值
+    write_to_warehouse(frame.assign(n=[5, 6]), args, rewrite_from_minute=202512260010)
+    assert args.dw_table == "cum" and not hasattr(args, "_rewrite_from_minute")
+
+    engine = sa.create_engine(dw_url, future=True)
+    with engine.connect() as conn:
+        assert pd.read_sql_query("select n from cum order by date_minute", conn)["n"].tolist() == [1, 6]
+        assert pd.read_sql_query("select n from cum_30m order by date_minute", conn)["n"].tolist() == [9, 9]
+
+
 def test_compute_cum_forward_fill_on_missing_buckets():
     df = pd.DataFrame(
         {
@@ -347,3 +422,911 @@ def test_distinct_ignores_null_like_hive():
     )
     got = out[(out["dim"] == "a") & (out["time_minute_10"] == 202512300120)]["user_num"].iloc[0]
     assert float(got) == 1.0
+
+
+def _sample_detail_two_dims():
+    return pd.DataFrame(
+        {
+            "d1": ["x", "x", "y", "y", "x"],
+            "d2": ["p", "q", "p", "p", "p"],
+            "uid": ["u1", "u2", "u1", "", "u3"],
+            "cost": [1.0, 2.0, 3.0, 4.0, 5.0],
+            "time_minute_10": [202512300110, 202512300120, 202512300110, 202512300130, 202512300130],
+        }
+    )
+
+
+_KEYS = ["d1", "d2", "time_minute_10"]
+_CUM_KW = dict(
+    dim_cols=["d1", "d2"],
+    metric_cols=["uid", "cost"],
+    metric_rules={"uid": "distinct", "cost": "sum"},
+    output_names={"uid": "user_num"},
+)
+_DISTINCT_KW = dict(dim_cols=["d1", "d2"], key_col="uid", out_col="user_num")
+
+
+def _sample_spine():
+    return pd.DataFrame({"time_minute_10": [202512300110, 202512300120, 202512300130]})
+
+
+def _sorted(df, keys=_KEYS):
+    return df.sort_values(keys).reset_index(drop=True)
+
+
+_BUCKET_KEYS = ["d1", "d2", "time_bucket"]
+
+
+def _sample_detail_buckets():
+    """_sample_detail_two_dims 换成桶下标时间（0..2）及对应的 spine。"""
+    df = _sample_detail_two_dims().rename(columns={"time_minute_10": "time_bucket"})
+    df["time_bucket"] = ((df["time_bucket"] - 202512300110) // 10).astype("int16")
+    return df, pd.DataFrame({"time_bucket": pd.array([0, 1, 2], dtype="int16")})
+
+
+@pytest.mark.parametrize("options", [{"engine": "codes"}, {"engine": "dense"}, {"workers": 2}], ids=str)
+def test_compute_cum_engines_match_groupby(options):
+    df = _sample_detail_two_dims()
+    want = _sorted(_compute_cum_10m_fast(df, spine_df=_sample_spine(), **_CUM_KW))
+    got = _sorted(_compute_cum_10m_fast(df, spine_df=_sample_spine(), **options, **_CUM_KW))
+    assert got.columns.tolist() == want.columns.tolist()
+    pd.testing.assert_frame_equal(got, want, check_dtype=False)
+
+
+@pytest.mark.parametrize(
+    "options", [{"engine": "groupby"}, {"engine": "codes"}, {"engine": "dense"}, {"workers": 2}], ids=str
+)
+def test_compute_cum_engines_fold_pre_start_rows(options):
+    # 起点之前的增量并入第一个输出桶（累计从当天开始），各引擎一致
+    late_spine = pd.DataFrame({"time_minute_10": [202512300120, 202512300130]})
+    got = _sorted(_compute_cum_10m_fast(_sample_detail_two_dims(), spine_df=late_spine, **options, **_CUM_KW))
+    # x/p@0110 的 u1 与 y/p@0110 的 u1、3.0 都在起点 0120 计入
+    assert got[["user_num", "cost"]].values.tolist() == [[1, 1], [2, 6], [1, 2], [1, 2], [1, 3], [1, 7]]
+    dense = _sorted(_compute_cum_10m_fast(_sample_detail_two_dims(), spine_df=late_spine, engine="dense", **_CUM_KW))
+    pd.testing.assert_frame_equal(got, dense, check_dtype=False)
+
+
+@pytest.mark.parametrize("options", [{}, {"output_mode": "changes"}, {"engine": "dense"}, {"workers": 2}], ids=str)
+def test_cube_distinct_engines_fold_pre_start_rows(options):
+    late_spine = pd.DataFrame({"time_minute_10": [202512300120, 202512300130]})
+    got = _cube_distinct_cum_fast(_sample_detail_two_dims(), spine_df=late_spine, **options, **_DISTINCT_KW)
+    got = _sorted(got)
+    start = got[got["time_minute_10"] == 202512300120].set_index(["d1", "d2"])["user_num"]
+    assert start.to_dict() == {
+        ("x", "p"): 1,
+        ("x", "q"): 1,
+        ("x", "整体"): 2,
+        ("y", "p"): 1,
+        ("y", "整体"): 1,
+        ("整体", "p"): 1,
+        ("整体", "q"): 1,
+        ("整体", "整体"): 2,
+    }
+
+
+_needs_pyroaring = pytest.mark.skipif(importlib.util.find_spec("pyroaring") is None, reason="pyroaring 未安装")
+
+
+def _distinct_layout(name):
+    df = _sample_detail_two_dims()
+    if name == "shuffled":
+        # 乱序输入：sort 方式依赖一次稳定排序，而不是输入顺序
+        return df.iloc[[4, 2, 0, 3, 1]].reset_index(drop=True)
+    if name == "null_dim":
+        df.loc[4, "d2"] = None
+        return df
+    if name == "int64_keys":
+        # 字符串键与 int64 编码键（含负数哈希）结果一致
+        return df.assign(uid=_encode_distinct_key(df["uid"]))
+    return df
+
+
+@pytest.mark.parametrize("layout", ["plain", "shuffled", "null_dim", "int64_keys"])
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"engine": "dense"},
+        {"workers": 2},
+        {"engine": "dense", "workers": 2},
+        {"executor": "levels"},
+        {"executor": "levels", "workers": 2},
+        {"spill": True},
+        {"first_seen": "sort"},
+        {"first_seen": "sort", "workers": 2},
+        {"first_seen": "sort", "executor": "levels"},
+        pytest.param({"first_seen": "bitmap"}, marks=_needs_pyroaring),
+        pytest.param({"first_seen": "bitmap", "engine": "dense", "workers": 2}, marks=_needs_pyroaring),
+    ],
+    ids=str,
+)
+def test_cube_distinct_variants_match_groupby(layout, options, tmp_path):
+    df = _distinct_layout(layout)
+    # 基准：字符串键 + 默认 groupby 引擎
+    base = _sample_detail_two_dims() if layout == "int64_keys" else df
+    want = _sorted(_cube_distinct_cum_fast(base, spine_df=_sample_spine(), **_DISTINCT_KW))
+
+    options = dict(options)
+    if options.pop("spill", False):
+        options["spill_dir"] = str(tmp_path)
+    if options.get("executor") == "levels":
+        options["tmp_dir"] = str(tmp_path)
+    got = _cube_distinct_cum_fast(df, spine_df=_sample_spine(), **options, **_DISTINCT_KW)
+    pd.testing.assert_frame_equal(_sorted(got), want, check_dtype=False)
+    # 落盘分片与父层 .npy 在结束后删除
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_first_seen_flags_marks_all_distinct_keys_in_one_pass():
+    df = pd.DataFrame(
+        {
+            "d": ["a", "a", "a", "b"],
+            "order_id": ["o1", "o1", "o2", "o1"],
+            "uid": ["u1", "u1", "u1", ""],
+            "t": [30, 10, 20, 40],
+        }
+    )
+    flags = _first_seen_flags(df, group_cols=["d"], key_cols=["order_id", "uid"], time_col="t")
+    # 行顺序保持不变：order_id 首次出现在 t=10/20/40，uid 仅在 t=10；空 uid 不计入
+    assert flags["order_id"].tolist() == [False, True, True, True]
+    assert flags["uid"].tolist() == [False, True, False, False]
+
+
+def test_cube_sum_spill_to_disk_matches_in_memory(tmp_path):
+    df = _sample_detail_two_dims()
+    want = _sorted(_cube_sum_fast(df, dim_cols=["d1", "d2"], metric_cols=["cost"]))
+    got = _cube_sum_fast(df, dim_cols=["d1", "d2"], metric_cols=["cost"], spill_dir=str(tmp_path))
+    pd.testing.assert_frame_equal(_sorted(got), want)
+    # (整体, 整体) 汇总全部明细
+    assert want[(want["d1"] == "整体") & (want["d2"] == "整体")]["cost"].sum() == df["cost"].sum()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cube_smallest_parent_prefers_fewest_rows():
+    # mask=0b11 可由 0b10（去掉 bit0）或 0b01（去掉 bit1）得到
+    assert _cube_smallest_parent(0b11, {0b01: 5, 0b10: 100}) == 0b01
+    assert _cube_smallest_parent(0b11, {0b01: 100, 0b10: 5}) == 0b10
+    # 行数相同：取去掉最低位的那个（与 mask ^ lsb 一致）
+    assert _cube_smallest_parent(0b11, {0b01: 7, 0b10: 7}) == 0b10
+    assert _cube_smallest_parent(0b100, {0: 1}) == 0
+
+
+def test_cube_sum_over_increments_matches_cube_of_cumulative():
+    df = _sample_detail_two_dims()
+    sum_kw = dict(dim_cols=["d1", "d2"], metric_cols=["cost"])
+    cum = _compute_cum_10m_fast(df, metric_rules={"cost": "sum"}, output_names={}, spine_df=_sample_spine(), **sum_kw)
+    want = _sorted(_cube_sum_fast(cum, **sum_kw))
+    got = _cube_sum_over_increments(df, output_names={}, spine_df=_sample_spine(), **sum_kw)
+    pd.testing.assert_frame_equal(_sorted(got), want, check_dtype=False)
+
+
+def test_cli_rejects_unknown_grouping_set_column_before_sparksql():
+    sql = "SELECT\n  os_type,\n  uid, -- distinct_user_num\n  cost, -- sum\n  time_minute,\n  date_p\nFROM t\n"
+    cmd = [
+        sys.executable,
+        "cum10m.py",
+        "--source",
+        "datawork",
+        "--dw-compute-mode",
+        "sparksql",
+        "--dw-table",
+        "x.y",
+        "--date-p",
+        "20251226",
+        "--start-ts",
+        "202512260000",
+        "--end-ts",
+        "202512260100",
+        "--grouping-sets",
+        "(os_type), (dX)",
+    ]
+    # 拼错的维度名在生成 SparkSQL 之前就报错，而不是被悄悄当成 () 提交
+    res = subprocess.run(cmd, input=sql, text=True, capture_output=True, cwd=ROOT)
+    assert res.returncode != 0
+    assert "grouping sets 中的字段不是维度字段: ['dX']（维度: ['os_type']）" in res.stderr
+
+
+def test_grouping_sets_restrict_pandas_cube_and_sparksql():
+    sql_text = "-- grouping_sets: rollup(d1, d2)\nselect d1, d2 from t"
+    sets = parse_grouping_sets(extract_grouping_sets(sql_text))
+    assert sets == [["d1", "d2"], ["d1"], []]
+    assert parse_grouping_sets("(d2), ()") == [["d2"], []]
+    masks = _grouping_sets_to_masks(sets, ["d1", "d2"])
+    assert masks == [0b00, 0b10, 0b11]
+    with pytest.raises(ValueError):
+        _grouping_sets_to_masks([["nope"]], ["d1", "d2"])
+
+    df = _sample_detail_two_dims()
+    full = _cube_distinct_cum_fast(df, spine_df=_sample_spine(), **_DISTINCT_KW)
+    got = _cube_distinct_cum_fast(df, spine_df=_sample_spine(), masks=masks, **_DISTINCT_KW)
+    # 只有 (d1,d2)、(d1,整体)、(整体,整体)，数值与完整 CUBE 中对应行一致
+    assert not ((got["d1"] == "整体") & (got["d2"] != "整体")).any()
+    want = _sorted(full.merge(got[_KEYS], on=_KEYS))
+    pd.testing.assert_frame_equal(_sorted(got), want, check_dtype=False)
+    assert len(_cube_sum_fast(df, dim_cols=["d1", "d2"], metric_cols=["cost"], masks=[0b11])) == 3
+
+    sql = _build_sparksql_cum_cube_insert_subquery(
+        raw_hql="select cost_type, os_type, uid, time_minute, date_p from t",
+        output_table="stat_aigc.cost_xxx",
+        anchor_table="stat_aigc.cost_anchor",
+        date_p=20251230,
+        start_ts=202512300000,
+        end_ts=202512300100,
+        fields=["cost_type", "os_type", "uid", "time_minute", "date_p"],
+        metric_rules={"uid": "distinct"},
+        output_names={"uid": "user_num"},
+        schema_info={"cols": ["cost_type", "os_type", "user_num", "date_minute", "date_p"], "part_cols": ["date_p"]},
+        no_cube=False,
+        preagg=False,
+        grouping_sets=[["os_type"], []],
+    )
+    assert "with cube" not in sql
+    assert "group by uid, cost_type, os_type grouping sets ((uid, os_type), (uid))" in sql
+
+
+def test_functional_dependency_pruning_matches_full_cube(tmp_path):
+    df = pd.DataFrame(
+        {
+            "country": ["cn", "cn", "us", "jp", "us"],
+            "region": ["asia", "asia", "na", "asia", "na"],
+            "os": ["ios", "web", "ios", "ios", "web"],
+            "uid": ["u1", "u2", "u1", "u3", "u4"],
+            "cost": [1.0, 2.0, 3.0, 4.0, 5.0],
+            "time_minute_10": [202512300110, 202512300120, 202512300110, 202512300130, 202512300120],
+        }
+    )
+    dims = ["country", "region", "os"]
+    fds = _detect_functional_dependencies(df, dims)
+    assert ("country", "region") in fds
+    assert ("region", "country") not in fds
+    assert extract_functional_dependencies("-- fd: country -> region, a -> b\nselect 1") == [
+        ("country", "region"),
+        ("a", "b"),
+    ]
+
+    keys = dims + ["time_minute_10"]
+    want = _cube_sum_fast(df, dim_cols=dims, metric_cols=["cost"]).sort_values(keys).reset_index(drop=True)
+    got = _cube_sum_fast(df, dim_cols=dims, metric_cols=["cost"], fds=fds).sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, want)
+
+    kwargs = dict(_DISTINCT_KW, dim_cols=dims, spine_df=_sample_spine())
+    want = _cube_distinct_cum_fast(df, **kwargs).sort_values(keys).reset_index(drop=True)
+    for extra in [{}, {"executor": "levels", "tmp_dir": str(tmp_path)}]:
+        got = _cube_distinct_cum_fast(df, fds=fds, **extra, **kwargs).sort_values(keys).reset_index(drop=True)
+        pd.testing.assert_frame_equal(got, want, check_dtype=False)
+
+
+def test_encode_distinct_key_to_int64_keeps_distinct_semantics():
+    s = pd.Series(["123", "007", "abc", "", None, "\\N", "null", "123"], name="uid", dtype=object)
+    enc = _encode_distinct_key(s, collision_check=True)
+    assert str(enc.dtype) == "Int64"
+    assert enc.isna().tolist() == [False, False, False, True, True, True, True, False]
+    assert enc[0] == 123 and enc[7] == 123
+    # 非规范整数（前导零）与普通字符串取哈希，落在负数区间，不会与整数值冲突
+    assert enc[1] < 0 and enc[2] < 0 and enc[1] != enc[2]
+    assert _distinct_key_mask(enc).tolist() == (~enc.isna()).tolist()
+
+
+def test_hll_distinct_mode_approximates_exact_cube():
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    n = 20000
+    df = pd.DataFrame(
+        {
+            "d1": rng.choice(["x", "y"], n),
+            "d2": rng.choice(["p", "q", "r"], n),
+            "uid": rng.integers(0, 5000, n).astype(str),
+            "time_minute_10": rng.integers(0, 6, n),
+        }
+    )
+    df.loc[:9, "uid"] = ""
+    spine_df = pd.DataFrame({"time_minute_10": range(6)})
+    kwargs = dict(_DISTINCT_KW, spine_df=spine_df)
+    keys = _KEYS
+    exact = _cube_distinct_cum_fast(df, **kwargs)
+    approx = _cube_hll_cum(df, precision=12, **kwargs)
+    m = exact.merge(approx, on=keys, suffixes=("", "_hll"))
+    assert len(m) == len(exact) == len(approx)
+    rel = (m["user_num_hll"] - m["user_num"]).abs() / m["user_num"]
+    assert rel.max() < 0.08
+    # 累计口径：随时间单调不减
+    assert (approx.sort_values(keys).groupby(["d1", "d2"])["user_num"].diff().fillna(0) >= 0).all()
+
+    small = pd.DataFrame({"d1": ["x"] * 4, "uid": ["a", "b", "b", None], "time_minute_10": [0, 1, 1, 1]})
+    got = _cube_hll_cum(small, dim_cols=["d1"], key_col="uid", out_col="user_num", spine_df=spine_df.head(2), masks=[0])
+    assert got["user_num"].tolist() == [1.0, 2.0]
+
+    sql = _build_sparksql_cum_cube_insert_subquery(
+        raw_hql="select cost_type, uid, time_minute, date_p from t",
+        output_table="stat_aigc.cost_xxx",
+        anchor_table="stat_aigc.cost_anchor",
+        date_p=20251230,
+        start_ts=202512300000,
+        end_ts=202512300100,
+        fields=["cost_type", "uid", "time_minute", "date_p"],
+        metric_rules={"uid": "distinct"},
+        output_names={"uid": "user_num"},
+        schema_info={"cols": ["cost_type", "user_num", "date_minute", "date_p"], "part_cols": ["date_p"]},
+        no_cube=False,
+        preagg=False,
+        distinct_mode="hll",
+    )
+    # 按 (维度, 桶) 建草图、窗口内合并累计；明细不与 spine 做 <= 关联
+    assert "hll_sketch_agg(uid, 12) as user_num_sketch" in sql
+    assert "group by date_minute, cost_type with cube" in sql
+    assert (
+        "coalesce(hll_sketch_estimate(hll_union_agg(user_num_sketch) over(partition by cost_type "
+        "order by date_minute rows between unbounded preceding and current row)),0) as user_num"
+    ) in sql
+    assert "<= s.date_minute" not in sql and "approx_count_distinct" not in sql
+    assert "first_minute" not in sql
+
+
+def test_hll_precision_range_is_checked(monkeypatch, capsys):
+    base = ["cum10m.py", "--date-p", "20251230", "--start-ts", "202512300000", "--end-ts", "202512300100"]
+    for ok in ("4", "18"):
+        monkeypatch.setattr(sys, "argv", base + ["--hll-precision", ok])
+        assert parse_args().hll_precision == int(ok)
+    for bad in ("3", "19"):
+        monkeypatch.setattr(sys, "argv", base + ["--hll-precision", bad])
+        with pytest.raises(SystemExit):
+            parse_args()
+        assert "4..18" in capsys.readouterr().err
+
+
+def test_change_only_output_roundtrips_to_dense():
+    df = pd.DataFrame(
+        {
+            "d1": ["x", "x", "y", "z"],
+            "uid": ["a", "b", "a", None],
+            "cost": [1.0, 2.0, 3.0, 0.0],
+            # 第一行早于输出起点（桶 2），应并入起点
+            "time_bucket": [0, 4, 3, 2],
+        }
+    )
+    spine_df = pd.DataFrame({"time_bucket": list(range(2, 7))})
+    kwargs = dict(
+        dim_cols=["d1"],
+        metric_cols=["uid", "cost"],
+        metric_rules={"uid": "distinct", "cost": "sum"},
+        output_names={"uid": "user_num"},
+        spine_df=spine_df,
+        engine="dense",
+        time_col="time_bucket",
+    )
+    dense = _compute_cum_10m_fast(df, **kwargs)
+    sparse = _compute_cum_10m_fast(df, **{**kwargs, "engine": "groupby"}, output_mode="changes")
+    assert len(sparse) < len(dense)
+    opts = dict(dim_cols=["d1"], value_cols=["user_num", "cost"], time_col="time_bucket", start=2)
+    changes = _change_only_rows(sparse, **opts)
+    pd.testing.assert_frame_equal(changes, _change_only_rows(dense, **opts), check_dtype=False)
+    assert changes[["d1", "time_bucket", "user_num", "cost"]].values.tolist() == [
+        ["x", 2, 1, 1.0],
+        ["x", 4, 2, 3.0],
+        ["y", 3, 1, 3.0],
+        ["z", 2, 0, 0.0],
+    ]
+
+    date_p = 20251230
+    out = changes.rename(columns={"time_bucket": "date_minute"})
+    out["date_minute"] = _bucket_to_minute(out["date_minute"].to_numpy(), date_p)
+    back = densify_change_only(out, start_ts=202512300020, end_ts=202512300105, metric_cols=["user_num", "cost"])
+    want = dense.rename(columns={"time_bucket": "date_minute"})
+    want["date_minute"] = _bucket_to_minute(want["date_minute"].to_numpy(), date_p)
+    pd.testing.assert_frame_equal(back, want.reset_index(drop=True), check_dtype=False)
+
+
+def test_incremental_state_merges_to_full_day_result():
+    df, spine_df = _sample_detail_buckets()
+    kw = dict(dim_cols=["d1", "d2"], sum_fields=["cost"], distinct_fields=["uid"], time_col="time_bucket")
+    mkw = dict(dim_cols=["d1", "d2"], time_col="time_bucket")
+    # 第一次运行覆盖到桶 0，第二次只处理之后的明细
+    early = _leaf_state_from_detail(df[df["time_bucket"] <= 0], **kw)
+    late = _leaf_state_from_detail(df[df["time_bucket"] > 0], **kw)
+    merged = _merge_leaf_state(early, late, **mkw)
+    compact = _detail_from_leaf_state(merged, **kw)
+    assert len(compact) <= len(df) + len(merged["first"]["uid"])
+
+    for fn, fkw in [(_compute_cum_10m_fast, _CUM_KW), (_cube_distinct_cum_fast, _DISTINCT_KW)]:
+        want = _sorted(fn(df, spine_df=spine_df, time_col="time_bucket", **fkw), _BUCKET_KEYS)
+        got = _sorted(fn(compact, spine_df=spine_df, time_col="time_bucket", **fkw), _BUCKET_KEYS)
+        pd.testing.assert_frame_equal(got, want, check_dtype=False)
+
+    hql = _build_incremental_hql("select d1, uid, time_minute from t;", fields=["d1", "uid", "time_minute"], after_minute=202512300119)
+    assert hql.endswith("where cast(time_minute as bigint) > 202512300119")
+    assert "from (\nselect d1, uid, time_minute from t\n) inc" in hql
+
+
+def test_late_arrival_fingerprints_rewind_state_to_changed_bucket():
+    detail = pd.DataFrame(
+        {
+            "d1": ["x", "x", "y", "x"],
+            "uid": ["a", "b", "a", "c"],
+            "cost": [1.0, 2.0, 3.0, 4.0],
+            "time_minute": [202512300005, 202512300012, 202512300025, 202512300031],
+        }
+    )
+    fields = ["d1", "uid", "cost", "time_minute"]
+    fp = _local_bucket_fingerprints(detail, fields=fields, date_p=20251230)
+    assert fp["time_bucket"].tolist() == [0, 1, 2, 3]
+    assert _earliest_changed_bucket(fp, fp, end_bucket=3) is None
+
+    late = pd.concat([detail, detail.iloc[[0]].assign(uid="z", time_minute=202512300018)], ignore_index=True)
+    late_fp = _local_bucket_fingerprints(late, fields=fields, date_p=20251230)
+    assert _earliest_changed_bucket(fp, late_fp, end_bucket=3) == 1
+    # 上次未覆盖的桶（> end_bucket）不算迟到
+    assert _earliest_changed_bucket(fp, late_fp, end_bucket=0) is None
+
+    work = detail.assign(time_bucket=[0, 1, 2, 3])
+    state = _leaf_state_from_detail(
+        work, dim_cols=["d1"], sum_fields=["cost"], distinct_fields=["uid"], time_col="time_bucket"
+    )
+    state["end_bucket"] = 3
+    rewound = _truncate_cum_state(state, 1)
+    assert rewound["end_bucket"] == 0
+    assert rewound["sums"]["time_bucket"].tolist() == [0]
+    assert rewound["first"]["uid"]["uid"].tolist() == ["a"]
+
+
+def test_coarser_granularities_take_last_fine_bucket_of_each_window():
+    assert _parse_granularities("10, 30,60,30") == [10, 30, 60]
+    assert _parse_granularities(None) == [10]
+    with pytest.raises(ValueError):
+        _parse_granularities("15")
+
+    # 桶 0..7，end_bucket=7：30 分钟窗口 [0,2] [3,5] [6,7]
+    dense = pd.DataFrame(
+        {
+            "d1": ["x"] * 8,
+            "time_bucket": list(range(8)),
+            "cost": [0.0, 1.0, 1.0, 1.0, 4.0, 4.0, 6.0, 7.0],
+        }
+    )
+    kw = dict(dim_cols=["d1"], time_col="time_bucket", minutes=30, end_bucket=7)
+    got = _coarsen_cum(dense, **kw)
+    assert got[["time_bucket", "cost"]].values.tolist() == [[0, 1.0], [3, 4.0], [6, 7.0]]
+
+    # change-only 输入得到粗粒度上的 change-only 表示
+    opts = dict(dim_cols=["d1"], value_cols=["cost"], time_col="time_bucket", start=0)
+    changes = _change_only_rows(dense, **opts)
+    got = _coarsen_cum(changes, **kw)
+    assert got[["time_bucket", "cost"]].values.tolist() == [[0, 1.0], [3, 4.0], [6, 7.0]]
+
+
+def test_duckdb_compute_matches_pandas_cube(tmp_path):
+    pytest.importorskip("duckdb")
+    from types import SimpleNamespace
+
+    df, spine_df = _sample_detail_buckets()
+    cum = _compute_cum_10m_fast(df, spine_df=spine_df, time_col="time_bucket", **_CUM_KW)
+    want = _cube_sum_fast(cum, dim_cols=["d1", "d2"], metric_cols=["cost"], time_col="time_bucket").merge(
+        _cube_distinct_cum_fast(df, spine_df=spine_df, time_col="time_bucket", **_DISTINCT_KW),
+        on=_BUCKET_KEYS,
+        how="outer",
+    )
+    args = SimpleNamespace(no_cube=False, dw_tmp_dir=str(tmp_path), _tmp_paths=[], date_p=20251230, workers=1)
+    got = _compute_cum_cube_duckdb(df, args, start_bucket=0, end_bucket=2, **_CUM_KW)
+    assert list(got.columns) == ["d1", "d2", "time_bucket", "cost", "user_num"]
+    pd.testing.assert_frame_equal(_sorted(got, _BUCKET_KEYS), _sorted(want.fillna(0), _BUCKET_KEYS), check_dtype=False)
+
+
+def test_duckdb_reads_query_to_local_file_directly(tmp_path, capsys):
+    pytest.importorskip("duckdb")
+    from types import SimpleNamespace
+
+    fields = ["d1", "func_name", "uid", "cost", "time_minute", "date_p"]
+    rules = {"uid": "distinct", "cost": "sum"}
+    rows = [
+        ["a", "x", "u1", "1.5", "202512301001", "20251230"],
+        ["", "", "u2", "2", "202512301012.0", "20251230"],
+        ["b", "未知", "u1", "abc", "202512301019", "20251230"],
+        ["b", "x", " \\N ", "3", "202512301021", "20251230"],
+        ["a", "x", "NULL", "4", "202512301005", "20251230"],
+        ["a", "x", "u3", "5", "202512290941", "20251229"],
+        ["a", "x", "u4", "6", "bad", "20251230"],
+        ["c", "x", "u5", "7", "202512302359", "20251230"],
+        ["c", "x"],
+    ]
+    path = tmp_path / "q.txt"
+    path.write_bytes(b"".join(b"\x00".join(c.encode() for c in r) + b"\n" for r in rows))
+    args = SimpleNamespace(no_cube=False, dw_tmp_dir=str(tmp_path), _tmp_paths=[], date_p=20251230, workers=1)
+    kw = dict(
+        dim_cols=["d1", "func_name"],
+        metric_cols=["uid", "cost"],
+        metric_rules=rules,
+        output_names={"uid": "user_num"},
+        start_bucket=60,
+        end_bucket=62,
+    )
+    keys = ["d1", "func_name", "time_bucket"]
+
+    def via_pandas(p):
+        df = _clean_detail_frame(_read_datawork_query_to_local_file(p, fields), args, fields=fields, metric_rules=rules, computed={})
+        df = _bucket_detail_frame(df, args, fields=fields, metric_rules=rules, end_bucket=62)
+        return _compute_cum_cube_duckdb(df, args, **kw).sort_values(keys).reset_index(drop=True)
+
+    got = _compute_cum_cube_duckdb(None, args, local_paths=[path], fields=fields, computed={}, **kw)
+    want = via_pandas(path)
+    assert capsys.readouterr().err == ""
+    pd.testing.assert_frame_equal(got.sort_values(keys).reset_index(drop=True), want, check_dtype=False)
+    assert got[(got["d1"] == "整体") & (got["func_name"] == "整体")]["user_num"].tolist() == [1, 2, 2]
+
+    # 非法 UTF-8：DuckDB 拒绝读取，回退为 pandas 读取（替换非法字节），结果不变
+    bad = tmp_path / "bad.txt"
+    bad.write_bytes(path.read_bytes() + b"a\x00x\x00u9\xff\x001\x00202512301009\x0020251230\n")
+    got = _compute_cum_cube_duckdb(None, args, local_paths=[bad], fields=fields, computed={}, **kw)
+    assert "回退为 pandas 读取" in capsys.readouterr().err
+    pd.testing.assert_frame_equal(got.sort_values(keys).reset_index(drop=True), via_pandas(bad), check_dtype=False)
+
+
+def test_localspark_select_only_sql_and_field_sep():
+    assert _detect_field_sep(b"a\x01b\x01c") == b"\x01"
+    assert _detect_field_sep(b"a\x00b") == b"\x00"
+    assert _detect_field_sep(b"a\tb,c") == b"\t"
+    assert _detect_field_sep(b"abc") is None
+
+    sql = _build_sparksql_cum_cube_insert(
+        raw_hql="select * from cum10m_detail",
+        output_table="stat_aigc.cost_xxx",
+        date_p=20251230,
+        start_ts=202512300000,
+        end_ts=202512300100,
+        fields=["cost_type", "uid", "req_time", "time_minute", "date_p"],
+        metric_rules={"uid": "distinct", "req_time": "sum"},
+        output_names={"uid": "user_num"},
+        schema_info={"cols": ["cost_type", "user_num", "req_time", "date_minute", "date_p"], "part_cols": ["date_p"]},
+        no_cube=False,
+        preagg=False,
+        select_only=True,
+    )
+    # 本机 SparkSession 逐条执行：不能带 set/insert，只返回目标表列的 select
+    assert sql.startswith("with\n")
+    assert "insert overwrite" not in sql and "set hive" not in sql
+    assert sql.rstrip().endswith("select cost_type, user_num, req_time, date_minute\nfrom final")
+    assert "where uid is not null" in sql
+
+
+def test_localspark_cube_counts_key_once_in_overall():
+    duckdb = pytest.importorskip("duckdb")
+    import re
+
+    sql = _build_sparksql_cum_cube_insert(
+        raw_hql="select * from cum10m_detail",
+        output_table="t",
+        date_p=20251230,
+        start_ts=202512300000,
+        end_ts=202512300020,
+        fields=["d1", "uid", "time_minute", "date_p"],
+        metric_rules={"uid": "distinct"},
+        output_names={"uid": "user_num"},
+        schema_info={"cols": ["d1", "user_num", "date_minute", "date_p"], "part_cols": ["date_p"]},
+        no_cube=False,
+        preagg=False,
+        select_only=True,
+    )
+    # CUBE 作用在 (dims, key) 的 first-seen 上，而不是每桶新增数上
+    assert "group by uid, d1 with cube" in sql
+    assert "group by first_minute, d1 with cube" not in sql
+
+    # 把 Hive 专有写法换成 DuckDB 等价写法后执行，核对 整体 行
+    sql = re.sub(
+        r"params as \(.*?\n\),\nnums as \(.*?\n\),\nspine as \(.*?\n\),",
+        "spine as (select * from (values (202512300000),(202512300010),(202512300020)) v(date_minute)),",
+        sql,
+        flags=re.S,
+    )
+    sql = re.sub(r"group by ([\w, ]+) with cube", lambda m: "group by cube(" + m.group(1) + ")", sql)
+    sql = sql.replace(
+        "cast(concat(substr(cast(time_minute as string),1,11),'0') as bigint)",
+        "cast(time_minute // 10 * 10 as bigint)",
+    )
+    cum10m_detail = pd.DataFrame(  # noqa: F841  DuckDB 按变量名取表
+        {
+            "d1": ["a", "b", "a"],
+            "uid": ["u1", "u1", "u2"],
+            "time_minute": [202512300001, 202512300012, 202512300015],
+            "date_p": [20251230] * 3,
+        }
+    )
+    out = duckdb.sql(sql).df()
+    got = {(r.d1, int(r.date_minute)): int(r.user_num) for r in out.itertuples()}
+    # u1 同时出现在 a、b 下，整体 只计一次
+    assert [got[("整体", m)] for m in (202512300000, 202512300010, 202512300020)] == [1, 2, 2]
+    assert [got[("b", m)] for m in (202512300000, 202512300010, 202512300020)] == [0, 1, 1]
+
+
+def test_query_to_local_reader_streams_ragged_nul_rows(tmp_path):
+    path = tmp_path / "q.txt"
+    # NUL 分隔；缺列补空串、多余列与末尾空列丢弃、非法 UTF-8 替换、引号原样保留
+    path.write_bytes(b'a\x00"b\x00c\nd\x00e\n\nf\x00g\x00h\x00i\nk\x00\xff\x00m\x00\n')
+    fields = ["x", "y", "z"]
+
+    df = _read_datawork_query_to_local_file(path, fields)
+    assert df.values.tolist() == [
+        ["a", '"b', "c"],
+        ["d", "e", ""],
+        ["", "", ""],
+        ["f", "g", "h"],
+        ["k", "\ufffd", "m"],
+    ]
+    chunks = list(_iter_query_to_local_chunks(path, fields, chunk_rows=2, usecols=["z", "x"]))
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    assert pd.concat(chunks).values.tolist() == df[["z", "x"]].values.tolist()
+
+    empty = tmp_path / "empty.txt"
+    empty.write_bytes(b"")
+    assert list(_read_datawork_query_to_local_file(empty, fields).columns) == fields
+
+
+def test_stream_reduce_matches_whole_file_leaf_state(tmp_path):
+    from types import SimpleNamespace
+
+    rows = [
+        ["a", "u1", "1.5", "202512300005", "20251230"],
+        ["", "u2", "2", "202512300012", "20251230"],
+        ["a", "u1", "1", "202512300019", "20251230"],
+        ["b", "\\N", "3", "202512300021", "20251230"],
+        ["b", "u3", "4", "202512300031", "20251230"],
+        ["a", "u2", "5", "202512300041", "20251229"],
+    ]
+    path = tmp_path / "q.txt"
+    path.write_bytes("".join("\x01".join(r) + "\n" for r in rows).encode())
+    fields = ["d1", "uid", "cost", "time_minute", "date_p"]
+    rules = {"uid": "distinct", "cost": "sum"}
+    args = SimpleNamespace(date_p=20251230, key_encoding="raw")
+    kw = dict(fields=fields, metric_rules=rules, computed={}, end_bucket=2)
+
+    # 分块（每块 2 行）归约与整表一次归约的叶子层状态一致；超出 end_ts / 其他 date_p 的行被丢弃
+    _, whole, n = _stream_reduce_query_to_local(path, args, chunk_rows=100, **kw)
+    detail, leaf, _ = _stream_reduce_query_to_local(path, args, chunk_rows=2, **kw)
+    assert n == 6
+    keys = ["d1", "time_bucket"]
+    pd.testing.assert_frame_equal(
+        leaf["sums"].sort_values(keys).reset_index(drop=True), whole["sums"].sort_values(keys).reset_index(drop=True)
+    )
+    first = leaf["first"]["uid"].sort_values(["d1", "uid"]).reset_index(drop=True)
+    assert first.values.tolist() == [["a", "u1", 0], ["未知", "u2", 1]]
+    assert sorted(detail["cost"].tolist()) == [0.0, 0.0, 1.0, 1.5, 2.0, 3.0]
+
+    # 已有状态覆盖到桶 0 时，每块只保留其后的桶
+    _, after, _ = _stream_reduce_query_to_local(path, args, chunk_rows=2, after_bucket=0, **kw)
+    assert int(after["sums"]["time_bucket"].min()) == 1
+
+
+def test_stream_reduce_many_chunks_merges_as_tree(tmp_path, monkeypatch):
+    import random
+    from types import SimpleNamespace
+
+    import cum10m
+
+    rng = random.Random(7)
+    n = 600
+    rows = [
+        [f"d{rng.randrange(4)}", f"u{rng.randrange(200)}", str(rng.randint(1, 9)), f"2025123000{rng.randrange(3)}{rng.randrange(10)}", "20251230"]
+        for _ in range(n)
+    ]
+    path = tmp_path / "q.txt"
+    path.write_bytes("".join("\x01".join(r) + "\n" for r in rows).encode())
+    fields = ["d1", "uid", "cost", "time_minute", "date_p"]
+    args = SimpleNamespace(date_p=20251230, key_encoding="raw")
+    kw = dict(fields=fields, metric_rules={"uid": "distinct", "cost": "sum"}, computed={}, end_bucket=2)
+    _, whole, _ = _stream_reduce_query_to_local(path, args, chunk_rows=n, **kw)
+
+    # 150 个块：每块状态至多 2 * 4 行，树形合并时每层输入不超过 2n 行、共 ceil(log2(150)) + 1 层；
+    # 逐块并入整体状态时每块都要带上整个累积状态，输入行数随块数平方增长
+    merged_rows = []
+    real_merge = cum10m._merge_leaf_state
+
+    def counting_merge(*states, **mkw):
+        merged_rows.append(sum(len(x["sums"]) + sum(len(t) for t in x["first"].values()) for x in states))
+        return real_merge(*states, **mkw)
+
+    monkeypatch.setattr(cum10m, "_merge_leaf_state", counting_merge)
+    _, leaf, _ = _stream_reduce_query_to_local(path, args, chunk_rows=4, **kw)
+    assert sum(merged_rows) <= 2 * n * 9
+    keys = ["d1", "time_bucket"]
+    pd.testing.assert_frame_equal(
+        leaf["sums"].sort_values(keys).reset_index(drop=True), whole["sums"].sort_values(keys).reset_index(drop=True)
+    )
+    fkeys = ["d1", "uid"]
+    pd.testing.assert_frame_equal(
+        leaf["first"]["uid"].sort_values(fkeys).reset_index(drop=True),
+        whole["first"]["uid"].sort_values(fkeys).reset_index(drop=True),
+    )
+
+
+def test_sliced_pull_covers_day_with_fallback_and_retries(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+
+    slices = _pull_time_slices(20251230, 202512300125, 60)
+    assert slices == [(None, 202512300100), (202512300100, None)]
+    assert _pull_time_slices(20251230, 202512300125, 60, after_minute=202512300019) == [(None, 202512300120), (202512300120, None)]
+    with pytest.raises(ValueError):
+        _pull_time_slices(20251230, 202512300125, 25)
+    hql = _build_time_slice_hql("select a, time_minute from t;", fields=["a", "time_minute"], lo_minute=202512300100)
+    assert hql.endswith(") sl\nwhere cast(time_minute as bigint) >= 202512300100")
+    assert _build_time_slice_hql("select 1", fields=["a"]) == "select 1"
+
+    # 每个分片：主引擎失败 -> 回退引擎；首片回退也失败一次，靠重试成功
+    calls = []
+
+    def fake_check_call(cmd):
+        engine, path = cmd[cmd.index("-se") + 1], Path(cmd[cmd.index("-file_path") + 1])
+        calls.append((path.name, engine))
+        if engine == "Presto" or (path.name.endswith("s000.txt") and calls.count((path.name, engine)) == 1):
+            raise subprocess.CalledProcessError(1, cmd)
+        path.write_bytes(b"x\x01" + path.name.encode() + b"\n")
+
+    monkeypatch.setattr(subprocess, "check_call", fake_check_call)
+    monkeypatch.setattr("cum10m.time.sleep", lambda sec: None)
+    args = SimpleNamespace(
+        dw_datawork_bin="datawork-client",
+        dw_project_name="p",
+        dw_ca_config_path="c",
+        dw_env="prod",
+        dw_query_fd="\\0001",
+        dw_hive_env="h",
+        dw_query_engine="Presto",
+        dw_query_fallback_engine="SparkSql",
+        dw_presto_max_runtime_minute=0,
+        dw_pull_workers=2,
+        dw_pull_retries=1,
+        dw_query_to_local_max_bytes=0,
+        _tmp_paths=[],
+    )
+    got = sorted(_pull_query_to_local_sliced(args, "select a, time_minute from t", fields=["a", "time_minute"], slices=slices, out_prefix=tmp_path / "src"))
+    assert [i for i, _ in got] == [0, 1]
+    assert [p.name for _, p in got] == ["src_s000.txt", "src_s001.txt"]
+    assert calls.count(("src_s000.txt", "SparkSql")) == 2 and calls.count(("src_s001.txt", "SparkSql")) == 1
+
+    args.dw_pull_retries = 0
+    with pytest.raises(subprocess.CalledProcessError):
+        _run_datawork_query_to_local(args, "select 1", tmp_path / "all_s000.txt")
+
+
+def test_first_seen_pushdown_queries_match_detail():
+    duckdb = pytest.importorskip("duckdb")
+    detail = pd.DataFrame(
+        {
+            "d1": ["a", "a", "b", "a", "b", "a"],
+            "oid": ["o1", "o2", "o1", "o1", None, "o3"],
+            "uid": ["u1", "u1", "u1", "u2", "u3", "u1"],
+            "cost": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+            "time_minute": [202512300003, 202512300004, 202512300015, 202512300021, 202512300022, 202512300035],
+            "date_p": [20251230] * 6,
+        }
+    )
+    fields = ["d1", "oid", "uid", "cost", "time_minute", "date_p"]
+    rules = {"oid": "distinct", "uid": "distinct", "cost": "sum"}
+    hqls = _build_first_seen_pushdown_hqls("select * from t;", fields=fields, metric_rules=rules, end_ts=202512300029)
+    assert len(hqls) == 3
+
+    con = duckdb.connect()
+    con.register("t", detail)
+    sums, first_oid, first_uid = [con.execute(q).df() for q in hqls]
+    con.close()
+    # 列序与 fields 一致，本地按同一套读入/预处理处理
+    assert all(list(x.columns) == fields for x in (sums, first_oid, first_uid))
+    assert sums.sort_values(["d1", "time_minute"])[["d1", "cost", "time_minute"]].values.tolist() == [
+        ["a", 3.0, "202512300000"],
+        ["a", 4.0, "202512300020"],
+        ["a", 6.0, "202512300030"],
+        ["b", 3.0, "202512300010"],
+        ["b", 5.0, "202512300020"],
+    ]
+    assert sums["oid"].isna().all() and sums["uid"].isna().all()
+    # 每个 (维度, key) 一行首次出现桶；NULL key 与 end_ts 之后的明细不参与
+    assert sorted(first_oid[["d1", "oid", "time_minute"]].values.tolist()) == [
+        ["a", "o1", 202512300000],
+        ["a", "o2", 202512300000],
+        ["b", "o1", 202512300010],
+    ]
+    assert sorted(first_uid[["d1", "uid", "time_minute"]].values.tolist()) == [
+        ["a", "u1", 202512300000],
+        ["a", "u2", 202512300020],
+        ["b", "u1", 202512300010],
+        ["b", "u3", 202512300020],
+    ]
+    assert (first_uid["cost"] == 0).all() and first_uid["oid"].isna().all()
+
+
+def test_state_dir_repulls_open_bucket_on_next_run(tmp_path):
+    sql = """
+    SELECT
+      d1,
+      uid,   -- distinct_user_num
+      cost,  -- sum
+      time_minute,
+      date_p
+    FROM t
+    """
+    rows = [
+        ("a", "u1", 1.0, 202512300001),
+        ("a", "u2", 2.0, 202512300011),
+    ]
+    # 第一次运行之后才落地、仍属于第一次 end_ts 所在桶（00:10~00:19）的明细
+    late_rows = [
+        ("a", "u3", 4.0, 202512300015),
+        ("b", "u1", 8.0, 202512300019),
+        ("a", "u4", 16.0, 202512300022),
+    ]
+
+    def run(detail, end_ts, out, extra):
+        src = tmp_path / f"{out}.in.xlsx"
+        pd.DataFrame(detail, columns=["d1", "uid", "cost", "time_minute"]).assign(date_p=20251230).to_excel(src, index=False)
+        cmd = [sys.executable, "cum10m.py", "--source", "excel", "--input", str(src), "--output", str(tmp_path / f"{out}.xlsx")]
+        cmd += ["--date-p", "20251230", "--start-ts", "202512300000", "--end-ts", str(end_ts), "--no-cube"] + extra
+        subprocess.run(cmd, input=sql, text=True, check=True)
+        return pd.read_excel(tmp_path / f"{out}.xlsx").sort_values(["d1", "date_minute"]).reset_index(drop=True)
+
+    state = ["--state-dir", str(tmp_path / "state")]
+    run(rows, 202512300010, "first", state)
+    got = run(rows + late_rows, 202512300020, "second", state)
+    want = run(rows + late_rows, 202512300020, "full", [])
+    pd.testing.assert_frame_equal(got, want)
+    assert got[got["date_minute"] == 202512300010]["cost"].tolist() == [7.0, 8.0]
+
+
+def test_state_dir_append_computes_only_new_buckets(tmp_path, monkeypatch):
+    sql = """
+    SELECT
+      d1,
+      d2,
+      uid,   -- distinct_user_num
+      cost,  -- sum
+      time_minute,
+      date_p
+    FROM t
+    """
+    rows = [
+        ("a", "p", "u1", 1.0, 202512300001),
+        ("a", "q", "u2", 2.0, 202512300011),
+        ("整体", "p", "u1", 4.0, 202512300013),
+        ("b", "p", "u1", 8.0, 202512300024),
+        ("a", "p", "u3", 16.0, 202512300025),
+        ("b", "q", "u2", 32.0, 202512300038),
+        ("c", "p", "u9", 64.0, 202512300041),
+    ]
+    src = tmp_path / "in.xlsx"
+    pd.DataFrame(rows, columns=["d1", "d2", "uid", "cost", "time_minute"]).assign(date_p=20251230).to_excel(src, index=False)
+
+    def run(end_ts, out, extra):
+        cmd = [sys.executable, "cum10m.py", "--source", "excel", "--input", str(src), "--output", str(tmp_path / f"{out}.xlsx")]
+        cmd += ["--date-p", "20251230", "--start-ts", "202512300000", "--end-ts", str(end_ts), "--dw-mode", "append"]
+        subprocess.run(cmd + extra, input=sql, text=True, check=True, cwd=ROOT)
+        got = pd.read_excel(tmp_path / f"{out}.xlsx", dtype={"d1": str, "d2": str})
+        return got.sort_values(["d1", "d2", "date_minute"]).reset_index(drop=True)
+
+    state = ["--state-dir", str(tmp_path / "state")]
+    prev = None
+    for i, end_ts in enumerate([202512300015, 202512300027, 202512300045]):
+        got = run(end_ts, f"inc{i}", state)
+        want = run(end_ts, f"full{i}", [])
+        if prev is not None:
+            want = want[want["date_minute"] > prev].reset_index(drop=True)
+        pd.testing.assert_frame_equal(got, want)
+        prev = end_ts // 10 * 10
+
+    # 状态里保存了各维度组合在已覆盖桶（00:30）的累计值，下次只算其后的桶
+    (path,) = (tmp_path / "state").iterdir()
+    cube = pd.read_pickle(path)["cube"]
+    assert cube["bucket"] == 3
+    totals = cube["totals"]
+    # 原始维度值“整体”（d1）与折叠出的“整体”各自保留一组（按 mask 区分），输出时才合并
+    both = totals[(totals["d1"] == "整体") & (totals["d2"] == "整体")].sort_values("cost")
+    assert both[["cost", "user_num"]].values.tolist() == [[4.0, 1.0], [63.0, 3.0]]
+
+
+def test_sliced_pull_resumes_from_open_bucket():
+    # 上次 end_ts=00:15：只有桶 0（00:00~00:09）已覆盖，桶 1 仍在落数
+    state = {"end_bucket": 0}
+    after = _state_resume_minute(state, 20251230)
+    assert after == 202512300009
+    slices = _pull_time_slices(20251230, 202512300125, 30, after_minute=after)
+    assert slices[0] == (None, 202512300040)
+    hql = _build_time_slice_hql(
+        _build_incremental_hql("select a, time_minute from t", fields=["a", "time_minute"], after_minute=after),
+        fields=["a", "time_minute"],
+        hi_minute=slices[0][1],
+    )
+    assert "where cast(time_minute as bigint) > 202512300009" in hql